@@ -0,0 +1,118 @@
+<?php
+require_once __DIR__ . '/helpers.php';
+// public/api/backtest-run-details.php
+// Сделки/индикаторы прогона из backtest_run_blobs (формат - backtest_blobs.py):
+//   ?run_id=N&kind=trades      - колонки сделок {entry_time: [...], ...}
+//   ?run_id=N&kind=indicators  - индикаторы в полном разрешении {name: {time: [...], value: [...]}}
+// Прогоны без блоба (старые записи) отдаются из backtest_runs.trades_json / indicators_json.
+require_once __DIR__ . '/db.php';
+
+// exit_time открытой сделки в блобе (NAT_MS в backtest_runner.py)
+const NAT_MS = PHP_INT_MIN;
+
+$runId = isset($_GET['run_id']) ? (int)$_GET['run_id'] : 0;
+$kind = $_GET['kind'] ?? 'trades';
+if ($runId <= 0) {
+    json_error('run_id is required');
+}
+if ($kind !== 'trades' && $kind !== 'indicators') {
+    json_error('kind must be trades or indicators');
+}
+
+function decompress_blob(string $codec, string $payload): string {
+    if ($codec === 'zlib') {
+        $raw = gzuncompress($payload);
+    } elseif ($codec === 'zstd') {
+        if (!function_exists('zstd_uncompress')) {
+            throw new RuntimeException('Блоб сжат zstd, но расширение zstd для PHP не установлено');
+        }
+        $raw = zstd_uncompress($payload);
+    } else {
+        throw new RuntimeException("Неизвестный codec блоба: $codec");
+    }
+    if ($raw === false) {
+        throw new RuntimeException("Не удалось распаковать блоб ($codec)");
+    }
+    return $raw;
+}
+
+// Один массив буфера в список PHP (NaN -> null: json_encode не пишет NaN)
+function unpack_column(string $raw, int $offset, string $dtype, int $n): array {
+    if ($n === 0) {
+        return [];
+    }
+    switch ($dtype) {
+        case '<f8':
+            $values = array_values(unpack("e$n", $raw, $offset));
+            return array_map(fn($v) => is_nan($v) ? null : $v, $values);
+        case '<i8':
+            return array_values(unpack("q$n", $raw, $offset));
+        case '<i4':
+            return array_values(unpack("l$n", $raw, $offset));
+        case '|b1':
+            return array_map(fn($v) => $v !== 0, array_values(unpack("C$n", $raw, $offset)));
+        default:
+            throw new RuntimeException("Неподдерживаемый dtype колонки: $dtype");
+    }
+}
+
+// Обратное к encode_columns: [(key, values), ...] в порядке заголовка
+function decode_columns(string $codec, string $payload): array {
+    $raw = decompress_blob($codec, $payload);
+    $headerLen = unpack('V', $raw, 0)[1];
+    $header = json_decode(substr($raw, 4, $headerLen), true);
+    $offset = 4 + $headerLen;
+
+    $columns = [];
+    foreach ($header as $item) {
+        $itemSize = (int)substr($item['dtype'], 2);
+        $columns[] = [$item['key'], unpack_column($raw, $offset, $item['dtype'], $item['len'])];
+        $offset += $itemSize * $item['len'];
+    }
+    return $columns;
+}
+
+try {
+    $pdo = get_db_connection();
+
+    $stmt = $pdo->prepare("
+        SELECT codec, payload
+        FROM backtest_run_blobs
+        WHERE run_id = :run_id AND kind = :kind
+    ");
+    $stmt->execute(['run_id' => $runId, 'kind' => $kind]);
+    $blob = $stmt->fetch();
+
+    if ($blob) {
+        // PDO pgsql отдаёт bytea потоком
+        $payload = is_resource($blob['payload']) ? stream_get_contents($blob['payload']) : $blob['payload'];
+        $data = [];
+        foreach (decode_columns($blob['codec'], $payload) as [$key, $values]) {
+            if ($kind === 'trades') {
+                if ($key === 'exit_time') {
+                    $values = array_map(fn($v) => $v === NAT_MS ? null : $v, $values);
+                }
+                $data[$key] = $values;
+            } else {
+                // ключ индикатора - [name, 'time' | 'value']
+                [$name, $field] = $key;
+                $data[$name][$field] = $values;
+            }
+        }
+        json_response(['run_id' => $runId, 'kind' => $kind, 'source' => 'blob', 'data' => $data]);
+    }
+
+    $column = $kind === 'trades' ? 'trades_json' : 'indicators_json';
+    $stmt = $pdo->prepare("SELECT $column AS details FROM backtest_runs WHERE id = :run_id");
+    $stmt->execute(['run_id' => $runId]);
+    $run = $stmt->fetch();
+
+    if (!$run) {
+        json_error('Run not found', 404);
+    }
+
+    $data = $run['details'] !== null ? json_decode($run['details'], true) : null;
+    json_response(['run_id' => $runId, 'kind' => $kind, 'source' => 'json', 'data' => $data]);
+} catch (Throwable $e) {
+    json_error($e->getMessage(), 500);
+}
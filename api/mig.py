@@ -109,6 +109,12 @@ CREATE INDEX IF NOT EXISTS idx_live_orders_status
 CREATE INDEX IF NOT EXISTS idx_live_orders_symbol_time
     ON live_orders (symbol, created_at);
 
+-- резерв денег под неисполненные заявки (execution_engine.load_risk_snapshot)
+CREATE INDEX IF NOT EXISTS idx_live_orders_pending
+    ON live_orders (strategy_universe_id, symbol)
+    INCLUDE (live_signal_id, quantity, price)
+    WHERE status IN ('NEW', 'WORKING', 'PARTIALLY_FILLED');
+
 CREATE TABLE IF NOT EXISTS live_trades (
     id                   bigserial PRIMARY KEY,
     live_order_id        bigint REFERENCES live_orders(id) ON DELETE SET NULL,
@@ -147,6 +153,125 @@ CREATE INDEX IF NOT EXISTS idx_live_errors_time
 CREATE INDEX IF NOT EXISTS idx_live_errors_strategy
     ON live_errors (strategy_universe_id, timestamp);
 
+-- Детали лучших прогонов (пишет backtest_blobs.save_run_details): их читают select_universe.php
+-- и backtest-run-details.php
+CREATE TABLE IF NOT EXISTS backtest_run_blobs (
+    run_id      integer NOT NULL REFERENCES backtest_runs (id) ON DELETE CASCADE,
+    kind        varchar(20) NOT NULL,
+    codec       varchar(10) NOT NULL,
+    raw_bytes   integer NOT NULL,
+    payload     bytea NOT NULL,
+    created_at  timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_id, kind)
+);
+
+-- payload уже сжат: TOAST не должен сжимать его повторно
+ALTER TABLE backtest_run_blobs ALTER COLUMN payload SET STORAGE EXTERNAL;
+
+-- Последняя минутка по инструменту (utils_prices): пишет datafeed_aggregator,
+-- читают fake_broker, переоценка позиций и health_monitor
+CREATE TABLE IF NOT EXISTS last_prices (
+    symbol_id      integer PRIMARY KEY REFERENCES symbols (id) ON DELETE CASCADE,
+    ticker         text NOT NULL,
+    price          double precision NOT NULL,
+    bar_timestamp  timestamp NOT NULL,
+    open           double precision,
+    high           double precision,
+    low            double precision,
+    volume         bigint,
+    updated_at     timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_last_prices_ticker
+    ON last_prices (ticker);
+
+-- последняя минутка по инструменту: заполнение last_prices ниже и load_recent_minutes
+-- в health_monitor читают candles_1m по этому индексу, без него - полный скан на инструмент
+CREATE INDEX IF NOT EXISTS idx_candles_1m_symbol_time
+    ON candles_1m (symbol_id, timestamp);
+
+-- первичное заполнение из уже загруженных минуток (по индексу symbol_id, timestamp)
+INSERT INTO last_prices (symbol_id, ticker, price, bar_timestamp, open, high, low, volume)
+SELECT s.id, s.ticker, c.close, c.timestamp, c.open, c.high, c.low, c.volume
+FROM symbols s
+CROSS JOIN LATERAL (
+    SELECT timestamp, open, high, low, close, volume
+    FROM candles_1m
+    WHERE symbol_id = s.id
+    ORDER BY timestamp DESC
+    LIMIT 1
+) c
+ON CONFLICT (symbol_id) DO NOTHING;
+
+-- Инструменты с запретом новых позиций из-за устаревших или рваных данных
+-- (пишет health_monitor, читает execution_engine.load_risk_snapshot)
+CREATE TABLE IF NOT EXISTS symbol_blocks (
+    symbol_id      integer PRIMARY KEY REFERENCES symbols (id) ON DELETE CASCADE,
+    ticker         text NOT NULL,
+    reason         text NOT NULL,
+    details_json   jsonb,
+    blocked_at     timestamptz NOT NULL DEFAULT now(),
+    updated_at     timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_symbol_blocks_ticker
+    ON symbol_blocks (ticker);
+
+-- Время записи свечи (задержки цепочки, utils_latency). Столбец добавляется без
+-- значения по умолчанию: ADD COLUMN с volatile DEFAULT переписал бы таблицу под
+-- блокировкой и проставил время миграции всей истории. DEFAULT задаётся отдельно
+-- и действует только для новых строк, у старых ingested_at остаётся NULL.
+ALTER TABLE candles_1m  ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+ALTER TABLE candles_5m  ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+ALTER TABLE candles_15m ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+ALTER TABLE candles_30m ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+ALTER TABLE candles_1h  ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+ALTER TABLE candles_4h  ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+ALTER TABLE candles_1d  ADD COLUMN IF NOT EXISTS ingested_at timestamptz;
+
+ALTER TABLE candles_1m  ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+ALTER TABLE candles_5m  ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+ALTER TABLE candles_15m ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+ALTER TABLE candles_30m ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+ALTER TABLE candles_1h  ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+ALTER TABLE candles_4h  ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+ALTER TABLE candles_1d  ALTER COLUMN ingested_at SET DEFAULT clock_timestamp();
+
+-- Версия lot_history для кэша лотов (utils_lot.LotHistoryVersion): UPDATE на месте
+-- (исправление lot_size) меняет только updated_at. Существующим строкам - время миграции.
+ALTER TABLE lot_history ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE lot_history ALTER COLUMN updated_at SET DEFAULT clock_timestamp();
+
+CREATE OR REPLACE FUNCTION set_timestamp_lot_history() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER trg_set_timestamp_lot_history
+    BEFORE UPDATE ON lot_history
+    FOR EACH ROW EXECUTE FUNCTION set_timestamp_lot_history();
+
+-- Замеры задержек: одна строка - агрегат пачки этапа (utils_latency.LatencyRecorder)
+CREATE TABLE IF NOT EXISTS latency_trace (
+    id           bigserial PRIMARY KEY,
+    stage        text NOT NULL,
+    metric       text NOT NULL,
+    samples      integer NOT NULL,
+    min_ms       double precision NOT NULL,
+    max_ms       double precision NOT NULL,
+    sum_ms       double precision NOT NULL,
+    buckets      integer[] NOT NULL,
+    items        bigint,
+    recorded_at  timestamptz NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE INDEX IF NOT EXISTS idx_latency_trace_time
+    ON latency_trace (recorded_at);
+
 COMMIT;
 """
 
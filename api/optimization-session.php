@@ -42,8 +42,10 @@ try {
         json_response(['error' => 'Session not found'], 404);
     }
 
+    // Сделки прогона в список не входят: api/backtest-run-details.php?run_id=...&kind=trades
     $sqlTrials = "
         SELECT
+            b.id AS run_id,
             b.trial_number,
             b.is_best,
             b.params_json,
@@ -53,7 +55,6 @@ try {
             b.profit_factor,
             b.trades_count,
             b.target_metric_value,
-            b.trades_json,
             b.indicators_json
         FROM backtest_runs b
         WHERE b.optimization_id = :opt_id
@@ -47,7 +47,9 @@ $sql = "
         br.created_at
     FROM backtest_runs br
     WHERE br.is_best = 1
-      AND br.trades_json IS NOT NULL
+      AND (br.trades_json IS NOT NULL
+           OR EXISTS (SELECT 1 FROM backtest_run_blobs bb
+                      WHERE bb.run_id = br.id AND bb.kind = 'trades'))
       AND br.indicators_json IS NOT NULL
 ";
 
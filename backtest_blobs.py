@@ -0,0 +1,212 @@
+"""
+backtest_blobs.py - Компактное хранение деталей бэктеста (сделки и индикаторы)
+
+Колонки NumPy складываются в один буфер (JSON-заголовок + сырые массивы) и
+сжимаются zstd (если установлен zstandard) или zlib. Блоб лежит в таблице
+backtest_run_blobs (bytea, создаётся api/mig.py), по одной строке на (run_id, kind):
+    kind = 'trades'     - колонки extract_trade_columns
+    kind = 'indicators' - ряды extract_indicator_series в полном разрешении
+
+В backtest_runs.indicators_json остаются прореженные для графика ряды,
+полное разрешение читается через load_indicator_series. trades_json у прогонов
+с блобом не заполняется; веб-интерфейс читает блобы через
+api/backtest-run-details.php (zstd - только при установленном расширении PHP).
+
+Раскладка буфера (до сжатия):
+    [ uint32 LE: длина заголовка ][ заголовок JSON ][ массив 1 ][ массив 2 ] ...
+Заголовок: [{"key": ..., "dtype": "<f8", "len": n}, ...] в порядке массивов.
+"""
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+import json
+import struct
+import zlib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # zstandard не обязателен: без него блобы сжимаются zlib
+    zstandard = None
+
+
+KIND_TRADES = 'trades'
+KIND_INDICATORS = 'indicators'
+
+# Уровни сжатия: блобы пишутся один раз на лучший прогон, читаются многократно
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 6
+
+
+# --- Кодирование ---
+
+def _compress(raw: bytes) -> Tuple[str, bytes]:
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return 'zlib', zlib.compress(raw, ZLIB_LEVEL)
+
+
+def _decompress(codec: str, payload: bytes) -> bytes:
+    if codec == 'zlib':
+        return zlib.decompress(payload)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Блоб сжат zstd, но модуль zstandard не установлен")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Неизвестный codec блоба: {codec}")
+
+
+def encode_columns(columns: Dict[Hashable, np.ndarray]) -> Tuple[str, int, bytes]:
+    """
+    Упаковывает колонки NumPy в сжатый буфер
+
+    Args:
+        columns: {ключ: одномерный массив}; ключ - строка или кортеж строк
+
+    Returns:
+        (codec, размер до сжатия, payload)
+    """
+    header = []
+    arrays = []
+    for key, values in columns.items():
+        arr = np.ascontiguousarray(values)
+        if arr.ndim != 1:
+            raise ValueError(f"Колонка {key!r} не одномерная: shape={arr.shape}")
+        header.append({
+            'key': list(key) if isinstance(key, tuple) else key,
+            'dtype': arr.dtype.str,
+            'len': len(arr),
+        })
+        arrays.append(arr)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    raw = b''.join([struct.pack('<I', len(header_bytes)), header_bytes] + [a.tobytes() for a in arrays])
+    codec, payload = _compress(raw)
+    return codec, len(raw), payload
+
+
+def decode_columns(codec: str, payload: bytes) -> Dict[Hashable, np.ndarray]:
+    """Распаковывает буфер encode_columns обратно в колонки NumPy"""
+    raw = _decompress(codec, bytes(payload))
+    (header_len,) = struct.unpack_from('<I', raw, 0)
+    offset = 4 + header_len
+    header = json.loads(raw[4:offset].decode('utf-8'))
+
+    columns: Dict[Hashable, np.ndarray] = {}
+    for item in header:
+        dtype = np.dtype(item['dtype'])
+        n = item['len']
+        key = tuple(item['key']) if isinstance(item['key'], list) else item['key']
+        # frombuffer даёт read-only view на raw; copy() отвязывает колонку от общего буфера
+        columns[key] = np.frombuffer(raw, dtype=dtype, count=n, offset=offset).copy()
+        offset += dtype.itemsize * n
+    return columns
+
+
+def pack_indicator_series(series: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> Dict[Hashable, np.ndarray]:
+    """{name: (times, values)} -> {(name, 'time'): ..., (name, 'value'): ...}"""
+    columns: Dict[Hashable, np.ndarray] = {}
+    for name, (times, values) in series.items():
+        columns[(name, 'time')] = times
+        columns[(name, 'value')] = values
+    return columns
+
+
+def unpack_indicator_series(
+    columns: Dict[Hashable, np.ndarray],
+    names: Optional[Iterable[str]] = None
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Обратное к pack_indicator_series; names - оставить только эти индикаторы"""
+    wanted = set(names) if names is not None else None
+    series: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+    for (name, field), values in columns.items():
+        if field != 'time' or (wanted is not None and name not in wanted):
+            continue
+        series[name] = (values, columns[(name, 'value')])
+    return series
+
+
+# --- Чтение/запись в БД ---
+
+def save_blob(conn, run_id: int, kind: str, columns: Dict[Hashable, np.ndarray]):
+    """
+    Записывает (или заменяет) блоб прогона; commit - на стороне вызывающего
+
+    Args:
+        conn: соединение psycopg2
+        run_id: backtest_runs.id
+        kind: KIND_TRADES или KIND_INDICATORS
+        columns: колонки NumPy
+    """
+    codec, raw_bytes, payload = encode_columns(columns)
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO backtest_run_blobs (run_id, kind, codec, raw_bytes, payload)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (run_id, kind) DO UPDATE
+            SET codec = EXCLUDED.codec,
+                raw_bytes = EXCLUDED.raw_bytes,
+                payload = EXCLUDED.payload,
+                created_at = CURRENT_TIMESTAMP
+            """,
+            (run_id, kind, codec, raw_bytes, payload),
+        )
+
+
+def load_blob(conn, run_id: int, kind: str) -> Optional[Dict[Hashable, np.ndarray]]:
+    """Читает блоб прогона; None - блоба нет"""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT codec, payload FROM backtest_run_blobs WHERE run_id = %s AND kind = %s",
+            (run_id, kind),
+        )
+        row = cur.fetchone()
+
+    if row is None:
+        return None
+    return decode_columns(row[0], row[1])
+
+
+def save_run_details(
+    conn,
+    run_id: int,
+    trade_columns: Optional[Dict[str, np.ndarray]],
+    indicator_series: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]
+):
+    """
+    Сохраняет сделки и индикаторы прогона в полном разрешении
+
+    Принимает trade_columns/indicator_series из результата run_backtest.
+    Таблицу создаёт миграция (api/mig.py); commit - на стороне вызывающего.
+    """
+    if trade_columns:
+        save_blob(conn, run_id, KIND_TRADES, trade_columns)
+    if indicator_series:
+        save_blob(conn, run_id, KIND_INDICATORS, pack_indicator_series(indicator_series))
+
+
+def load_trade_columns(conn, run_id: int) -> Optional[Dict[str, np.ndarray]]:
+    """Сделки прогона: колонки extract_trade_columns (None - блоба нет)"""
+    return load_blob(conn, run_id, KIND_TRADES)
+
+
+def load_indicator_series(
+    conn,
+    run_id: int,
+    names: Optional[Iterable[str]] = None
+) -> Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Индикаторы прогона в полном разрешении
+
+    Args:
+        conn: соединение psycopg2
+        run_id: backtest_runs.id
+        names: только эти индикаторы (None - все)
+
+    Returns:
+        {name: (times_ms int64, values float64)} или None, если блоба нет
+    """
+    columns = load_blob(conn, run_id, KIND_INDICATORS)
+    if columns is None:
+        return None
+    return unpack_indicator_series(columns, names)
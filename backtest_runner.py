@@ -1,14 +1,20 @@
 # backtest_runner.py - backtesting.py интеграция
 from typing import Any, Dict, Tuple, Optional
 import pandas as pd
-import psycopg2
 from psycopg2.extras import RealDictCursor
 from backtesting import Backtest
 from datetime import datetime
 import json
+import numpy as np
 from config_loader import StrategyConfig, DB_CFG
+from db_pool import connection, register_statement, execute_prepared
 from importlib import import_module
 
+try:
+    import orjson
+except ImportError:  # orjson не обязателен: без него используется стандартный json
+    orjson = None
+
 
 def load_strategy_class(cfg: StrategyConfig):
     """Загружает класс стратегии из модуля"""
@@ -36,37 +42,100 @@ def load_ohlcv_from_db(
     Returns:
         DataFrame с колонками Open, High, Low, Close, Volume и индексом timestamp
     """
-    conn = psycopg2.connect(**db_cfg)
-    try:
+    statement = register_statement(
+        f"load_ohlcv_{timeframe_table}",
+        f"""
+            SELECT timestamp, open, high, low, close, volume
+            FROM {timeframe_table}
+            WHERE symbol_id = %s AND timestamp BETWEEN %s AND %s
+            ORDER BY timestamp
+        """
+    )
+
+    with connection(db_cfg) as conn:
         with conn.cursor() as cur:
-            sql = f"""
-                SELECT timestamp, open, high, low, close, volume
-                FROM {timeframe_table}
-                WHERE symbol_id = %s AND timestamp BETWEEN %s AND %s
-                ORDER BY timestamp
-            """
-            cur.execute(sql, (symbol_id, start, end))
+            execute_prepared(cur, statement, (symbol_id, start, end))
             rows = cur.fetchall()
 
-            if not rows:
-                raise ValueError(f"No data found for symbol_id={symbol_id} in {timeframe_table}")
+    if not rows:
+        raise ValueError(f"No data found for symbol_id={symbol_id} in {timeframe_table}")
+
+    df = pd.DataFrame(rows, columns=['timestamp', 'Open', 'High', 'Low', 'Close', 'Volume'])
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    df.set_index('timestamp', inplace=True)
+    return df
+
 
-            df = pd.DataFrame(rows, columns=['timestamp', 'Open', 'High', 'Low', 'Close', 'Volume'])
-            df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
-            df.set_index('timestamp', inplace=True)
-            return df
-    finally:
-        conn.close()
+def dumps_json(obj: Any) -> str:
+    """Сериализует в JSON-строку: orjson (если установлен) или стандартный json"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
 
 
-def extract_trades_json(stats) -> str:
+def to_epoch_ms(values) -> np.ndarray:
     """
-    Извлекает сделки из результатов бэктеста и конвертирует в JSON
-    Включает информацию о входе И выходе из позиции
+    Переводит время в миллисекунды Unix epoch (UTC), int64
+
+    Время без часового пояса считается UTC. NaT остаётся NaT-значением int64,
+    проверять его нужно по pd.isna исходных значений.
+    """
+    idx = pd.DatetimeIndex(values)
+    if idx.tz is not None:
+        idx = idx.tz_convert('UTC').tz_localize(None)
+    return idx.values.astype('datetime64[ms]').view(np.int64)
+
+
+# Прореживание индикаторов в indicators_json: точек на ряд не больше (None - без прореживания)
+CHART_MAX_POINTS = 5000
+
+# Значение int64 для NaT в колонках времени (epoch ms)
+NAT_MS = np.iinfo(np.int64).min
+
+
+def _with_nulls(values: np.ndarray, null_mask: np.ndarray) -> list:
+    """Список значений с None на позициях null_mask"""
+    return [None if is_null else v for v, is_null in zip(values.tolist(), null_mask.tolist())]
+
+
+def downsample_series(times: np.ndarray, values: np.ndarray, max_points: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Прореживает ряд для графика, сохраняя форму (min/max в каждом интервале)
+
+    Ряд делится на max_points // 2 интервалов, из каждого берутся точки
+    минимума и максимума; первая и последняя точки сохраняются всегда.
+    """
+    n = len(values)
+    if max_points is None or n <= max_points:
+        return times, values
+
+    bucket = -(-n // max(max_points // 2, 1))
+    n_buckets = -(-n // bucket)
+    pad = n_buckets * bucket - n
+
+    lows = np.concatenate([values, np.full(pad, np.inf)]).reshape(n_buckets, bucket)
+    highs = np.concatenate([values, np.full(pad, -np.inf)]).reshape(n_buckets, bucket)
+    base = np.arange(n_buckets) * bucket
+
+    idx = np.unique(np.concatenate([
+        [0, n - 1],
+        base + lows.argmin(axis=1),
+        base + highs.argmax(axis=1),
+    ]))
+    return times[idx], values[idx]
+
+
+def extract_trade_columns(stats) -> Dict[str, np.ndarray]:
     """
-    import pandas as pd
-    import json
+    Извлекает сделки из результатов бэктеста в виде колонок NumPy
 
+    Время - миллисекунды Unix epoch (UTC), у открытых сделок exit_time = NAT_MS
+    и exit_price = NaN.
+
+    Returns:
+        {entry_time, entry_price, exit_time, exit_price, size, is_long, pnl, pnl_percent}
+        (пустой словарь, если сделок нет)
+    """
     trades_df = None
     if hasattr(stats, '_trades'):
         trades_df = getattr(stats, '_trades')
@@ -74,59 +143,91 @@ def extract_trades_json(stats) -> str:
         trades_df = getattr(stats, 'trades')
 
     if trades_df is None or len(trades_df) == 0:
-        return json.dumps([])
+        return {}
+
+    df = trades_df[trades_df['EntryTime'].notna()]
+    if len(df) == 0:
+        return {}
+
+    def column(name: str) -> np.ndarray:
+        if name not in df:
+            return np.zeros(len(df))
+        return df[name].to_numpy(dtype=np.float64)
+
+    size = column('Size')
+
+    return {
+        'entry_time': to_epoch_ms(df['EntryTime']),
+        'entry_price': column('EntryPrice'),
+        'exit_time': to_epoch_ms(df['ExitTime']),
+        'exit_price': column('ExitPrice'),
+        'size': np.abs(size),
+        'is_long': size > 0,
+        'pnl': column('PnL'),
+        'pnl_percent': column('ReturnPct') * 100,
+    }
 
-    df = trades_df.copy()
-    trades_list = []
 
-    for _, tr in df.iterrows():
-        # Получаем время входа
-        entry_time = tr.get('EntryTime')
-        if pd.isna(entry_time):
-            continue
+def trades_to_json(columns: Dict[str, np.ndarray], columnar: bool = False) -> str:
+    """
+    Сделки (результат extract_trade_columns) в JSON
+
+    Args:
+        columns: колонки сделок
+        columnar: True - {"entry_time": [...], "entry_price": [...], ...},
+                  False - список объектов сделок
+    """
+    if not columns:
+        return dumps_json([])
 
-        # Получаем время выхода
-        exit_time = tr.get('ExitTime')
+    exit_time = columns['exit_time']
+    exit_price = columns['exit_price']
 
-        # Получаем цены
-        entry_price = float(tr.get('EntryPrice', 0.0))
-        exit_price = float(tr.get('ExitPrice', 0.0)) if not pd.isna(tr.get('ExitPrice')) else None
+    lists = {name: values.tolist() for name, values in columns.items()}
+    lists['exit_time'] = _with_nulls(exit_time, exit_time == NAT_MS)
+    lists['exit_price'] = _with_nulls(exit_price, np.isnan(exit_price))
 
-        # Определяем направление сделки
-        size = float(tr.get('Size', 0.0))
-        is_long = size > 0
+    if columnar:
+        return dumps_json(lists)
 
-        # P&L
-        pnl = float(tr.get('PnL', 0.0))
-        pnl_percent = float(tr.get('ReturnPct', 0.0)) * 100 if 'ReturnPct' in tr else 0.0
+    keys = list(lists)
+    return dumps_json([dict(zip(keys, row)) for row in zip(*lists.values())])
 
-        trade_data = {
-            'entry_time': entry_time.isoformat() if hasattr(entry_time, 'isoformat') else str(entry_time),
-            'entry_price': entry_price,
-            'exit_time': exit_time.isoformat() if exit_time and hasattr(exit_time, 'isoformat') else (str(exit_time) if exit_time else None),
-            'exit_price': exit_price,
-            'size': abs(size),
-            'is_long': is_long,
-            'pnl': pnl,
-            'pnl_percent': pnl_percent
-        }
 
-        trades_list.append(trade_data)
+def extract_trades_json(stats, columnar: bool = False) -> str:
+    """
+    Извлекает сделки из результатов бэктеста и конвертирует в JSON
+    Включает информацию о входе И выходе из позиции
 
-    return json.dumps(trades_list)
+    Время - миллисекунды Unix epoch (UTC).
 
+    Args:
+        stats: результат Backtest.run
+        columnar: True - {"entry_time": [...], "entry_price": [...], ...},
+                  False - список объектов сделок
 
-def extract_indicators_json(stats, data: pd.DataFrame) -> str:
+    Returns:
+        JSON-строка
     """
-    Извлекает значения индикаторов из объекта стратегии и конвертирует в JSON
+    return trades_to_json(extract_trade_columns(stats), columnar)
+
+
+def extract_indicator_series(stats, data: pd.DataFrame) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
     """
-    import json
+    Извлекает индикаторы стратегии в полном разрешении
 
-    series: Dict[str, Any] = {}
+    NaN/Inf пропускаются, время - миллисекунды Unix epoch (UTC).
+
+    Returns:
+        {name: (times_ms int64, values float64)}
+    """
+    series: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
 
     strategy = getattr(stats, '_strategy', None)
     if strategy is None:
-        return json.dumps({})
+        return series
+
+    times = to_epoch_ms(data.index)
 
     for attr_name in dir(strategy):
         if attr_name.startswith('_'):
@@ -137,25 +238,77 @@ def extract_indicators_json(stats, data: pd.DataFrame) -> str:
             continue
 
         # Проверяем, является ли атрибут индикатором (имеет len и name)
-        if hasattr(attr, '__len__') and hasattr(attr, 'name'):
-            indicator_data = []
+        if not (hasattr(attr, '__len__') and hasattr(attr, 'name')):
+            continue
+
+        try:
+            values = np.asarray(attr, dtype=np.float64)
+        except (TypeError, ValueError):
+            continue
+        if values.ndim != 1:
+            continue
+
+        values = values[:len(times)]
+        mask = np.isfinite(values)
+        if not mask.any():
+            continue
+
+        series[attr.name] = (times[:len(values)][mask], values[mask])
+
+    return series
+
 
-            for i, val in enumerate(attr):
-                if pd.isna(val):
-                    continue
-                if i >= len(data):
-                    break
+def indicators_to_json(
+    series: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    columnar: bool = False,
+    max_points: Optional[int] = None
+) -> str:
+    """
+    Индикаторы (результат extract_indicator_series) в JSON
+
+    Args:
+        series: {name: (times_ms, values)}
+        columnar: True - {name: {"time": [...], "value": [...]}},
+                  False - {name: [{"time": ..., "value": ...}, ...]}
+        max_points: прореживание каждого ряда до max_points точек (None - все точки)
+    """
+    out: Dict[str, Any] = {}
 
-                ts = data.index[i]
-                indicator_data.append({
-                    'time': ts.isoformat() if hasattr(ts, 'isoformat') else str(ts),
-                    'value': float(val)
-                })
+    for name, (times, values) in series.items():
+        times, values = downsample_series(times, values, max_points)
+        point_times = times.tolist()
+        point_values = values.tolist()
 
-            if indicator_data:
-                series[attr.name] = indicator_data
+        if columnar:
+            out[name] = {'time': point_times, 'value': point_values}
+        else:
+            out[name] = [{'time': t, 'value': v} for t, v in zip(point_times, point_values)]
 
-    return json.dumps(series)
+    return dumps_json(out)
+
+
+def extract_indicators_json(
+    stats,
+    data: pd.DataFrame,
+    columnar: bool = False,
+    max_points: Optional[int] = None
+) -> str:
+    """
+    Извлекает значения индикаторов из объекта стратегии и конвертирует в JSON
+
+    NaN/Inf пропускаются, время - миллисекунды Unix epoch (UTC).
+
+    Args:
+        stats: результат Backtest.run
+        data: свечи бэктеста (по их индексу берётся время точек)
+        columnar: True - {name: {"time": [...], "value": [...]}},
+                  False - {name: [{"time": ..., "value": ...}, ...]}
+        max_points: прореживание каждого ряда до max_points точек (None - все точки)
+
+    Returns:
+        JSON-строка
+    """
+    return indicators_to_json(extract_indicator_series(stats, data), columnar, max_points)
 
 
 def safe_float(v) -> float:
@@ -177,7 +330,10 @@ def run_backtest(
     window: Tuple[datetime, datetime],
     params: Dict[str, Any],
     db_cfg: Dict[str, Any] = DB_CFG,
-    extract_details: bool = True
+    extract_details: bool = True,
+    data: Optional[pd.DataFrame] = None,
+    columnar_details: bool = False,
+    chart_max_points: Optional[int] = CHART_MAX_POINTS
 ) -> Dict[str, Any]:
     """
     Запускает бэктест стратегии
@@ -190,37 +346,36 @@ def run_backtest(
         params: параметры стратегии
         db_cfg: конфигурация БД
         extract_details: извлекать ли детали (сделки, индикаторы)
+        data: заранее загруженные OHLCV (если None - загружаются из БД)
+        columnar_details: сделки и индикаторы в колоночном JSON ({time: [...], value: [...]})
+        chart_max_points: прореживание индикаторов в indicators_json (полные ряды - в indicator_series)
 
     Returns:
-        Словарь с результатами: метрики + trades_json + indicators_json
+        Словарь с результатами: метрики + trades_json + indicators_json,
+        а также trade_columns/indicator_series (колонки NumPy в полном разрешении)
     """
     # Загружаем класс стратегии
     StrategyClass = load_strategy_class(cfg)
 
-    # Загружаем данные
-    data = load_ohlcv_from_db(
-        symbol_id=symbol_id,
-        timeframe_table=timeframe_table,
-        start=window[0],
-        end=window[1],
-        db_cfg=db_cfg
-    )
+    # Загружаем данные (если не переданы готовые)
+    if data is None:
+        data = load_ohlcv_from_db(
+            symbol_id=symbol_id,
+            timeframe_table=timeframe_table,
+            start=window[0],
+            end=window[1],
+            db_cfg=db_cfg
+        )
 
     # Передаем symbol_id в стратегию (если нужно)
     StrategyClass.symbol_id = symbol_id
+    # Ключ набора данных: по нему стратегии переиспользуют общие индикаторы
+    StrategyClass.data_key = (symbol_id, timeframe_table, window[0], window[1])
 
     # Запускаем бэктест
     bt = Backtest(data, StrategyClass, cash=100000, commission=0.0005)
     stats = bt.run(**params)
 
-    # Извлекаем детали
-    trades_json = None
-    indicators_json = None
-
-    if extract_details:
-        trades_json = extract_trades_json(stats)
-        indicators_json = extract_indicators_json(stats, data)
-
     # Формируем результат
     res = {
         'CAGR': safe_float(stats.get('Return [%]', 0)),
@@ -233,8 +388,47 @@ def run_backtest(
         'MaxTradeDD': safe_float(stats.get('Max. Trade Duration', 0)),
         'target_metric': safe_float(stats.get('Sharpe Ratio', 0)),
         'raw_stats': stats,
-        'trades_json': trades_json,
-        'indicators_json': indicators_json
+        'trades_json': None,
+        'indicators_json': None,
+        'trade_columns': None,
+        'indicator_series': None
     }
 
+    # Извлекаем детали
+    if extract_details:
+        add_details(res, data, columnar_details=columnar_details, chart_max_points=chart_max_points)
+
     return res
+
+
+def add_details(
+    metrics: Dict[str, Any],
+    data: pd.DataFrame,
+    columnar_details: bool = False,
+    chart_max_points: Optional[int] = CHART_MAX_POINTS
+) -> Dict[str, Any]:
+    """
+    Дополняет результат run_backtest сделками и индикаторами по его raw_stats
+
+    Позволяет получить детали уже посчитанного прогона (например, лучшего
+    trial-а) без повторного бэктеста.
+
+    Args:
+        metrics: результат run_backtest (с raw_stats)
+        data: свечи, на которых выполнялся бэктест
+        columnar_details: сделки и индикаторы в колоночном JSON
+        chart_max_points: прореживание индикаторов в indicators_json
+
+    Returns:
+        Тот же словарь metrics с заполненными trades_json, indicators_json,
+        trade_columns, indicator_series
+    """
+    stats = metrics['raw_stats']
+    trade_columns = extract_trade_columns(stats)
+    indicator_series = extract_indicator_series(stats, data)
+
+    metrics['trade_columns'] = trade_columns
+    metrics['indicator_series'] = indicator_series
+    metrics['trades_json'] = trades_to_json(trade_columns, columnar=columnar_details)
+    metrics['indicators_json'] = indicators_to_json(indicator_series, columnar=columnar_details, max_points=chart_max_points)
+    return metrics
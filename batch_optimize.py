@@ -1,14 +1,34 @@
 """
 batch_optimize.py - Батчевая оптимизация стратегий
 """
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import os
+import time
+
+# Время импорта модулей: при spawn каждый воркер заново импортирует этот файл
+_IMPORT_STARTED = time.perf_counter()
+_IMPORT_PID = os.getpid()
+
+from psycopg2.extras import RealDictCursor, execute_values
 from datetime import datetime
-from typing import List
+from typing import List, Optional
+from urllib.parse import quote_plus
 import logging
-import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from strategy_optimizer import optimize_strategy, DBCFG
+import socket
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import optuna
+import pandas as pd
+from strategy_optimizer import optimize_strategy, create_optimization_session, DBCFG
+from backtest_runner import load_ohlcv_from_db, load_strategy_class
+from configloader import get_strategy_config, load_all_strategy_configs
+from db_pool import connection
+from utils_indicators import clear_indicator_cache
+from utils_lot import LotHistorySnapshot, get_lot_cache, install_lot_snapshot
+from ohlcv_arena import ArenaHandle, OhlcvArena, attach, detach
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 TIMEFRAMES: List[str] = [
     'candles_1m',
@@ -32,6 +52,47 @@ START_DATE = datetime(2024, 1, 1)
 END_DATE = datetime(2024, 11, 14)
 N_TRIALS = 50
 
+# Имя батча: по нему в batch_runs ищутся уже обработанные комбинации.
+# Тот же набор дат/trial-ов при перезапуске продолжает прерванный прогон.
+BATCH_NAME = f"grid_{START_DATE:%Y%m%d}_{END_DATE:%Y%m%d}_{N_TRIALS}"
+
+# Optuna-хранилище в той же PostgreSQL: недоделанные study продолжаются после рестарта
+OPTUNA_STORAGE_URL = (
+    f"postgresql+psycopg2://{quote_plus(DBCFG['user'])}:{quote_plus(DBCFG['password'])}"
+    f"@{DBCFG['host']}:{DBCFG['port']}/{DBCFG['database']}"
+)
+
+BATCH_RUNS_DDL = """
+CREATE TABLE IF NOT EXISTS batch_runs (
+    id               bigserial PRIMARY KEY,
+    batch_name       text    NOT NULL,
+    symbol_id        integer NOT NULL,
+    timeframe_table  text    NOT NULL,
+    strategy_code    text    NOT NULL,
+    status           text    NOT NULL DEFAULT 'pending',
+    optimization_id  integer,
+    study_name       text    NOT NULL,
+    attempts         integer NOT NULL DEFAULT 0,
+    best_value       double precision,
+    error            text,
+    created_at       timestamptz NOT NULL DEFAULT now(),
+    started_at       timestamptz,
+    finished_at      timestamptz,
+    CONSTRAINT batch_runs_unq UNIQUE (batch_name, symbol_id, timeframe_table, strategy_code)
+);
+
+CREATE INDEX IF NOT EXISTS idx_batch_runs_status
+    ON batch_runs (batch_name, status);
+
+-- очередь для распределённых воркеров (batch_worker.py)
+ALTER TABLE batch_runs
+    ADD COLUMN IF NOT EXISTS window_start timestamp,
+    ADD COLUMN IF NOT EXISTS window_end   timestamp,
+    ADD COLUMN IF NOT EXISTS n_trials     integer,
+    ADD COLUMN IF NOT EXISTS claimed_by   text,
+    ADD COLUMN IF NOT EXISTS heartbeat_at timestamptz;
+"""
+
 # НАСТРОЙКА ПАРАЛЛЕЛИЗМА
 # Вариант 1: Агрессивный (все ядра)
 # MAX_WORKERS = os.cpu_count()  # 12
@@ -45,11 +106,55 @@ MAX_WORKERS = os.cpu_count() - 2  # 10
 # Вариант 4: Ручная настройка
 # MAX_WORKERS = 8
 
-print(f"CPU cores: {os.cpu_count()}, MAX_WORKERS: {MAX_WORKERS}")
+# Свечи грузит родитель и кладёт в shared memory; воркеры получают view без копии.
+# False - каждый воркер сам загружает свечи своей группы из БД.
+USE_SHARED_MEMORY = True
+
+# Сколько групп (symbol, timeframe) одновременно держать в работе/очереди пула
+MAX_IN_FLIGHT_GROUPS = MAX_WORKERS * 2
+
+# Захват комбинации без heartbeat дольше этого срока считается брошенным (секунд)
+LEASE_SECONDS = 300
+
+# Период обновления heartbeat_at захваченных комбинаций (секунд)
+HEARTBEAT_SECONDS = 30
+
+
+class LeaseLostError(Exception):
+    """Захват комбинации перешёл к другому воркеру (истёк lease)"""
+
+
+def make_owner_id(suffix: str = "") -> str:
+    """Идентификатор владельца захватов batch_runs (claimed_by)"""
+    return f"{socket.gethostname()}:{os.getpid()}{suffix}"
+
+
+def check_lease(conn, run_id: int, owner: str):
+    """
+    Проверяет в транзакции conn, что комбинация всё ещё захвачена owner,
+    и блокирует строку до конца транзакции (перехват дождётся её окончания)
+
+    Raises:
+        LeaseLostError: захват перешёл к другому воркеру
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT 1
+            FROM batch_runs
+            WHERE id = %s AND claimed_by = %s AND status = 'running'
+            FOR UPDATE
+            """,
+            (run_id, owner),
+        )
+        if cur.fetchone() is None:
+            raise LeaseLostError(f"batch_runs id={run_id} перехвачена другим воркером")
 
 def setup_logger() -> logging.Logger:
-    """Настраивает логгер"""
+    """Настраивает логгер (повторный вызов возвращает уже настроенный)"""
     logger = logging.getLogger('batch_optimize')
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
 
     log_path = os.path.join(os.path.dirname(__file__), 'batch_optimize.log')
@@ -68,62 +173,504 @@ def setup_logger() -> logging.Logger:
 
 def get_symbols() -> list:
     """Получает список символов из БД"""
-    conn = psycopg2.connect(**DBCFG)
-
-    try:
+    with connection(DBCFG) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute("SELECT id, ticker FROM symbols ORDER BY id")
             rows = cur.fetchall()
             return rows
 
-    finally:
-        conn.close()
+def ensure_batch_runs_table():
+    """Создаёт таблицу batch_runs (состояние комбинаций батча), если её нет"""
+    with connection(DBCFG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(BATCH_RUNS_DDL)
+
+
+def ensure_optuna_storage():
+    """
+    Создаёт схему Optuna в БД до старта воркеров
+
+    Несколько процессов, одновременно открывающих пустое RDB-хранилище,
+    конкурируют за создание его таблиц; advisory lock сериализует это.
+    """
+    with connection(DBCFG) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(hashtext('optuna_storage_init'))")
+        try:
+            optuna.storages.RDBStorage(OPTUNA_STORAGE_URL)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(hashtext('optuna_storage_init'))")
+
+
+def make_study_name(batch_name: str, symbol_id: int, tf: str, code: str) -> str:
+    """Детерминированное имя study: по нему Optuna находит study после рестарта"""
+    return f"{batch_name}:{symbol_id}:{tf}:{code}"
+
 
-def run_single_optimization(symbol_id: int, ticker: str, tf: str, code: str) -> dict:
-    """Запускает одну оптимизацию"""
+def register_batch_combos(batch_name: str, tasks: list) -> int:
+    """
+    Регистрирует комбинации батча в batch_runs (уже существующие не трогает)
+
+    Returns:
+        Количество вновь добавленных комбинаций
+    """
+    rows = [
+        (batch_name, symbol_id, tf, code, make_study_name(batch_name, symbol_id, tf, code),
+         START_DATE, END_DATE, N_TRIALS)
+        for symbol_id, _ticker, tf, code in tasks
+    ]
+    with connection(DBCFG) as conn:
+        with conn.cursor() as cur:
+            inserted = execute_values(
+                cur,
+                """
+                INSERT INTO batch_runs (batch_name, symbol_id, timeframe_table, strategy_code, study_name,
+                                        window_start, window_end, n_trials)
+                VALUES %s
+                ON CONFLICT (batch_name, symbol_id, timeframe_table, strategy_code) DO NOTHING
+                RETURNING id
+                """,
+                rows,
+                fetch=True
+            )
+        return len(inserted)
+
+
+def load_unfinished_combos(batch_name: str) -> list:
+    """
+    Возвращает комбинации батча, которые ещё не завершены
+    (pending, failed и running — последние остались от прерванного запуска)
+
+    Комбинации, которые сейчас считает воркер (running с живым lease), пропускаются.
+    """
+    with connection(DBCFG) as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT br.id, br.symbol_id, s.ticker, br.timeframe_table, br.strategy_code,
+                       br.status, br.optimization_id, br.study_name
+                FROM batch_runs br
+                JOIN symbols s ON s.id = br.symbol_id
+                WHERE br.batch_name = %s AND br.status <> 'finished'
+                  AND NOT (br.status = 'running'
+                           AND br.claimed_by IS NOT NULL
+                           AND br.heartbeat_at >= now() - make_interval(secs => %s))
+                ORDER BY br.symbol_id, br.timeframe_table, br.strategy_code
+            """, (batch_name, LEASE_SECONDS))
+            return cur.fetchall()
+
+
+def update_batch_run(run_id: int, status: str, owner: Optional[str] = None, **fields) -> bool:
+    """
+    Обновляет статус комбинации в batch_runs (и доп. поля, если переданы)
+
+    С owner обновление проходит, только если комбинацию не держит другой владелец
+    с живым lease (running, свежий heartbeat_at); статус 'running' при этом
+    записывает claimed_by = owner, то есть это захват.
+
+    Returns:
+        True, если строка обновлена
+    """
+    sets = ["status = %s"]
+    values: list = [status]
+
+    if status == 'running':
+        sets.append("started_at = now()")
+        sets.append("heartbeat_at = now()")
+        sets.append("attempts = attempts + 1")
+        if owner is not None:
+            sets.append("claimed_by = %s")
+            values.append(owner)
+    elif status in ('finished', 'failed'):
+        sets.append("finished_at = now()")
+
+    for name, value in fields.items():
+        sets.append(f"{name} = %s")
+        values.append(value)
+
+    where = "id = %s"
+    values.append(run_id)
+    if owner is not None:
+        where += """
+            AND NOT (status = 'running'
+                     AND claimed_by IS DISTINCT FROM %s
+                     AND heartbeat_at >= now() - make_interval(secs => %s))"""
+        values.extend([owner, LEASE_SECONDS])
+
+    with connection(DBCFG) as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"UPDATE batch_runs SET {', '.join(sets)} WHERE {where}", values)
+            return cur.rowcount == 1
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Продлевает heartbeat_at всех комбинаций батча, захваченных owner
+
+    Локальный прогон держит захваты одним запросом из родительского процесса,
+    иначе batch_worker перехватил бы комбинации, которые считаются дольше LEASE_SECONDS.
+    """
+
+    def __init__(self, batch_name: str, owner: str):
+        super().__init__(daemon=True)
+        self.batch_name = batch_name
+        self.owner = owner
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(HEARTBEAT_SECONDS):
+            try:
+                with connection(DBCFG) as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            """
+                            UPDATE batch_runs
+                            SET heartbeat_at = now()
+                            WHERE batch_name = %s AND claimed_by = %s AND status = 'running'
+                            """,
+                            (self.batch_name, self.owner),
+                        )
+            except Exception as e:
+                logging.getLogger("batch_optimize").error(f"Не удалось продлить захваты batch_runs: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def run_single_optimization(
+    run_id: int,
+    symbol_id: int,
+    ticker: str,
+    tf: str,
+    code: str,
+    study_name: str,
+    optimization_id: Optional[int] = None,
+    data: Optional[pd.DataFrame] = None,
+    owner: Optional[str] = None
+) -> dict:
+    """
+    Запускает (или продолжает) одну оптимизацию и отмечает её состояние в batch_runs
+
+    Сессия optimization_sessions создаётся один раз и сохраняется в batch_runs,
+    поэтому при повторном запуске дубликатов сессий не появляется.
+    Если передан data, свечи не загружаются из БД.
+    С owner комбинация захватывается как у batch_worker: занятая воркером пропускается,
+    а лучший прогон пишется, только пока захват за owner.
+    """
     window = (START_DATE, END_DATE)
+    result = {'symbol_id': symbol_id, 'ticker': ticker, 'tf': tf, 'code': code}
 
     try:
+        if optimization_id is None:
+            optimization_id = create_optimization_session(
+                strategy_code=code,
+                symbol_id=symbol_id,
+                timeframe_table=tf,
+                window=window,
+                target_metric='Sharpe',
+                direction='maximize',
+                n_trials=N_TRIALS,
+                storage_url=OPTUNA_STORAGE_URL,
+                study_name=study_name
+            )
+
+        if not update_batch_run(run_id, 'running', owner=owner, optimization_id=optimization_id):
+            return {**result, 'success': False, 'skipped': True,
+                    'error': 'комбинацию считает batch_worker'}
+
         study = optimize_strategy(
             strategy_code=code,
             symbol_id=symbol_id,
             timeframe_table=tf,
             window=window,
             n_trials=N_TRIALS,
-            storage_url=None,
-            study_name=None
+            storage_url=OPTUNA_STORAGE_URL,
+            study_name=study_name,
+            optimization_id=optimization_id,
+            data=data,
+            best_run_guard=(lambda conn: check_lease(conn, run_id, owner)) if owner is not None else None
         )
 
+        update_batch_run(run_id, 'finished', owner=owner, best_value=study.best_value, error=None)
+
         return {
-            'symbol_id': symbol_id,
-            'ticker': ticker,
-            'tf': tf,
-            'code': code,
+            **result,
             'success': True,
             'best_value': study.best_value,
             'best_params': study.best_params
         }
 
     except Exception as e:
-        return {
+        try:
+            update_batch_run(run_id, 'failed', owner=owner, error=str(e))
+        except Exception:
+            pass
+
+        return {**result, 'success': False, 'error': str(e)}
+
+def fail_group(symbol_id: int, ticker: str, tf: str, combos: list, error: str,
+               owner: Optional[str] = None) -> list:
+    """Отмечает все комбинации группы как failed и возвращает их результаты"""
+    results = []
+    for c in combos:
+        try:
+            update_batch_run(c['id'], 'failed', owner=owner, error=error)
+        except Exception:
+            pass
+        results.append({
             'symbol_id': symbol_id,
             'ticker': ticker,
             'tf': tf,
-            'code': code,
+            'code': c['strategy_code'],
             'success': False,
-            'error': str(e)
-        }
+            'error': error
+        })
+    return results
+
+
+def init_worker(strategy_codes: List[str], lot_snapshot: Optional[LotHistorySnapshot] = None):
+    """
+    Инициализатор процесса пула: прогрев до первой задачи
+
+    Тяжёлые модули (optuna, pandas, backtesting, psycopg2) уже импортированы
+    вместе с этим файлом; здесь один раз загружаются конфигурации и классы
+    стратегий, чтобы trial-ы не обращались за ними к БД. Снимок lot_history
+    приходит от родителя, воркер не читает таблицу сам. Время прогрева
+    пишется в лог для отслеживания регрессий.
+    """
+    logger = setup_logger()
+
+    if lot_snapshot is not None:
+        install_lot_snapshot(lot_snapshot)
+
+    t0 = time.perf_counter()
+    try:
+        # весь каталог одним запросом; дальше get_strategy_config - обращение к кэшу
+        load_all_strategy_configs(DBCFG)
+    except Exception as e:
+        logger.warning(f"Worker {os.getpid()}: strategy catalog not preloaded: {e}")
+
+    configs = []
+    for code in strategy_codes:
+        try:
+            configs.append(get_strategy_config(code, DBCFG))
+        except Exception as e:
+            # комбинации этой стратегии упадут с той же ошибкой и попадут в batch_runs
+            logger.warning(f"Worker {os.getpid()}: strategy config {code} not loaded: {e}")
+    t1 = time.perf_counter()
+
+    for cfg in configs:
+        try:
+            load_strategy_class(cfg)
+        except Exception as e:
+            logger.warning(f"Worker {os.getpid()}: strategy class {cfg.py_module}.{cfg.py_class} not loaded: {e}")
+    t2 = time.perf_counter()
+
+    if os.getpid() == _IMPORT_PID:
+        imports = f"{_IMPORT_SECONDS:.2f}s"
+    else:
+        imports = "inherited (fork)"
+
+    logger.info(
+        f"Worker {os.getpid()} ready: imports {imports}, "
+        f"strategy configs {t1 - t0:.2f}s, strategy classes {t2 - t1:.2f}s"
+    )
+
+
+def make_executor(lot_snapshot: Optional[LotHistorySnapshot] = None) -> ProcessPoolExecutor:
+    """Пул воркеров с прогревом; один пул обслуживает все батчи запуска"""
+    return ProcessPoolExecutor(
+        max_workers=MAX_WORKERS,
+        initializer=init_worker,
+        initargs=(STRATEGY_CODES, lot_snapshot)
+    )
+
+
+def run_group_optimization(
+    symbol_id: int,
+    ticker: str,
+    tf: str,
+    combos: list,
+    handle: Optional[ArenaHandle] = None,
+    owner: Optional[str] = None
+) -> list:
+    """
+    Прогоняет все стратегии одной пары (symbol, timeframe) в одном воркере
+
+    Свечи берутся из shared memory родителя (handle) или, если handle не передан,
+    загружаются из БД один раз на группу. Общие индикаторы (SMA/ATR/...) считаются
+    один раз и переиспользуются всеми стратегиями группы; после группы кэш
+    индикаторов очищается, чтобы память воркера не росла.
+
+    Returns:
+        Список результатов run_single_optimization по каждой стратегии
+    """
+    window = (START_DATE, END_DATE)
+
+    try:
+        if handle is not None:
+            data = attach(handle)
+        else:
+            data = load_ohlcv_from_db(
+                symbol_id=symbol_id,
+                timeframe_table=tf,
+                start=window[0],
+                end=window[1],
+                db_cfg=DBCFG
+            )
+    except Exception as e:
+        return fail_group(symbol_id, ticker, tf, combos, str(e), owner=owner)
+
+    try:
+        return [
+            run_single_optimization(
+                c['id'], symbol_id, ticker, tf, c['strategy_code'],
+                c['study_name'], c['optimization_id'], data=data, owner=owner
+            )
+            for c in combos
+        ]
+
+    finally:
+        clear_indicator_cache((symbol_id, tf, window[0], window[1]))
+        if handle is not None:
+            del data
+            detach(handle)
+
+
+def group_combos(combos: list) -> "OrderedDict[tuple, list]":
+    """Группирует комбинации по (symbol_id, ticker, timeframe_table)"""
+    groups: "OrderedDict[tuple, list]" = OrderedDict()
+    for c in combos:
+        groups.setdefault((c['symbol_id'], c['ticker'], c['timeframe_table']), []).append(c)
+    return groups
+
+
+def run_batch(batch_name: str, executor: ProcessPoolExecutor, logger: logging.Logger):
+    """
+    Прогоняет незавершённые комбинации одного батча на готовом пуле воркеров
+
+    Группы (symbol, timeframe) подаются окном по MAX_IN_FLIGHT_GROUPS.
+    Комбинации захватываются в batch_runs от имени этого процесса (claimed_by),
+    а LeaseKeeper продлевает захваты, пока батч идёт: параллельные batch_worker
+    их не перехватывают.
+    """
+    owner = make_owner_id("/local")
+    combos = load_unfinished_combos(batch_name)
+    if not combos:
+        logger.info(f"Batch '{batch_name}': nothing to do, all combinations are finished.")
+        return
+
+    # Одна задача = все стратегии одной пары (symbol, timeframe):
+    # свечи и общие индикаторы загружаются/считаются в воркере один раз
+    groups = group_combos(combos)
+    logger.info(f"Batch '{batch_name}': unfinished combinations {len(combos)}, task groups (symbol, timeframe): {len(groups)}")
+
+    completed = 0
+    total = len(combos)
+
+    def log_results(ticker: str, tf: str, results: list):
+        nonlocal completed
+        for result in results:
+            completed += 1
+            code = result['code']
+            if result.get('skipped'):
+                logger.info(f"[{completed}/{total}] {ticker} | {tf} | {code} → skipped: {result['error']}")
+            elif result['success']:
+                logger.info(
+                    f"[{completed}/{total}] {ticker} | {tf} | {code} → "
+                    f"best_value={result['best_value']:.4f}, "
+                    f"best_params={result['best_params']}"
+                )
+            else:
+                logger.error(f"[{completed}/{total}] {ticker} | {tf} | {code} → ERROR: {result['error']}")
+
+    pending_groups = iter(groups.items())
+    window = (START_DATE, END_DATE)
+
+    keeper = LeaseKeeper(batch_name, owner)
+    keeper.start()
+
+    # Группы подаются окном по MAX_IN_FLIGHT_GROUPS: в shared memory лежат
+    # только свечи групп, которые сейчас считаются или ждут свободного воркера
+    try:
+        with OhlcvArena() as arena:
+            futures = {}
+
+            def submit_next() -> bool:
+                for (symbol_id, ticker, tf), group in pending_groups:
+                    handle = None
+                    if USE_SHARED_MEMORY:
+                        try:
+                            data = load_ohlcv_from_db(
+                                symbol_id=symbol_id,
+                                timeframe_table=tf,
+                                start=window[0],
+                                end=window[1],
+                                db_cfg=DBCFG
+                            )
+                            handle = arena.put((symbol_id, tf), data)
+                            del data
+                        except Exception as e:
+                            log_results(ticker, tf, fail_group(symbol_id, ticker, tf, group, str(e), owner=owner))
+                            continue
+
+                    future = executor.submit(run_group_optimization, symbol_id, ticker, tf, group, handle, owner)
+                    futures[future] = (symbol_id, ticker, tf, group)
+                    return True
+                return False
+
+            while len(futures) < MAX_IN_FLIGHT_GROUPS and submit_next():
+                pass
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    symbol_id, ticker, tf, group = futures.pop(future)
+                    arena.release((symbol_id, tf))
+
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        # группа не вернула результатов (упал воркер или пул): без failed её строки
+                        # остались бы running, и LeaseKeeper продлевал бы их до конца батча
+                        codes = [c['strategy_code'] for c in group]
+                        logger.exception(f"{ticker} | {tf} | {codes} → EXCEPTION: {e}")
+                        log_results(ticker, tf, fail_group(symbol_id, ticker, tf, group, str(e), owner=owner))
+                        continue
+
+                    log_results(ticker, tf, results)
+
+                while len(futures) < MAX_IN_FLIGHT_GROUPS and submit_next():
+                    pass
+    finally:
+        keeper.stop()
+
+    logger.info(f"Batch '{batch_name}' optimization finished.")
+
 
 def main():
-    """Основная функция батчевой оптимизации"""
+    """
+    Основная функция батчевой оптимизации
+
+    Использование: python batch_optimize.py [batch_name ...] [--enqueue-only]
+    Повторный запуск с тем же batch_name продолжает прерванный батч.
+    Несколько batch_name обрабатываются по очереди одним пулом воркеров
+    (процессы и их прогрев переиспользуются между батчами).
+    --enqueue-only только регистрирует комбинации в batch_runs: их разбирают
+    воркеры batch_worker.py (на одной или нескольких машинах).
+    """
     logger = setup_logger()
+    batch_names = [a for a in sys.argv[1:] if not a.startswith('--')] or [BATCH_NAME]
+    enqueue_only = '--enqueue-only' in sys.argv[1:]
 
     symbols = get_symbols()
     if not symbols:
         logger.error("No symbols found")
         return
 
-    logger.info(f"Batch optimization from {START_DATE.date()} to {END_DATE.date()}")
+    logger.info(f"Batches: {batch_names}, from {START_DATE.date()} to {END_DATE.date()}")
     logger.info(f"Strategies: {STRATEGY_CODES}")
     logger.info(f"Timeframes: {TIMEFRAMES}")
     logger.info(f"Trials per combo: {N_TRIALS}")
@@ -135,32 +682,24 @@ def main():
             for code in STRATEGY_CODES:
                 tasks.append((sym['id'], sym['ticker'], tf, code))
 
-    logger.info(f"Total combinations: {len(tasks)}")
+    ensure_batch_runs_table()
+    ensure_optuna_storage()
 
-    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {
-            executor.submit(run_single_optimization, symbol_id, ticker, tf, code): (symbol_id, ticker, tf, code)
-            for symbol_id, ticker, tf, code in tasks
-        }
+    for batch_name in batch_names:
+        added = register_batch_combos(batch_name, tasks)
+        logger.info(f"Batch '{batch_name}': total combinations {len(tasks)} (new: {added})")
 
-        completed = 0
-        total = len(futures)
+    if enqueue_only:
+        logger.info(f"Batches {batch_names} enqueued; start batch_worker.py <batch_name> on worker nodes.")
+        return
 
-        for future in as_completed(futures):
-            symbol_id, ticker, tf, code = futures[future]
-            completed += 1
-            try:
-                result = future.result()
-                if result['success']:
-                    logger.info(
-                        f"[{completed}/{total}] {ticker} | {tf} | {code} → "
-                        f"best_value={result['best_value']:.4f}, "
-                        f"best_params={result['best_params']}"
-                    )
-                else:
-                    logger.error(f"[{completed}/{total}] {ticker} | {tf} | {code} → ERROR: {result['error']}")
-            except Exception as e:
-                logger.exception(f"[{completed}/{total}] {ticker} | {tf} | {code} → EXCEPTION: {e}")
+    # lot_history читается один раз здесь и передаётся воркерам снимком
+    lot_snapshot = get_lot_cache().snapshot()
+    logger.info(f"Lot history snapshot: {lot_snapshot.version.row_count} rows")
+
+    with make_executor(lot_snapshot) as executor:
+        for batch_name in batch_names:
+            run_batch(batch_name, executor, logger)
 
     logger.info("Batch optimization finished.")
 
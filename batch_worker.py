@@ -0,0 +1,376 @@
+"""
+batch_worker.py - Воркер распределённой батч-оптимизации
+
+Разбирает комбинации батча из таблицы batch_runs (очередь в PostgreSQL).
+Любое количество воркеров на любых машинах может указывать на одну stock_db:
+комбинация захватывается через SELECT ... FOR UPDATE SKIP LOCKED, воркер
+обновляет heartbeat_at, пока считает её, а захваты без heartbeat дольше
+LEASE_SECONDS переходят другим воркерам. Optuna-study хранится в той же БД,
+поэтому перехваченная комбинация продолжается с места остановки.
+
+Использование:
+    python batch_optimize.py [batch_name] --enqueue-only    # поставить батч в очередь
+    python batch_worker.py [batch_name] [--processes N] [--exit-when-done]
+
+--processes N запускает N воркеров на этой машине (удобно для локальной
+проверки: несколько процессов против одной БД).
+"""
+import argparse
+import logging
+import multiprocessing as mp
+import sys
+import threading
+import time
+from typing import Optional
+
+from psycopg2.extras import RealDictCursor
+
+from batch_optimize import (
+    BATCH_NAME, START_DATE, END_DATE, N_TRIALS, OPTUNA_STORAGE_URL,
+    HEARTBEAT_SECONDS, LEASE_SECONDS, LeaseLostError,
+    check_lease, ensure_batch_runs_table, ensure_optuna_storage, make_owner_id,
+)
+from strategy_optimizer import optimize_strategy, create_optimization_session, DBCFG
+from db_pool import CONNECTION_ERRORS, connect as db_connect, recover_connection
+from backtest_runner import load_ohlcv_from_db
+from utils_indicators import clear_indicator_cache
+from utils_lot import LotHistorySnapshot, get_lot_cache, install_lot_snapshot
+
+# Пауза, когда в очереди нет свободных комбинаций (секунд)
+POLL_INTERVAL_SECONDS = 10
+
+# Комбинации со статусом failed перезапускаются, пока attempts < MAX_ATTEMPTS
+MAX_ATTEMPTS = 3
+
+# --- Логирование ---
+
+logger = logging.getLogger("batch_worker")
+logger.setLevel(logging.INFO)
+
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter(
+    fmt="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+# --- Очередь batch_runs ---
+
+def claim_next_combo(
+    conn,
+    batch_name: str,
+    worker_id: str,
+    prefer: Optional[tuple] = None
+) -> Optional[dict]:
+    """
+    Захватывает следующую комбинацию батча
+
+    Берутся pending, failed (attempts < MAX_ATTEMPTS) и running с истёкшим lease.
+    Комбинации той же пары (symbol_id, timeframe_table), что и prefer, идут первыми:
+    воркер продолжает работать на уже загруженных свечах.
+
+    В prev_status возвращается статус до захвата ('running' - перехват у воркера
+    с истёкшим lease).
+    """
+    prefer_symbol, prefer_tf = prefer if prefer else (None, None)
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            """
+            WITH picked AS (
+                SELECT id, status AS prev_status
+                FROM batch_runs
+                WHERE batch_name = %s
+                  AND (
+                        status = 'pending'
+                     OR (status = 'failed' AND attempts < %s)
+                     OR (status = 'running'
+                         AND (heartbeat_at IS NULL
+                              OR heartbeat_at < now() - make_interval(secs => %s)))
+                  )
+                ORDER BY (symbol_id = %s AND timeframe_table = %s) IS TRUE DESC,
+                         symbol_id, timeframe_table, strategy_code
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE batch_runs br
+            SET status = 'running',
+                claimed_by = %s,
+                heartbeat_at = now(),
+                started_at = now(),
+                attempts = br.attempts + 1
+            FROM picked
+            WHERE br.id = picked.id
+            RETURNING br.id, br.symbol_id, br.timeframe_table, br.strategy_code,
+                      br.optimization_id, br.study_name, br.attempts,
+                      br.window_start, br.window_end, br.n_trials, picked.prev_status
+            """,
+            (batch_name, MAX_ATTEMPTS, LEASE_SECONDS, prefer_symbol, prefer_tf, worker_id),
+        )
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def count_unfinished(conn, batch_name: str) -> int:
+    """Сколько комбинаций батча ещё может быть выполнено"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*)
+            FROM batch_runs
+            WHERE batch_name = %s
+              AND (status IN ('pending', 'running') OR (status = 'failed' AND attempts < %s))
+            """,
+            (batch_name, MAX_ATTEMPTS),
+        )
+        (cnt,) = cur.fetchone()
+    conn.commit()
+    return int(cnt)
+
+
+def heartbeat(conn, run_id: int, worker_id: str) -> bool:
+    """Продлевает lease; False - комбинацию уже перехватил другой воркер"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE batch_runs
+            SET heartbeat_at = now()
+            WHERE id = %s AND claimed_by = %s AND status = 'running'
+            """,
+            (run_id, worker_id),
+        )
+        ok = cur.rowcount == 1
+    conn.commit()
+    return ok
+
+
+def should_fail_stale_trials(combo: dict) -> bool:
+    """
+    Можно ли пометить FAIL RUNNING trial-ы study захваченной комбинации
+
+    Только при повторной попытке, когда прежний владелец точно не считает:
+    его lease истёк (перехват running) или он сам записал failed.
+    При первой попытке RUNNING trial-ов другого процесса быть не может.
+    """
+    return combo['attempts'] > 1 and combo.get('prev_status') in ('running', 'failed')
+
+
+def finish_combo(conn, run_id: int, worker_id: str, status: str,
+                 best_value: Optional[float] = None, error: Optional[str] = None):
+    """Записывает результат комбинации (только если захват всё ещё наш)"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE batch_runs
+            SET status = %s,
+                best_value = COALESCE(%s, best_value),
+                error = %s,
+                finished_at = now(),
+                heartbeat_at = now()
+            WHERE id = %s AND claimed_by = %s
+            """,
+            (status, best_value, error, run_id, worker_id),
+        )
+    conn.commit()
+
+
+class HeartbeatThread(threading.Thread):
+    """Фоновое продление lease захваченной комбинации (своё соединение с БД)"""
+
+    def __init__(self, run_id: int, worker_id: str):
+        super().__init__(daemon=True)
+        self.run_id = run_id
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        conn = db_connect(DBCFG, application_name='batch_worker')
+        try:
+            while not self._stop_event.wait(HEARTBEAT_SECONDS):
+                try:
+                    if not heartbeat(conn, self.run_id, self.worker_id):
+                        self.lost = True
+                        return
+                except Exception as e:
+                    logger.error(f"Не удалось обновить heartbeat batch_runs id={self.run_id}: {e}")
+                    try:
+                        conn = recover_connection(conn, attempts=1)
+                    except CONNECTION_ERRORS:
+                        pass  # следующая попытка - через HEARTBEAT_SECONDS
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+# --- Выполнение комбинаций ---
+
+def run_claimed_combo(conn, combo: dict, worker_id: str, data) -> Optional[float]:
+    """Оптимизирует захваченную комбинацию, держа lease живым"""
+    run_id = combo['id']
+    window = (combo['window_start'] or START_DATE, combo['window_end'] or END_DATE)
+    n_trials = combo['n_trials'] or N_TRIALS
+
+    optimization_id = combo['optimization_id']
+    if optimization_id is None:
+        optimization_id = create_optimization_session(
+            strategy_code=combo['strategy_code'],
+            symbol_id=combo['symbol_id'],
+            timeframe_table=combo['timeframe_table'],
+            window=window,
+            target_metric='Sharpe',
+            direction='maximize',
+            n_trials=n_trials,
+            storage_url=OPTUNA_STORAGE_URL,
+            study_name=combo['study_name']
+        )
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE batch_runs SET optimization_id = %s WHERE id = %s",
+                (optimization_id, run_id),
+            )
+        conn.commit()
+
+    hb = HeartbeatThread(run_id, worker_id)
+    hb.start()
+
+    def abort_if_lost(study, trial):
+        if hb.lost:
+            raise LeaseLostError(f"batch_runs id={run_id} перехвачена другим воркером")
+
+    try:
+        study = optimize_strategy(
+            strategy_code=combo['strategy_code'],
+            symbol_id=combo['symbol_id'],
+            timeframe_table=combo['timeframe_table'],
+            window=window,
+            n_trials=n_trials,
+            storage_url=OPTUNA_STORAGE_URL,
+            study_name=combo['study_name'],
+            optimization_id=optimization_id,
+            data=data,
+            callbacks=[abort_if_lost],
+            fail_stale=should_fail_stale_trials(combo),
+            # лучший прогон пишется, только если захват всё ещё наш (проверка в той же транзакции)
+            best_run_guard=lambda db_conn: check_lease(db_conn, run_id, worker_id)
+        )
+    finally:
+        hb.stop()
+
+    if hb.lost:
+        raise LeaseLostError(f"batch_runs id={run_id} перехвачена другим воркером")
+
+    finish_combo(conn, run_id, worker_id, 'finished', best_value=study.best_value)
+    return study.best_value
+
+
+def worker_loop(batch_name: str, exit_when_done: bool = False,
+                lot_snapshot: Optional[LotHistorySnapshot] = None):
+    """
+    Основной цикл воркера: захват → оптимизация → запись результата
+
+    lot_snapshot - снимок lot_history от родительского процесса (None - загрузить из БД).
+    """
+    worker_id = make_owner_id()
+    if lot_snapshot is not None:
+        install_lot_snapshot(lot_snapshot)
+    conn = db_connect(DBCFG, application_name='batch_worker')
+    ensure_optuna_storage()
+    logger.info(f"Старт batch_worker {worker_id}, batch '{batch_name}'")
+
+    # свечи последней пары (symbol_id, timeframe_table, window) держим в памяти
+    data_key = None
+    data = None
+
+    try:
+        while True:
+            combo = claim_next_combo(conn, batch_name, worker_id, prefer=data_key[:2] if data_key else None)
+
+            if combo is None:
+                if exit_when_done and count_unfinished(conn, batch_name) == 0:
+                    logger.info("Очередь батча пуста, воркер завершается")
+                    return
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+
+            label = f"{combo['symbol_id']} | {combo['timeframe_table']} | {combo['strategy_code']}"
+            logger.info(f"Захвачена комбинация id={combo['id']}: {label} (попытка {combo['attempts']})")
+
+            key = (combo['symbol_id'], combo['timeframe_table'],
+                   combo['window_start'] or START_DATE, combo['window_end'] or END_DATE)
+
+            try:
+                if key != data_key:
+                    if data_key is not None:
+                        clear_indicator_cache(data_key)
+                    data = None
+                    data = load_ohlcv_from_db(
+                        symbol_id=key[0],
+                        timeframe_table=key[1],
+                        start=key[2],
+                        end=key[3],
+                        db_cfg=DBCFG
+                    )
+                    data_key = key
+
+                best_value = run_claimed_combo(conn, combo, worker_id, data)
+                logger.info(f"Комбинация id={combo['id']} {label} → best_value={best_value:.4f}")
+
+            except LeaseLostError as e:
+                conn = recover_connection(conn)
+                logger.warning(str(e))
+
+            except Exception as e:
+                conn = recover_connection(conn)
+                logger.exception(f"Ошибка комбинации id={combo['id']} {label}: {e}")
+                try:
+                    finish_combo(conn, combo['id'], worker_id, 'failed', error=str(e))
+                except Exception:
+                    conn = recover_connection(conn)
+                    logger.exception("Не удалось записать статус failed в batch_runs")
+
+    finally:
+        conn.close()
+        logger.info(f"batch_worker {worker_id} остановлен")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер распределённой батч-оптимизации")
+    parser.add_argument('batch_name', nargs='?', default=BATCH_NAME)
+    parser.add_argument('--processes', type=int, default=1,
+                        help="сколько воркеров запустить на этой машине")
+    parser.add_argument('--exit-when-done', action='store_true',
+                        help="завершиться, когда в батче не осталось невыполненных комбинаций")
+    args = parser.parse_args()
+
+    ensure_batch_runs_table()
+
+    if args.processes <= 1:
+        worker_loop(args.batch_name, args.exit_when_done)
+        return
+
+    # lot_history читается один раз и передаётся процессам снимком
+    lot_snapshot = get_lot_cache().snapshot()
+
+    procs = [
+        mp.Process(target=worker_loop, args=(args.batch_name, args.exit_when_done, lot_snapshot),
+                   name=f"batch_worker-{i}")
+        for i in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.info("Остановка batch_worker по Ctrl+C")
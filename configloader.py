@@ -1,11 +1,12 @@
 """
 configloader.py - Конфигурация подключения к БД и загрузка стратегий
 """
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from dataclasses import dataclass
 import json
-import psycopg2
+import time
 from psycopg2.extras import RealDictCursor
+from db_pool import connection
 
 DBCFG: Dict[str, Any] = {
     'host': 'localhost',
@@ -36,98 +37,188 @@ class StrategyConfig:
     py_class: str
     params: List[ParamConfig]
 
-def load_strategy_config(strategy_code: str, dbcfg: Dict[str, Any] = DBCFG) -> StrategyConfig:
-    """Загружает конфигурацию стратегии из БД PostgreSQL"""
-    conn = psycopg2.connect(**dbcfg)
+# Кэш конфигураций стратегий в пределах процесса: {code: (время загрузки time.monotonic, StrategyConfig)}
+_STRATEGY_CONFIG_CACHE: Dict[str, Tuple[float, StrategyConfig]] = {}
+
+# Срок жизни записи кэша (секунд); None - без срока, только явная инвалидация
+STRATEGY_CONFIG_TTL_SECONDS: Optional[float] = 300
+
+_STRATEGY_CONFIGS_SQL = """
+    SELECT c.id, c.code, c.name, c.py_module, c.py_class,
+           p.name AS param_name, p.param_type, p.min_value, p.max_value,
+           p.step_value, p.category_values, p.description
+    FROM strategy_catalog c
+    LEFT JOIN strategy_params p ON p.strategy_id = c.id
+    {where}
+    ORDER BY c.code, p.name
+"""
 
-    try:
+
+def _parse_param(p: Dict[str, Any]) -> ParamConfig:
+    """ParamConfig из строки strategy_params"""
+    # Парсим category_values для categorical/bool параметров
+    choices = None
+    if p['category_values']:
+        try:
+            if isinstance(p['category_values'], str):
+                choices = json.loads(p['category_values'])
+            else:
+                choices = p['category_values']
+
+            # Для bool параметров конвертируем в Python bool
+            if p['param_type'] == 'bool':
+                choices = [bool(int(x)) for x in choices]
+        except (json.JSONDecodeError, ValueError):
+            # Если не JSON, разделяем по запятой
+            choices = [x.strip() for x in p['category_values'].split(',')]
+
+    # Определяем log_scale (по умолчанию False)
+    log_scale = False
+    if p['description'] and 'log' in p['description'].lower():
+        log_scale = True
+
+    # Конвертируем min/max/step в числа (если они есть)
+    min_val = None
+    max_val = None
+    step = None
+
+    if p['min_value']:
+        try:
+            min_val = float(p['min_value'])
+        except (ValueError, TypeError):
+            pass
+
+    if p['max_value']:
+        try:
+            max_val = float(p['max_value'])
+        except (ValueError, TypeError):
+            pass
+
+    if p['step_value']:
+        try:
+            step = float(p['step_value'])
+        except (ValueError, TypeError):
+            pass
+
+    return ParamConfig(
+        name=p['param_name'],
+        type=p['param_type'],
+        min_val=min_val,
+        max_val=max_val,
+        step=step,
+        choices=choices,
+        log_scale=log_scale
+    )
+
+
+def fetch_strategy_configs(
+    strategy_codes: Optional[List[str]] = None,
+    dbcfg: Dict[str, Any] = DBCFG
+) -> Dict[str, StrategyConfig]:
+    """
+    Загружает конфигурации стратегий из БД одним запросом (strategy_catalog + strategy_params)
+
+    Args:
+        strategy_codes: коды стратегий (None - все стратегии каталога)
+        dbcfg: конфигурация подключения к БД
+
+    Returns:
+        Словарь {code: StrategyConfig}; отсутствующих в каталоге кодов в нём нет
+    """
+    if strategy_codes is None:
+        sql, params = _STRATEGY_CONFIGS_SQL.format(where=""), ()
+    else:
+        sql, params = _STRATEGY_CONFIGS_SQL.format(where="WHERE c.code = ANY(%s)"), (list(strategy_codes),)
+
+    with connection(dbcfg) as conn:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                SELECT id, code, name, py_module, py_class
-                FROM strategy_catalog
-                WHERE code = %s
-            """, (strategy_code,))
-
-            row = cur.fetchone()
-            if not row:
-                raise ValueError(f"Strategy '{strategy_code}' not found in database")
-
-            strategy_id = row['id']
-
-            cur.execute("""
-                SELECT name, param_type, min_value, max_value, step_value, category_values, description
-                FROM strategy_params
-                WHERE strategy_id = %s
-                ORDER BY name
-            """, (strategy_id,))
-
-            params_rows = cur.fetchall()
-
-            params = []
-            for p in params_rows:
-                # Парсим category_values для categorical/bool параметров
-                choices = None
-                if p['category_values']:
-                    try:
-                        if isinstance(p['category_values'], str):
-                            choices = json.loads(p['category_values'])
-                        else:
-                            choices = p['category_values']
-
-                        # Для bool параметров конвертируем в Python bool
-                        if p['param_type'] == 'bool':
-                            choices = [bool(int(x)) for x in choices]
-                    except (json.JSONDecodeError, ValueError):
-                        # Если не JSON, разделяем по запятой
-                        choices = [x.strip() for x in p['category_values'].split(',')]
-
-                # Определяем log_scale (по умолчанию False)
-                log_scale = False
-                if p['description'] and 'log' in p['description'].lower():
-                    log_scale = True
-
-                # Конвертируем min/max/step в числа (если они есть)
-                min_val = None
-                max_val = None
-                step = None
-
-                if p['min_value']:
-                    try:
-                        min_val = float(p['min_value'])
-                    except (ValueError, TypeError):
-                        pass
-
-                if p['max_value']:
-                    try:
-                        max_val = float(p['max_value'])
-                    except (ValueError, TypeError):
-                        pass
-
-                if p['step_value']:
-                    try:
-                        step = float(p['step_value'])
-                    except (ValueError, TypeError):
-                        pass
-
-                param = ParamConfig(
-                    name=p['name'],
-                    type=p['param_type'],
-                    min_val=min_val,
-                    max_val=max_val,
-                    step=step,
-                    choices=choices,
-                    log_scale=log_scale
-                )
-                params.append(param)
-
-            return StrategyConfig(
-                id=strategy_id,
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+
+    configs: Dict[str, StrategyConfig] = {}
+    for row in rows:
+        cfg = configs.get(row['code'])
+        if cfg is None:
+            cfg = StrategyConfig(
+                id=row['id'],
                 code=row['code'],
                 name=row['name'],
                 py_module=row['py_module'],
                 py_class=row['py_class'],
-                params=params
+                params=[]
             )
+            configs[row['code']] = cfg
+        if row['param_name'] is not None:
+            cfg.params.append(_parse_param(row))
+    return configs
+
 
-    finally:
-        conn.close()
+def load_strategy_config(strategy_code: str, dbcfg: Dict[str, Any] = DBCFG) -> StrategyConfig:
+    """Загружает конфигурацию стратегии из БД PostgreSQL (без кэша)"""
+    cfg = fetch_strategy_configs([strategy_code], dbcfg).get(strategy_code)
+    if cfg is None:
+        raise ValueError(f"Strategy '{strategy_code}' not found in database")
+    return cfg
+
+
+def load_all_strategy_configs(dbcfg: Dict[str, Any] = DBCFG) -> Dict[str, StrategyConfig]:
+    """
+    Загружает все стратегии каталога одним запросом и заменяет ими кэш процесса
+
+    Returns:
+        Словарь {code: StrategyConfig}
+    """
+    configs = fetch_strategy_configs(None, dbcfg)
+    loaded_at = time.monotonic()
+    _STRATEGY_CONFIG_CACHE.clear()
+    _STRATEGY_CONFIG_CACHE.update((code, (loaded_at, cfg)) for code, cfg in configs.items())
+    return configs
+
+
+def _cached_strategy_config(strategy_code: str) -> Optional[StrategyConfig]:
+    item = _STRATEGY_CONFIG_CACHE.get(strategy_code)
+    if item is None:
+        return None
+    loaded_at, cfg = item
+    if STRATEGY_CONFIG_TTL_SECONDS is not None and time.monotonic() - loaded_at > STRATEGY_CONFIG_TTL_SECONDS:
+        return None
+    return cfg
+
+
+def get_strategy_config(strategy_code: str, dbcfg: Dict[str, Any] = DBCFG) -> StrategyConfig:
+    """Конфигурация стратегии из кэша процесса (при промахе или истёкшем TTL - из БД)"""
+    cfg = _cached_strategy_config(strategy_code)
+    if cfg is None:
+        cfg = load_strategy_config(strategy_code, dbcfg)
+        _STRATEGY_CONFIG_CACHE[strategy_code] = (time.monotonic(), cfg)
+    return cfg
+
+
+def preload_strategy_configs(strategy_codes: List[str], dbcfg: Dict[str, Any] = DBCFG) -> Dict[str, StrategyConfig]:
+    """
+    Заранее загружает конфигурации стратегий в кэш процесса
+
+    Отсутствующие в кэше (или устаревшие) коды читаются из БД одним запросом.
+
+    Returns:
+        Словарь {code: StrategyConfig}
+    """
+    missing = [code for code in strategy_codes if _cached_strategy_config(code) is None]
+    if missing:
+        loaded_at = time.monotonic()
+        for code, cfg in fetch_strategy_configs(missing, dbcfg).items():
+            _STRATEGY_CONFIG_CACHE[code] = (loaded_at, cfg)
+    return {code: get_strategy_config(code, dbcfg) for code in strategy_codes}
+
+
+def invalidate_strategy_configs(strategy_code: Optional[str] = None):
+    """
+    Сбрасывает кэш конфигураций стратегий
+
+    Args:
+        strategy_code: если задан - сбрасывается только эта стратегия
+    """
+    if strategy_code is None:
+        _STRATEGY_CONFIG_CACHE.clear()
+    else:
+        _STRATEGY_CONFIG_CACHE.pop(strategy_code, None)
@@ -0,0 +1,156 @@
+"""
+db_async.py - Асинхронный доступ к PostgreSQL (asyncpg) для asyncio-варианта демонов
+
+    - пул asyncpg на event loop, с TCP keepalive сервера и подключением с backoff
+      (те же параметры, что у db_pool);
+    - служебные записи демонов (heartbeat в service_status, ошибки в live_errors)
+      короткими запросами из пула: они не ждут основной обработки и друг друга.
+
+Использование:
+    pool = await create_pool(application_name='async_runner')
+    await update_service_heartbeat(pool, 'fake_broker')
+    await pool.close()
+
+asyncpg не обязателен для остального кода: без него модуль импортируется,
+а create_pool сообщает, что пакет нужно установить (pip install asyncpg).
+"""
+from typing import Any, Dict, Optional
+import asyncio
+import json
+import logging
+import os
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg нужен только asyncio-варианту демонов
+    asyncpg = None
+
+from db_pool import CONNECT_ATTEMPTS, KEEPALIVE_OPTIONS, backoff_delays
+
+logger = logging.getLogger("db_async")
+
+# Размер пула asyncpg на процесс
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = int(os.environ.get('PG_ASYNC_POOL_MAX_CONN', 8))
+
+# Таймаут служебных запросов (heartbeat, log_error), секунд
+COMMAND_TIMEOUT_SECONDS = 30
+
+
+def _default_cfg() -> Dict[str, Any]:
+    from configloader import DBCFG
+    return DBCFG
+
+
+def _server_settings(application_name: Optional[str]) -> Dict[str, str]:
+    # asyncpg не передаёт keepalive-параметры libpq: задаём их серверу как настройки сессии
+    settings = {
+        'tcp_keepalives_idle': str(KEEPALIVE_OPTIONS['keepalives_idle']),
+        'tcp_keepalives_interval': str(KEEPALIVE_OPTIONS['keepalives_interval']),
+        'tcp_keepalives_count': str(KEEPALIVE_OPTIONS['keepalives_count']),
+    }
+    if application_name:
+        settings['application_name'] = application_name
+    return settings
+
+
+async def create_pool(
+    cfg: Optional[Dict[str, Any]] = None,
+    application_name: Optional[str] = None,
+    min_size: int = POOL_MIN_SIZE,
+    max_size: int = POOL_MAX_SIZE,
+    attempts: Optional[int] = CONNECT_ATTEMPTS
+):
+    """
+    Пул asyncpg с повтором подключения (backoff)
+
+    Args:
+        cfg: конфигурация подключения (None - configloader.DBCFG)
+        application_name: имя в pg_stat_activity
+        attempts: число попыток подключения (None - пока не получится)
+
+    Returns:
+        asyncpg.Pool
+    """
+    if asyncpg is None:
+        raise RuntimeError("Для asyncio-варианта демонов нужен asyncpg: pip install asyncpg")
+
+    cfg = cfg if cfg is not None else _default_cfg()
+    delays = backoff_delays(attempts)
+    while True:
+        try:
+            return await asyncpg.create_pool(
+                host=cfg.get('host'),
+                port=cfg.get('port'),
+                database=cfg.get('database') or cfg.get('dbname'),
+                user=cfg.get('user'),
+                password=cfg.get('password'),
+                min_size=min_size,
+                max_size=max_size,
+                command_timeout=COMMAND_TIMEOUT_SECONDS,
+                server_settings=_server_settings(application_name),
+            )
+        except (OSError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            logger.warning(f"Нет подключения к PostgreSQL ({str(e).strip()}), повтор через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+
+
+async def log_error(
+    pool,
+    source: str,
+    message: str,
+    severity: str = "error",
+    strategy_universe_id: Optional[int] = None,
+    symbol: Optional[str] = None,
+    timeframe: Optional[str] = None,
+    details: Optional[Dict[str, Any]] = None,
+):
+    """Запись ошибки/события в live_errors; сбой записи только логируется"""
+    try:
+        await pool.execute(
+            """
+            INSERT INTO live_errors (
+                timestamp, source, severity,
+                strategy_universe_id, symbol, timeframe,
+                message, details_json
+            )
+            VALUES (now(), $1, $2, $3, $4, $5, $6, $7::jsonb)
+            """,
+            source,
+            severity,
+            strategy_universe_id,
+            symbol,
+            timeframe,
+            message,
+            json.dumps(details, ensure_ascii=False, default=str) if details is not None else None,
+        )
+    except Exception as e:
+        logger.error(f"Не удалось записать ошибку в live_errors: {e}")
+
+
+async def update_service_heartbeat(
+    pool,
+    service_name: str,
+    status: str = "ok",
+    details: Optional[Dict[str, Any]] = None,
+):
+    """Heartbeat сервиса в service_status; сбой записи только логируется"""
+    try:
+        await pool.execute(
+            """
+            INSERT INTO service_status (service_name, last_heartbeat, status, details_json)
+            VALUES ($1, now(), $2, $3::jsonb)
+            ON CONFLICT (service_name)
+            DO UPDATE SET last_heartbeat = EXCLUDED.last_heartbeat,
+                          status = EXCLUDED.status,
+                          details_json = COALESCE(EXCLUDED.details_json, service_status.details_json)
+            """,
+            service_name,
+            status,
+            json.dumps(details, ensure_ascii=False, default=str) if details is not None else None,
+        )
+    except Exception as e:
+        logger.error(f"Не удалось обновить heartbeat {service_name}: {e}")
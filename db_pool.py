@@ -0,0 +1,324 @@
+"""
+db_pool.py - Общий доступ к PostgreSQL
+
+    - пул соединений на процесс (psycopg2 ThreadedConnectionPool), отдельный
+      пул на каждую конфигурацию подключения;
+    - TCP keepalive, чтобы долгоживущие соединения демонов не обрывались молча;
+    - подключение и переподключение с экспоненциальной задержкой (backoff);
+    - подготовленные запросы (PREPARE/EXECUTE) для горячих запросов.
+
+Короткие операции (сохранение прогона, загрузка свечей, конфигурации):
+    with connection() as conn:
+        ...            # commit при выходе, rollback при исключении
+
+Демоны держат одно выделенное соединение:
+    conn = connect(application_name='execution_engine')
+    ...
+    except Exception:
+        conn = recover_connection(conn)   # rollback или переподключение
+
+После fork (ProcessPoolExecutor, multiprocessing) дочерний процесс заводит
+свои пулы: унаследованные сокеты родителя не используются и не закрываются.
+"""
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set
+import logging
+import os
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+logger = logging.getLogger("db_pool")
+
+# TCP keepalive (секунды): обрыв сети обнаруживается за ~idle + interval * count
+KEEPALIVE_OPTIONS: Dict[str, int] = {
+    'keepalives': 1,
+    'keepalives_idle': int(os.environ.get('PG_KEEPALIVES_IDLE', 30)),
+    'keepalives_interval': int(os.environ.get('PG_KEEPALIVES_INTERVAL', 10)),
+    'keepalives_count': int(os.environ.get('PG_KEEPALIVES_COUNT', 5)),
+}
+
+# Размер пула на процесс и конфигурацию
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = int(os.environ.get('PG_POOL_MAX_CONN', 8))
+
+# Подключение: число попыток и экспоненциальная задержка между ними (секунды)
+CONNECT_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+# Соединение из пула, простоявшее дольше этого срока, проверяется SELECT 1 (секунд)
+PING_AFTER_IDLE_SECONDS = 60
+
+# Ошибки, после которых соединение считается потерянным
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Соединение psycopg2, которое помнит свои параметры и подготовленные запросы"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # имена запросов, для которых в этой сессии уже выполнен PREPARE
+        self.prepared: Set[str] = set()
+        # параметры подключения (для переподключения)
+        self.connect_kwargs: Dict[str, Any] = {}
+        # время возврата в пул (time.monotonic)
+        self.released_at: float = time.monotonic()
+
+
+# --- Параметры подключения ---
+
+def _default_cfg() -> Dict[str, Any]:
+    # импорт здесь: configloader сам пользуется этим модулем
+    from configloader import DBCFG
+    return DBCFG
+
+
+def connect_kwargs(cfg: Optional[Dict[str, Any]] = None, application_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Параметры psycopg2.connect: конфигурация БД + keepalive
+
+    Args:
+        cfg: конфигурация подключения (None - configloader.DBCFG); ключи keepalive
+             в cfg переопределяют KEEPALIVE_OPTIONS
+        application_name: имя в pg_stat_activity
+
+    Returns:
+        dict для psycopg2.connect
+    """
+    kwargs: Dict[str, Any] = dict(KEEPALIVE_OPTIONS)
+    kwargs.update(cfg if cfg is not None else _default_cfg())
+    if application_name:
+        kwargs['application_name'] = application_name
+    kwargs['connection_factory'] = PooledConnection
+    return kwargs
+
+
+def backoff_delays(attempts: Optional[int] = CONNECT_ATTEMPTS) -> Iterator[float]:
+    """Задержки перед повторными попытками: 0.5, 1, 2, ... до BACKOFF_MAX_SECONDS (None - бесконечно)"""
+    delay = BACKOFF_BASE_SECONDS
+    n = 1
+    while attempts is None or n < attempts:
+        yield delay
+        delay = min(delay * 2, BACKOFF_MAX_SECONDS)
+        n += 1
+
+
+def _connect_with_backoff(kwargs: Dict[str, Any], attempts: Optional[int]) -> PooledConnection:
+    delays = backoff_delays(attempts)
+    while True:
+        try:
+            conn = psycopg2.connect(**kwargs)
+            conn.connect_kwargs = kwargs
+            return conn
+        except psycopg2.OperationalError as e:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            logger.warning(f"Нет подключения к PostgreSQL ({str(e).strip()}), повтор через {delay:.1f} сек")
+            time.sleep(delay)
+
+
+def connect(
+    cfg: Optional[Dict[str, Any]] = None,
+    application_name: Optional[str] = None,
+    attempts: Optional[int] = CONNECT_ATTEMPTS
+) -> PooledConnection:
+    """
+    Отдельное (не из пула) соединение с keepalive и повтором подключения
+
+    Args:
+        cfg: конфигурация подключения (None - configloader.DBCFG)
+        application_name: имя в pg_stat_activity
+        attempts: число попыток подключения (None - пока не получится)
+
+    Returns:
+        соединение psycopg2 (autocommit выключен)
+    """
+    return _connect_with_backoff(connect_kwargs(cfg, application_name), attempts)
+
+
+def recover_connection(conn, attempts: Optional[int] = None) -> PooledConnection:
+    """
+    Приводит соединение демона в рабочее состояние после ошибки
+
+    Живое соединение откатывается (rollback) и возвращается как есть;
+    потерянное закрывается и открывается заново с теми же параметрами
+    (с backoff, по умолчанию - пока не получится).
+
+    Returns:
+        рабочее соединение (то же или новое, autocommit выключен)
+    """
+    if not conn.closed:
+        try:
+            conn.rollback()
+            return conn
+        except CONNECTION_ERRORS:
+            pass
+
+    logger.warning("Соединение с PostgreSQL потеряно, переподключение")
+    kwargs = getattr(conn, 'connect_kwargs', None) or connect_kwargs()
+    try:
+        conn.close()
+    except Exception:
+        pass
+    return _connect_with_backoff(kwargs, attempts)
+
+
+# --- Пул соединений процесса ---
+
+class _BackoffPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool, открывающий соединения с повтором (backoff)"""
+
+    def _connect(self, key=None):
+        conn = _connect_with_backoff(self._kwargs, CONNECT_ATTEMPTS)
+        if key is not None:
+            self._used[key] = conn
+            self._rused[id(conn)] = key
+        else:
+            self._pool.append(conn)
+        return conn
+
+
+_pools: Dict[tuple, _BackoffPool] = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+
+# Пулы, унаследованные от родителя при fork: держим ссылки, чтобы сборщик мусора
+# не закрыл сокеты родителя (закрытие отправило бы серверу Terminate за него)
+_inherited_pools: List[_BackoffPool] = []
+
+
+def _pool_key(cfg: Dict[str, Any]) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in cfg.items()))
+
+
+def get_pool(cfg: Optional[Dict[str, Any]] = None) -> ThreadedConnectionPool:
+    """Пул соединений этого процесса для конфигурации cfg (создаётся при первом обращении)"""
+    global _pools_pid
+    cfg = cfg if cfg is not None else _default_cfg()
+
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _inherited_pools.extend(_pools.values())
+            _pools.clear()
+            _pools_pid = os.getpid()
+
+        key = _pool_key(cfg)
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _BackoffPool(POOL_MIN_CONN, POOL_MAX_CONN, **connect_kwargs(cfg))
+            _pools[key] = pool
+        return pool
+
+
+def _is_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - conn.released_at < PING_AFTER_IDLE_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except CONNECTION_ERRORS:
+        return False
+
+
+@contextmanager
+def connection(cfg: Optional[Dict[str, Any]] = None) -> Iterator[PooledConnection]:
+    """
+    Соединение из пула процесса на время блока with
+
+    commit при нормальном выходе, rollback при исключении; потерянное
+    соединение в пул не возвращается (закрывается).
+
+    Args:
+        cfg: конфигурация подключения (None - configloader.DBCFG)
+    """
+    pool = get_pool(cfg)
+    conn = pool.getconn()
+    while not _is_alive(conn):
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except CONNECTION_ERRORS:
+        broken = True
+        raise
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        conn.released_at = time.monotonic()
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def close_pools():
+    """Закрывает пулы этого процесса (при завершении)"""
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            return
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+# --- Подготовленные запросы ---
+
+# Зарегистрированные запросы: {имя: SQL с плейсхолдерами $1, $2, ...}
+PREPARED_STATEMENTS: Dict[str, str] = {}
+
+_PLACEHOLDER = re.compile(r'%s')
+
+
+def register_statement(name: str, sql: str) -> str:
+    """
+    Регистрирует горячий запрос для PREPARE
+
+    Args:
+        name: имя подготовленного запроса (идентификатор SQL)
+        sql: текст запроса с плейсхолдерами %s (как для cursor.execute)
+
+    Returns:
+        name
+    """
+    counter = iter(range(1, 10_000))
+    PREPARED_STATEMENTS[name] = _PLACEHOLDER.sub(lambda m: f"${next(counter)}", sql)
+    return name
+
+
+def execute_prepared(cur, name: str, params: Sequence[Any] = ()):
+    """
+    Выполняет зарегистрированный запрос через EXECUTE
+
+    PREPARE выполняется один раз на сессию соединения. Подготовленный запрос
+    не откатывается rollback-ом, поэтому набор conn.prepared остаётся верным
+    и после ошибок транзакции.
+    """
+    conn = cur.connection
+    prepared = getattr(conn, 'prepared', None)
+    if prepared is None:
+        # соединение не из db_pool: без учёта PREPARE, обычный запрос
+        sql = re.sub(r'\$\d+', '%s', PREPARED_STATEMENTS[name])
+        cur.execute(sql, params)
+        return
+
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
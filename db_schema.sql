@@ -35,6 +35,22 @@ $$;
 
 ALTER FUNCTION public.set_timestamp_strategy_universe() OWNER TO postgres;
 
+--
+-- Name: set_timestamp_lot_history(); Type: FUNCTION; Schema: public; Owner: postgres
+--
+
+CREATE FUNCTION public.set_timestamp_lot_history() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$;
+
+
+ALTER FUNCTION public.set_timestamp_lot_history() OWNER TO postgres;
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
@@ -170,7 +186,8 @@ CREATE TABLE public.candles_15m (
     close double precision NOT NULL,
     volume bigint NOT NULL,
     is_gap boolean DEFAULT false NOT NULL,
-    gap_dir text
+    gap_dir text,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -204,7 +221,8 @@ CREATE TABLE public.candles_1d (
     close double precision NOT NULL,
     volume bigint NOT NULL,
     is_gap boolean DEFAULT false NOT NULL,
-    gap_dir text
+    gap_dir text,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -238,7 +256,8 @@ CREATE TABLE public.candles_1h (
     close double precision NOT NULL,
     volume bigint NOT NULL,
     is_gap boolean DEFAULT false NOT NULL,
-    gap_dir text
+    gap_dir text,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -270,7 +289,8 @@ CREATE TABLE public.candles_1m (
     high double precision NOT NULL,
     low double precision NOT NULL,
     close double precision NOT NULL,
-    volume bigint NOT NULL
+    volume bigint NOT NULL,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -304,7 +324,8 @@ CREATE TABLE public.candles_30m (
     close double precision NOT NULL,
     volume bigint NOT NULL,
     is_gap boolean DEFAULT false NOT NULL,
-    gap_dir text
+    gap_dir text,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -338,7 +359,8 @@ CREATE TABLE public.candles_4h (
     close double precision NOT NULL,
     volume bigint NOT NULL,
     is_gap boolean DEFAULT false NOT NULL,
-    gap_dir text
+    gap_dir text,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -372,7 +394,8 @@ CREATE TABLE public.candles_5m (
     close double precision NOT NULL,
     volume bigint NOT NULL,
     is_gap boolean DEFAULT false NOT NULL,
-    gap_dir text
+    gap_dir text,
+    ingested_at timestamp with time zone DEFAULT clock_timestamp()
 );
 
 
@@ -391,6 +414,66 @@ CREATE TABLE public.datafeed_state (
 
 ALTER TABLE public.datafeed_state OWNER TO postgres;
 
+--
+-- Name: last_prices; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.last_prices (
+    symbol_id integer NOT NULL,
+    ticker text NOT NULL,
+    price double precision NOT NULL,
+    bar_timestamp timestamp without time zone NOT NULL,
+    open double precision,
+    high double precision,
+    low double precision,
+    volume bigint,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.last_prices OWNER TO postgres;
+
+--
+-- Name: latency_trace; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.latency_trace (
+    id bigint NOT NULL,
+    stage text NOT NULL,
+    metric text NOT NULL,
+    samples integer NOT NULL,
+    min_ms double precision NOT NULL,
+    max_ms double precision NOT NULL,
+    sum_ms double precision NOT NULL,
+    buckets integer[] NOT NULL,
+    items bigint,
+    recorded_at timestamp with time zone DEFAULT clock_timestamp() NOT NULL
+);
+
+
+ALTER TABLE public.latency_trace OWNER TO postgres;
+
+--
+-- Name: latency_trace_id_seq; Type: SEQUENCE; Schema: public; Owner: postgres
+--
+
+CREATE SEQUENCE public.latency_trace_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER SEQUENCE public.latency_trace_id_seq OWNER TO postgres;
+
+--
+-- Name: latency_trace_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: postgres
+--
+
+ALTER SEQUENCE public.latency_trace_id_seq OWNED BY public.latency_trace.id;
+
+
 --
 -- Name: live_errors; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -619,7 +702,8 @@ CREATE TABLE public.lot_history (
     symbol_id integer NOT NULL,
     lot_size integer NOT NULL,
     change_date timestamp without time zone NOT NULL,
-    comment character varying(255) DEFAULT ''::character varying
+    comment character varying(255) DEFAULT ''::character varying,
+    updated_at timestamp with time zone DEFAULT clock_timestamp() NOT NULL
 );
 
 
@@ -852,6 +936,22 @@ ALTER SEQUENCE public.strategy_universe_id_seq OWNER TO postgres;
 ALTER SEQUENCE public.strategy_universe_id_seq OWNED BY public.strategy_universe.id;
 
 
+--
+-- Name: symbol_blocks; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.symbol_blocks (
+    symbol_id integer NOT NULL,
+    ticker text NOT NULL,
+    reason text NOT NULL,
+    details_json jsonb,
+    blocked_at timestamp with time zone DEFAULT now() NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.symbol_blocks OWNER TO postgres;
+
 --
 -- Name: symbols; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -930,6 +1030,13 @@ ALTER TABLE ONLY public.backtest_runs ALTER COLUMN id SET DEFAULT nextval('publi
 ALTER TABLE ONLY public.bar_state ALTER COLUMN id SET DEFAULT nextval('public.bar_state_id_seq'::regclass);
 
 
+--
+-- Name: latency_trace id; Type: DEFAULT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.latency_trace ALTER COLUMN id SET DEFAULT nextval('public.latency_trace_id_seq'::regclass);
+
+
 --
 -- Name: live_errors id; Type: DEFAULT; Schema: public; Owner: postgres
 --
@@ -1047,6 +1154,22 @@ ALTER TABLE ONLY public.datafeed_state
     ADD CONSTRAINT datafeed_state_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: last_prices last_prices_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.last_prices
+    ADD CONSTRAINT last_prices_pkey PRIMARY KEY (symbol_id);
+
+
+--
+-- Name: latency_trace latency_trace_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.latency_trace
+    ADD CONSTRAINT latency_trace_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: live_errors live_errors_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -1151,6 +1274,14 @@ ALTER TABLE ONLY public.strategy_universe
     ADD CONSTRAINT strategy_universe_uq_symbol_tf_strat UNIQUE (symbol, timeframe, strategy_id);
 
 
+--
+-- Name: symbol_blocks symbol_blocks_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.symbol_blocks
+    ADD CONSTRAINT symbol_blocks_pkey PRIMARY KEY (symbol_id);
+
+
 --
 -- Name: symbols symbols_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -1203,6 +1334,13 @@ CREATE INDEX idx_candles_1d_is_gap ON public.candles_1d USING btree (symbol_id,
 CREATE INDEX idx_candles_1h_is_gap ON public.candles_1h USING btree (symbol_id, is_gap, "timestamp");
 
 
+--
+-- Name: idx_candles_1m_symbol_time; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX idx_candles_1m_symbol_time ON public.candles_1m USING btree (symbol_id, "timestamp");
+
+
 --
 -- Name: idx_candles_30m_is_gap; Type: INDEX; Schema: public; Owner: postgres
 --
@@ -1224,6 +1362,20 @@ CREATE INDEX idx_candles_4h_is_gap ON public.candles_4h USING btree (symbol_id,
 CREATE INDEX idx_candles_5m_is_gap ON public.candles_5m USING btree (symbol_id, is_gap, "timestamp");
 
 
+--
+-- Name: idx_last_prices_ticker; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE UNIQUE INDEX idx_last_prices_ticker ON public.last_prices USING btree (ticker);
+
+
+--
+-- Name: idx_latency_trace_time; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX idx_latency_trace_time ON public.latency_trace USING btree (recorded_at);
+
+
 --
 -- Name: idx_live_errors_source_time; Type: INDEX; Schema: public; Owner: postgres
 --
@@ -1252,6 +1404,13 @@ CREATE INDEX idx_live_errors_time ON public.live_errors USING btree ("timestamp"
 CREATE INDEX idx_live_orders_status ON public.live_orders USING btree (status, created_at);
 
 
+--
+-- Name: idx_live_orders_pending; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX idx_live_orders_pending ON public.live_orders USING btree (strategy_universe_id, symbol) INCLUDE (live_signal_id, quantity, price) WHERE (status = ANY (ARRAY['NEW'::text, 'WORKING'::text, 'PARTIALLY_FILLED'::text]));
+
+
 --
 -- Name: idx_live_orders_symbol_time; Type: INDEX; Schema: public; Owner: postgres
 --
@@ -1308,6 +1467,13 @@ CREATE INDEX idx_live_trades_symbol_time ON public.live_trades USING btree (symb
 CREATE INDEX idx_strategy ON public.strategy_params USING btree (strategy_id);
 
 
+--
+-- Name: idx_symbol_blocks_ticker; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE UNIQUE INDEX idx_symbol_blocks_ticker ON public.symbol_blocks USING btree (ticker);
+
+
 --
 -- Name: ticker; Type: INDEX; Schema: public; Owner: postgres
 --
@@ -1322,6 +1488,13 @@ CREATE UNIQUE INDEX ticker ON public.symbols USING btree (ticker);
 CREATE UNIQUE INDEX uk_symbol_date ON public.lot_history USING btree (symbol_id, change_date);
 
 
+--
+-- Name: lot_history trg_set_timestamp_lot_history; Type: TRIGGER; Schema: public; Owner: postgres
+--
+
+CREATE TRIGGER trg_set_timestamp_lot_history BEFORE UPDATE ON public.lot_history FOR EACH ROW EXECUTE FUNCTION public.set_timestamp_lot_history();
+
+
 --
 -- Name: strategy_universe trg_set_timestamp_strategy_universe; Type: TRIGGER; Schema: public; Owner: postgres
 --
@@ -1329,6 +1502,14 @@ CREATE UNIQUE INDEX uk_symbol_date ON public.lot_history USING btree (symbol_id,
 CREATE TRIGGER trg_set_timestamp_strategy_universe BEFORE UPDATE ON public.strategy_universe FOR EACH ROW EXECUTE FUNCTION public.set_timestamp_strategy_universe();
 
 
+--
+-- Name: last_prices last_prices_symbol_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.last_prices
+    ADD CONSTRAINT last_prices_symbol_id_fkey FOREIGN KEY (symbol_id) REFERENCES public.symbols(id) ON DELETE CASCADE;
+
+
 --
 -- Name: live_errors live_errors_strategy_universe_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -1385,6 +1566,14 @@ ALTER TABLE ONLY public.live_trades
     ADD CONSTRAINT live_trades_strategy_universe_id_fkey FOREIGN KEY (strategy_universe_id) REFERENCES public.strategy_universe(id) ON DELETE CASCADE;
 
 
+--
+-- Name: symbol_blocks symbol_blocks_symbol_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.symbol_blocks
+    ADD CONSTRAINT symbol_blocks_symbol_id_fkey FOREIGN KEY (symbol_id) REFERENCES public.symbols(id) ON DELETE CASCADE;
+
+
 --
 -- PostgreSQL database dump complete
 --
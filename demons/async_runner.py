@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+async_runner.py
+
+Назначение:
+    asyncio-вариант основных циклов демонов datafeed_aggregator, strategy_runner,
+    execution_engine и fake_broker: все (или выбранные) демоны в одном event loop.
+
+Цели:
+    - Долгий запрос одного демона (большая пачка минуток, снимок риска на тысячи
+      сигналов) не должен останавливать его heartbeat, опрос и запись ошибок,
+      а также работу остальных демонов.
+
+Устройство (гибрид):
+    - Служебные запросы идут через пул asyncpg (db_async) и выполняются параллельно:
+      heartbeat каждого демона - отдельная задача по таймеру, проверка «есть ли работа» -
+      лёгкий запрос перед итерацией, log_error - отдельная задача, которую цикл не ждёт.
+    - Сама обработка - те же run_once демонов на psycopg2: каждый демон держит своё
+      соединение и выполняет итерацию в потоке (asyncio.to_thread). Логика демонов
+      не дублируется, а итерации разных демонов идут одновременно.
+    - Пока итерация идёт дольше STALL_SECONDS, heartbeat пишет status='busy'
+      с её длительностью: health_monitor видит живой, но занятый сервис, а итерацию
+      дольше таймаута сервиса считает зависшей (<service>_down), как и пропавший heartbeat.
+
+Ключевые допущения:
+    - Нужен пакет asyncpg (pip install asyncpg); обычные демоны работают без него.
+    - Запускается вместо отдельных процессов выбранных демонов, не вместе с ними.
+
+Запуск:
+    python demons/async_runner.py
+    python demons/async_runner.py --daemons execution_engine fake_broker
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Set
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+import db_async
+from db_pool import connect as db_connect, recover_connection
+from utils_lot import LotSizeCache
+
+import datafeed_aggregator
+import execution_engine
+import fake_broker
+import strategy_runner
+
+# live-стратегии импортируют demons.strategy_runner: отдаём им уже загруженный модуль, а не вторую копию
+sys.modules.setdefault("demons.strategy_runner", strategy_runner)
+
+# Интервал heartbeat каждого демона (секунд)
+HEARTBEAT_INTERVAL_SECONDS = 10
+
+# Итерация дольше этого срока отмечается в heartbeat как status='busy' (секунд)
+STALL_SECONDS = 30
+
+# Пауза после ошибки итерации (секунд)
+ERROR_PAUSE_SECONDS = 5
+
+# --- Логирование ---
+
+logger = logging.getLogger("async_runner")
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter(
+    fmt="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Незавершённые фоновые записи (log_error): ссылки, чтобы задачи не собрал сборщик мусора
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Запускает корутину фоном, не дожидаясь её"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# --- Демоны ---
+
+
+class AsyncDaemon:
+    """
+    Основной цикл демона в event loop
+
+    Подклассы задают service_name (service_status), error_source (live_errors),
+    poll_interval и синхронные setup/run_once/on_error (выполняются в потоке
+    с psycopg2-соединением демона), а при желании - has_work (запрос через пул asyncpg).
+    """
+
+    service_name = ""
+    error_source = ""
+    poll_interval = 2.0
+
+    def __init__(self):
+        self.conn = None
+        self.busy_since: Optional[float] = None
+
+    # --- синхронная часть (поток) ---
+
+    def setup(self, conn):
+        pass
+
+    def run_once(self, conn):
+        raise NotImplementedError
+
+    def on_error(self, conn):
+        pass
+
+    def _iteration(self):
+        self.run_once(self.conn)
+        self.conn.commit()
+
+    def _recover(self):
+        self.conn = recover_connection(self.conn)
+        try:
+            self.on_error(self.conn)
+        except Exception as e:
+            self.conn = recover_connection(self.conn)
+            logger.error(f"{self.service_name}: не удалось восстановить состояние: {e}")
+
+    # --- асинхронная часть ---
+
+    async def has_work(self, pool) -> bool:
+        return True
+
+    async def heartbeat_loop(self, pool, stop: asyncio.Event):
+        while not stop.is_set():
+            busy_for = time.monotonic() - self.busy_since if self.busy_since is not None else 0.0
+            if busy_for >= STALL_SECONDS:
+                await db_async.update_service_heartbeat(
+                    pool, self.service_name, status="busy",
+                    details={"iteration_seconds": round(busy_for, 1)},
+                )
+            else:
+                await db_async.update_service_heartbeat(pool, self.service_name)
+            await wait_or_stop(stop, HEARTBEAT_INTERVAL_SECONDS)
+
+    async def run(self, pool, stop: asyncio.Event):
+        self.conn = await asyncio.to_thread(db_connect, application_name=self.service_name)
+        self.conn.autocommit = False
+        heartbeat = asyncio.create_task(self.heartbeat_loop(pool, stop))
+        logger.info(f"Старт {self.service_name}")
+
+        try:
+            ready = False
+            while not stop.is_set():
+                try:
+                    if not ready:
+                        await asyncio.to_thread(self.setup, self.conn)
+                        ready = True
+                    if await self.has_work(pool):
+                        self.busy_since = time.monotonic()
+                        await asyncio.to_thread(self._iteration)
+                except Exception as e:
+                    logger.exception(f"Ошибка в основном цикле {self.service_name}: {e}")
+                    spawn(db_async.log_error(
+                        pool,
+                        source=self.error_source,
+                        message=f"Ошибка в основном цикле {self.service_name}",
+                        severity="error",
+                        details={"error": str(e)},
+                    ))
+                    await asyncio.to_thread(self._recover)
+                    await wait_or_stop(stop, ERROR_PAUSE_SECONDS)
+                finally:
+                    self.busy_since = None
+
+                await wait_or_stop(stop, self.poll_interval)
+        finally:
+            heartbeat.cancel()
+            await asyncio.to_thread(self.conn.close)
+            logger.info(f"{self.service_name} остановлен")
+
+
+class DatafeedDaemon(AsyncDaemon):
+    service_name = "data_feed"
+    error_source = "data_feed"
+    poll_interval = datafeed_aggregator.POLL_INTERVAL_SECONDS
+
+    def __init__(self):
+        super().__init__()
+        self.gap_threshold = datafeed_aggregator.DEFAULT_GAP_THRESHOLD
+        self.last_1m_ts = None
+
+    def setup(self, conn):
+        self.gap_threshold = datafeed_aggregator.get_gap_threshold(conn)
+        self.last_1m_ts = datafeed_aggregator.load_last_state(conn)
+        if self.last_1m_ts is None:
+            self.last_1m_ts = datafeed_aggregator.init_last_1m_timestamp(conn)
+            datafeed_aggregator.save_last_1m_timestamp(conn, self.last_1m_ts)
+        conn.commit()
+
+    async def has_work(self, pool) -> bool:
+        return await pool.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM candles_1m WHERE timestamp > $1)",
+            self.last_1m_ts,
+        )
+
+    def run_once(self, conn):
+        self.last_1m_ts, _ = datafeed_aggregator.run_once(conn, self.last_1m_ts, self.gap_threshold)
+
+
+class StrategyRunnerDaemon(AsyncDaemon):
+    service_name = "strategy_runner"
+    error_source = "strategy_runner"
+    poll_interval = strategy_runner.POLL_INTERVAL_SECONDS
+
+    def run_once(self, conn):
+        strategy_runner.run_once(conn)
+
+
+class ExecutionEngineDaemon(AsyncDaemon):
+    service_name = "execution_engine"
+    error_source = "execution"
+    poll_interval = execution_engine.POLL_INTERVAL_SECONDS
+
+    def __init__(self):
+        super().__init__()
+        self.lot_cache: Optional[LotSizeCache] = None
+        self.lot_checked_at = 0.0
+
+    def setup(self, conn):
+        self.lot_cache = LotSizeCache(conn=conn)
+        conn.commit()
+        self.lot_checked_at = time.monotonic()
+
+    async def has_work(self, pool) -> bool:
+        return await pool.fetchval("SELECT EXISTS (SELECT 1 FROM live_signals WHERE processed = false)")
+
+    def run_once(self, conn):
+        if time.monotonic() - self.lot_checked_at >= execution_engine.LOT_REFRESH_SECONDS:
+            self.lot_checked_at = time.monotonic()
+            if self.lot_cache.refresh(conn):
+                logger.info(f"lot_history обновлена: {self.lot_cache.version.row_count} строк")
+        execution_engine.run_once(conn, self.lot_cache, self.service_name)
+
+
+class FakeBrokerDaemon(AsyncDaemon):
+    service_name = "fake_broker"
+    error_source = "broker"
+    poll_interval = fake_broker.POLL_INTERVAL_SECONDS
+
+    def __init__(self):
+        super().__init__()
+        self.ledger = fake_broker.Ledger()
+        self.book = fake_broker.OrderBook()
+
+    def setup(self, conn):
+        self.book = fake_broker.OrderBook(LotSizeCache(conn=conn))
+        self.ledger.load(conn)
+        self.book.load(conn)
+        conn.commit()
+
+    def run_once(self, conn):
+        # переоценка позиций нужна каждый цикл, поэтому без has_work
+        fake_broker.run_once(conn, self.ledger, self.book)
+
+    def on_error(self, conn):
+        # память могла уйти вперёд незаписанной пачки - перечитываем из БД
+        self.setup(conn)
+
+
+DAEMONS: Dict[str, type] = {
+    "datafeed_aggregator": DatafeedDaemon,
+    "strategy_runner": StrategyRunnerDaemon,
+    "execution_engine": ExecutionEngineDaemon,
+    "fake_broker": FakeBrokerDaemon,
+}
+
+
+async def wait_or_stop(stop: asyncio.Event, timeout: float):
+    """Пауза до timeout секунд, прерываемая остановкой"""
+    try:
+        await asyncio.wait_for(stop.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def run_daemons(names: List[str], stop: Optional[asyncio.Event] = None):
+    stop = stop or asyncio.Event()
+    pool = await db_async.create_pool(application_name="async_runner")
+    try:
+        await asyncio.gather(*(DAEMONS[name]().run(pool, stop) for name in names))
+    finally:
+        if _background_tasks:
+            await asyncio.gather(*_background_tasks, return_exceptions=True)
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio-вариант основных циклов демонов")
+    parser.add_argument("--daemons", nargs="+", choices=sorted(DAEMONS), default=list(DAEMONS),
+                        help="какие демоны запустить (по умолчанию все)")
+    args = parser.parse_args()
+    asyncio.run(run_daemons(args.daemons))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.info("Остановка async_runner по Ctrl+C")
@@ -24,9 +24,14 @@ datafeed_aggregator.py
   * находить позиции по инструменту в live_positions;
   * если LONG и gap DOWN, либо SHORT и gap UP, ставить gap_mode = true.
 
+- Поддерживать last_prices — close последней минутки по каждому инструменту
+  (fake_broker и проверки берут цену оттуда, а не из candles_1m).
+
 - Вести состояние:
   * datafeed_state.last_1m_timestamp — последний обработанный timestamp из candles_1m (в MSK).
   * service_status(service_name='data_feed') — heartbeat и статус сервиса.
+  * latency_trace(stage='data_feed') — длительность пачки и задержка от появления
+    минутки в candles_1m (ingested_at) до записи агрегатов (их ingested_at).
 
 - Логировать ошибки в stdout/файл и в таблицу live_errors (source='data_feed').
 
@@ -41,7 +46,7 @@ datafeed_aggregator.py
 - Таблица live_positions содержит хотя бы:
   (id, symbol, direction, gap_mode, updated_at, ...).
 
-- Таблицы datafeed_state, service_status, live_errors уже созданы миграцией.
+- Таблицы datafeed_state, last_prices, service_status, live_errors уже созданы миграцией.
 
 Архитектура:
 
@@ -51,28 +56,26 @@ datafeed_aggregator.py
   3. При закрытии бара:
      - пишет бар в candles_xx с is_gap/gap_dir;
      - при is_gap=true вызывает обновление live_positions.gap_mode (если гэп против позиции).
-  4. Обновляет datafeed_state и heartbeat в service_status.
+  4. Обновляет last_prices, datafeed_state и heartbeat в service_status.
   5. Спит заданный интервал и повторяет.
 - Любые ошибки ловятся, пишутся в live_errors и лог, цикл не падает насмерть.
 """
 
 import logging
+import os
 import sys
 import time
 from datetime import datetime, timedelta
 
-import psycopg2
-from psycopg2.extras import DictCursor, Json
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
 
-# --- Конфиг подключения к PostgreSQL ---
+from psycopg2.extras import DictCursor, Json
 
-PG_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 5432,
-    "dbname": "stock_db",
-    "user": "postgres",
-    "password": "123",
-}
+from db_pool import connect as db_connect, recover_connection
+from utils_latency import LatencyRecorder
+from utils_prices import update_last_prices_from_candles
 
 # --- Конфиг таймфреймов ---
 
@@ -118,6 +121,7 @@ class AggregatedBar:
         "low",
         "close",
         "volume",
+        "ingested_at",
     )
 
     def __init__(self, symbol_id, start_ts, end_ts, open_, high_, low_, close_, volume_):
@@ -129,6 +133,7 @@ class AggregatedBar:
         self.low = low_
         self.close = close_
         self.volume = volume_
+        self.ingested_at = None  # время записи в candles_xx (после закрытия)
 
     def update_with_minute(self, open_, high_, low_, close_, volume_):
         if self.open is None:
@@ -152,16 +157,6 @@ last_closed_close = {
 # --- Работа с БД ---
 
 
-def get_connection():
-    return psycopg2.connect(
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        dbname=PG_CONFIG["dbname"],
-        user=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-    )
-
-
 def log_error(
     conn,
     message,
@@ -230,7 +225,8 @@ def load_last_state(conn):
         cur.execute("SELECT last_1m_timestamp FROM datafeed_state WHERE id = 1")
         row = cur.fetchone()
         if row and row["last_1m_timestamp"] is not None:
-            last_1m_ts = row["last_1m_timestamp"]  # naive MSK
+            # колонка timestamptz: приводим к naive (время сессии), как timestamp в candles_1m
+            last_1m_ts = row["last_1m_timestamp"].replace(tzinfo=None)  # naive MSK
 
         # последние close по каждому TF и symbol_id
         for tf_name, cfg in TIMEFRAMES.items():
@@ -296,6 +292,9 @@ def process_closed_bar(conn, tf_name, cfg, bar: AggregatedBar, gap_threshold):
     - вычисление гэпа;
     - запись в таблицу candles_xx;
     - при необходимости обновление live_positions.gap_mode.
+
+    Returns:
+        (is_gap, gap_dir)
     """
     table = cfg["table"]
     symbol_id = bar.symbol_id
@@ -321,6 +320,7 @@ def process_closed_bar(conn, tf_name, cfg, bar: AggregatedBar, gap_threshold):
                 is_gap, gap_dir
             )
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING ingested_at
             """,
             (
                 symbol_id,
@@ -334,12 +334,15 @@ def process_closed_bar(conn, tf_name, cfg, bar: AggregatedBar, gap_threshold):
                 gap_dir,
             ),
         )
+        bar.ingested_at = cur.fetchone()[0]
 
     last_closed_close[tf_name][symbol_id] = close_price
 
     if is_gap:
         mark_gap_positions(conn, symbol_id, gap_dir)
 
+    return is_gap, gap_dir
+
 
 def mark_gap_positions(conn, symbol_id, gap_dir):
     """
@@ -411,6 +414,9 @@ def process_minute_bar(conn, row, gap_threshold):
 
     row: DictRow из candles_1m (symbol_id, timestamp, open, high, low, close, volume),
     где timestamp в московском времени (naive).
+
+    Returns:
+        закрытые этой минуткой бары: [(tf_name, AggregatedBar, is_gap, gap_dir)]
     """
     symbol_id = row["symbol_id"]
     ts = row["timestamp"]  # MSK naive
@@ -421,6 +427,7 @@ def process_minute_bar(conn, row, gap_threshold):
     c = float(row["close"])
     v = float(row["volume"])
 
+    closed = []
     for tf_name, cfg in TIMEFRAMES.items():
         minutes = cfg["minutes"]
         bucket_start = floor_timestamp_to_bucket(ts, minutes)
@@ -444,7 +451,8 @@ def process_minute_bar(conn, row, gap_threshold):
         else:
             # если пришла минутка уже в следующем/дальнейшем интервале — закрываем и создаём новый
             if ts >= current.end_ts:
-                process_closed_bar(conn, tf_name, cfg, current, gap_threshold)
+                is_gap, gap_dir = process_closed_bar(conn, tf_name, cfg, current, gap_threshold)
+                closed.append((tf_name, current, is_gap, gap_dir))
                 current = AggregatedBar(
                     symbol_id=symbol_id,
                     start_ts=bucket_start,
@@ -460,12 +468,108 @@ def process_minute_bar(conn, row, gap_threshold):
                 # всё ещё внутри текущего интервала — просто обновляем
                 current.update_with_minute(o, h, l, c, v)
 
+    return closed
+
 
 # --- Основной цикл демона ---
 
 
+def init_last_1m_timestamp(conn):
+    """
+    Начальный last_1m_timestamp, если ещё ничего не обрабатывали:
+    минимум из candles_1m - 1 минута (чтобы не пропустить), иначе «вчера».
+    """
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT min(timestamp) AS min_ts FROM candles_1m")
+        row = cur.fetchone()
+    if row and row["min_ts"] is not None:
+        return row["min_ts"] - timedelta(minutes=1)  # уже MSK naive
+    # fallback: стартуем от «вчера»
+    return datetime.now() - timedelta(days=1)
+
+
+def fetch_new_minutes(conn, last_1m_ts):
+    """Новые минутки из candles_1m после last_1m_ts (по времени, затем по symbol_id)"""
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(
+            """
+            SELECT symbol_id, timestamp, open, high, low, close, volume, ingested_at
+            FROM candles_1m
+            WHERE timestamp > %s
+            ORDER BY timestamp, symbol_id
+            """,
+            (last_1m_ts,),
+        )
+        return cur.fetchall()
+
+
+def process_minutes(conn, rows, last_1m_ts, gap_threshold):
+    """
+    Пачка минуток -> агрегаты, last_prices, datafeed_state (с commit).
+
+    Returns:
+        (новый last_1m_ts, закрытые бары [(tf_name, AggregatedBar, is_gap, gap_dir)])
+    """
+    total = len(rows)
+    logger.info(f"Новых минутных свечей: {total}")
+
+    started = time.perf_counter()
+    latency = LatencyRecorder("data_feed")
+
+    processed = 0
+    batch_log_step = 100_000  # логировать каждые 100k минуток
+    closed = []
+
+    for row in rows:
+        ts = row["timestamp"]  # MSK naive
+
+        if last_1m_ts is None or ts > last_1m_ts:
+            last_1m_ts = ts
+
+        closed.extend(process_minute_bar(conn, row, gap_threshold))
+        processed += 1
+
+        if processed % batch_log_step == 0:
+            logger.info(
+                f"Обработано минутных свечей: {processed}/{total} "
+                f"({processed * 100.0 / total:.1f}%), last_1m_ts={last_1m_ts}"
+            )
+
+    logger.info(
+        f"Завершена обработка пачки минуток: {processed}/{total}, "
+        f"last_1m_ts={last_1m_ts}"
+    )
+
+    # последние цены пачки (commit вместе с прогрессом)
+    update_last_prices_from_candles(conn, rows)
+
+    # задержка считается от самой ранней по времени появления минутки пачки
+    latency.duration(time.perf_counter() - started, total)
+    latency.lag(min((row["ingested_at"] for row in rows if row["ingested_at"] is not None), default=None), total)
+    latency.flush(conn)
+
+    # сохраняем прогресс
+    save_last_1m_timestamp(conn, last_1m_ts)
+    return last_1m_ts, closed
+
+
+def run_once(conn, last_1m_ts, gap_threshold):
+    """
+    Одна итерация: новые минутки после last_1m_ts -> агрегаты, last_prices, datafeed_state.
+
+    Returns:
+        (новый last_1m_ts, число обработанных минуток)
+    """
+    rows = fetch_new_minutes(conn, last_1m_ts)
+    if not rows:
+        return last_1m_ts, 0
+
+    last_1m_ts, _ = process_minutes(conn, rows, last_1m_ts, gap_threshold)
+    return last_1m_ts, len(rows)
+
+
 def main_loop():
-    conn = get_connection()
+    conn = db_connect(application_name="datafeed_aggregator")
     conn.autocommit = False
 
     try:
@@ -474,17 +578,7 @@ def main_loop():
         last_1m_ts = load_last_state(conn)  # MSK naive или None
 
         if last_1m_ts is None:
-            # если ещё не обрабатывали ничего — берём минимум из candles_1m - 1 минуту (чтобы не пропустить)
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("SELECT min(timestamp) AS min_ts FROM candles_1m")
-                row = cur.fetchone()
-                if row and row["min_ts"] is not None:
-                    ts0 = row["min_ts"]  # уже MSK naive
-                    last_1m_ts = ts0 - timedelta(minutes=1)
-                else:
-                    # fallback: стартуем от «вчера»
-                    last_1m_ts = datetime.now() - timedelta(days=1)
-
+            last_1m_ts = init_last_1m_timestamp(conn)
             logger.info(f"Начальный last_1m_timestamp = {last_1m_ts}")
             save_last_1m_timestamp(conn, last_1m_ts)
 
@@ -492,57 +586,12 @@ def main_loop():
 
         while True:
             try:
-                # читаем новые минутки
-                with conn.cursor(cursor_factory=DictCursor) as cur:
-                    cur.execute(
-                        """
-                        SELECT symbol_id, timestamp, open, high, low, close, volume
-                        FROM candles_1m
-                        WHERE timestamp > %s
-                        ORDER BY timestamp, symbol_id
-                        """,
-                        (last_1m_ts,),
-                    )
-                    rows = cur.fetchall()
-
-                if rows:
-                    total = len(rows)
-                    logger.info(f"Новых минутных свечей: {total}")
-
-                    processed = 0
-                    batch_log_step = 100_000  # логировать каждые 100k минуток
-
-                    for row in rows:
-                        ts = row["timestamp"]  # MSK naive
-
-                        if last_1m_ts is None or ts > last_1m_ts:
-                            last_1m_ts = ts
-
-                        process_minute_bar(conn, row, gap_threshold)
-                        processed += 1
-
-                        if processed % batch_log_step == 0:
-                            logger.info(
-                                f"Обработано минутных свечей: {processed}/{total} "
-                                f"({processed * 100.0 / total:.1f}%), last_1m_ts={last_1m_ts}"
-                            )
-
-                    logger.info(
-                        f"Завершена обработка пачки минуток: {processed}/{total}, "
-                        f"last_1m_ts={last_1m_ts}"
-                    )
-
-                    # сохраняем прогресс и heartbeat
-                    save_last_1m_timestamp(conn, last_1m_ts)
-                    update_service_heartbeat(conn)
-                else:
-                    # если нет новых данных — просто обновим heartbeat
-                    update_service_heartbeat(conn)
-
+                last_1m_ts, _ = run_once(conn, last_1m_ts, gap_threshold)
+                update_service_heartbeat(conn)
                 conn.commit()
 
             except Exception as e:
-                conn.rollback()
+                conn = recover_connection(conn)
                 logger.exception(f"Ошибка в основном цикле обработки минуток: {e}")
                 log_error(
                     conn,
@@ -11,7 +11,8 @@ execution_engine.py
     - Периодически опрашивать live_signals на предмет новых сигналов (processed = false).
     - Для каждого сигнала:
         * подтянуть strategy_universe (risk_per_trade, max_drawdown_fraction, mode, priority, symbol, timeframe, strategy_id);
-        * проверить глобальные флаги trading_control (allow_trading, allow_new_positions);
+        * проверить глобальные флаги trading_control (allow_trading, allow_new_positions)
+          и блокировку инструмента в symbol_blocks (новые позиции запрещены только на нём);
         * подтянуть состояние счёта (account_state: equity, free_cash);
         * подтянуть позицию по стратегии/инструменту (live_positions) и lot_size инструмента (symbols);
         * применить риск-логику:
@@ -29,7 +30,9 @@ execution_engine.py
           со статусом 'NEW' или 'NOT_SENT' (если политика не отправлять автоматически).
     - Обновлять:
         * флаг processed / processed_at в live_signals;
-        * service_status(service_name='execution_engine') — heartbeat и статус.
+        * service_status(service_name='execution_engine') — heartbeat и статус;
+        * latency_trace(stage='execution_engine') — длительность пачки и задержка
+          от записи сигнала (live_signals.created_at) до заявки.
     - Любые ошибки и отказы записывать в live_errors с source='execution' или 'risk'.
 
 Ключевые допущения:
@@ -39,40 +42,66 @@ execution_engine.py
     - MANUAL_CLOSE и FORCED_CLOSE проходят даже при allow_trading=false (ручной/форс-мажорный контроль).
 
 Архитектура:
-    - Один процесс с циклом:
-        1. Читает пачку сигналов из live_signals (processed=false, отсортированных по времени).
+    - Цикл потребителя сигналов (в одной транзакции на пачку):
+        1. Захватывает пачку сигналов из live_signals (processed=false, по времени):
+           партиции (strategy_universe_id, symbol) - через pg_try_advisory_xact_lock,
+           строки - FOR UPDATE SKIP LOCKED.
         2. Для каждого сигнала применяет risk/execution-логику.
-        3. Пишет заявки в live_orders и помечает сигнал как processed.
+        3. Пишет заявки в live_orders и помечает сигнал как processed (commit).
         4. Обновляет heartbeat в service_status.
         5. Спит заданный интервал и повторяет.
+    - Потребителей может быть несколько (процессы или --threads N): сигналы одной
+      партиции обрабатывает один потребитель по порядку, разные партиции - параллельно.
+      Пачка с открытиями держит account_state FOR UPDATE до commit, а ещё не исполненные
+      заявки на открытие учитываются в free_cash и лимитах позиций.
 """
 
+import argparse
 import logging
 import math
+import os
 import sys
+import threading
 import time
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
 
 import psycopg2
-from psycopg2.extras import DictCursor, Json
+from psycopg2.extras import DictCursor, Json, execute_values
 
-# --- Конфиг подключения к PostgreSQL ---
+from db_pool import connect as db_connect, recover_connection
+from utils_latency import LatencyRecorder
+from utils_lot import LotSizeCache
 
-PG_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 5432,
-    "dbname": "stock_db",
-    "user": "postgres",
-    "password": "123",
-}
+# --- Параметры ---
 
 # Максимальное количество сигналов за одну итерацию
-MAX_SIGNALS_PER_BATCH = 100
+# (сигналы пачки обрабатываются в памяти и пишутся одной транзакцией)
+MAX_SIGNALS_PER_BATCH = 1000
+
+# Сколько партиций (strategy_universe_id, symbol) захватывать за одну итерацию
+MAX_PARTITIONS_PER_BATCH = 200
+
+# Типы сигналов, открывающие или увеличивающие позицию
+OPENING_SIGNAL_TYPES = ("OPEN", "ADD", "REVERSE")
+
+# Статусы заявок, ещё не исполненных брокером (деньги под них уже зарезервированы;
+# для PARTIALLY_FILLED резерв считается по полному объёму - с запасом).
+# Тот же список - в условии частичного индекса idx_live_orders_pending
+PENDING_ORDER_STATUSES = ("NEW", "WORKING", "PARTIALLY_FILLED")
+PENDING_ORDER_STATUSES_SQL = ", ".join(f"'{status}'" for status in PENDING_ORDER_STATUSES)
 
 # Пауза между итерациями (секунд)
 POLL_INTERVAL_SECONDS = 2
 
+# Как часто сверять версию lot_history и догружать изменения (секунд)
+LOT_REFRESH_SECONDS = 60
+
 # --- Логирование ---
 
 logger = logging.getLogger("execution_engine")
@@ -89,16 +118,6 @@ logger.addHandler(handler)
 
 # --- Работа с БД ---
 
-def get_connection():
-    return psycopg2.connect(
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        dbname=PG_CONFIG["dbname"],
-        user=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-    )
-
-
 def log_error(conn, message: str, severity: str = "error", source: str = "execution",
               strategy_universe_id: Optional[int] = None,
               symbol: Optional[str] = None,
@@ -156,9 +175,10 @@ def load_trading_control(conn) -> Tuple[bool, bool]:
         return bool(row["allow_trading"]), bool(row["allow_new_positions"])
 
 
-def load_account_state(conn) -> Tuple[float, float]:
+def load_account_state(conn, for_update: bool = False) -> Tuple[float, float]:
+    """for_update - заблокировать строку счёта до конца транзакции (сериализует открытия)"""
     with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("SELECT equity, free_cash FROM account_state WHERE id = 1")
+        cur.execute("SELECT equity, free_cash FROM account_state WHERE id = 1" + (" FOR UPDATE" if for_update else ""))
         row = cur.fetchone()
         if not row:
             # default
@@ -166,115 +186,391 @@ def load_account_state(conn) -> Tuple[float, float]:
         return float(row["equity"]), float(row["free_cash"])
 
 
-def load_symbol_info(conn, symbol: str) -> Tuple[Optional[int], int]:
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("SELECT id, lot_size FROM symbols WHERE ticker = %s", (symbol,))
-        row = cur.fetchone()
-        if not row:
-            return None, 1
-        return int(row["id"]), int(row["lot_size"])
+def signal_kind(signal_row) -> str:
+    """Тип сигнала: signal_json.type, иначе колонка signal_type"""
+    return (signal_row["signal_json"] or {}).get("type") or signal_row["signal_type"]
 
 
-def load_strategy_universe_row(conn, su_id: int):
+def claim_signals(conn, limit: int = MAX_SIGNALS_PER_BATCH,
+                  max_partitions: int = MAX_PARTITIONS_PER_BATCH) -> list:
+    """
+    Захватывает пачку необработанных сигналов для этого потребителя
+
+    Сначала берутся партиции (strategy_universe_id, symbol) в порядке самого
+    раннего сигнала - через pg_try_advisory_xact_lock, занятые другими
+    потребителями пропускаются. Затем их сигналы читаются по времени
+    с FOR UPDATE SKIP LOCKED. Блокировки держатся до commit пачки, так что
+    сигналы одной партиции всегда обрабатываются одним потребителем по порядку.
+    """
     with conn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute(
             """
-            SELECT *
-            FROM strategy_universe
-            WHERE id = %s
+            WITH partitions AS (
+                SELECT p.strategy_universe_id, p.symbol
+                FROM (
+                    SELECT strategy_universe_id, symbol, min(signal_timestamp) AS first_ts
+                    FROM live_signals
+                    WHERE processed = false
+                    GROUP BY strategy_universe_id, symbol
+                    ORDER BY first_ts
+                    OFFSET 0
+                ) p
+                WHERE pg_try_advisory_xact_lock(
+                    hashtext('live_signals'),
+                    hashtext(p.strategy_universe_id::text || '|' || p.symbol)
+                )
+                LIMIT %s
+            )
+            SELECT ls.*
+            FROM live_signals ls
+            JOIN partitions pt
+              ON pt.strategy_universe_id = ls.strategy_universe_id
+             AND pt.symbol = ls.symbol
+            WHERE ls.processed = false
+            ORDER BY ls.signal_timestamp, ls.id
+            LIMIT %s
+            FOR UPDATE OF ls SKIP LOCKED
             """,
-            (su_id,),
+            (max_partitions, limit),
         )
-        return cur.fetchone()
+        return cur.fetchall()
 
 
-def load_position_for_strategy(conn, strategy_universe_id: int, symbol: str):
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute(
-            """
-            SELECT id, direction, quantity, avg_price, gap_mode
-            FROM live_positions
-            WHERE strategy_universe_id = %s
-              AND symbol = %s
-            """,
-            (strategy_universe_id, symbol),
-        )
-        return cur.fetchone()
+# --- Пакетная запись результатов пачки ---
 
 
-def count_open_positions(conn) -> int:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT COUNT(*)
-            FROM live_positions
-            """
-        )
-        (cnt,) = cur.fetchone()
-        return int(cnt)
+class BatchWriter:
+    """
+    Накопитель результатов пачки сигналов
+
+    Заявки, отказы (live_errors) и id обработанных сигналов копятся в памяти
+    и пишутся в flush одной транзакцией: execute_values для live_orders и
+    live_errors и один UPDATE live_signals по id = ANY(...).
+
+    Если пачечная запись упала на ошибке БД (например, значение одного сигнала
+    не лезет в колонку), она откатывается до SAVEPOINT и результаты пишутся
+    по сигналу, каждый под своим SAVEPOINT. Сигнал, чьи результаты записать
+    не удалось, помечается processed с записью signal_write_failed в
+    live_errors, иначе он отравлял бы каждую повторную пачку. Если flush
+    всё же не прошёл (потеря соединения), ни один сигнал пачки не помечен
+    processed и пачка будет обработана заново.
+    """
+
+    def __init__(self):
+        self.orders: List[tuple] = []
+        # (live_signal_id | None, строка live_errors)
+        self.errors: List[Tuple[Optional[int], tuple]] = []
+        self.processed_ids: List[int] = []
+
+    def add_order(self, live_signal_id: int, strategy_universe_id: int,
+                  symbol: str, timeframe: str,
+                  side: str, quantity: float, price: Optional[float],
+                  order_type: str, status: str = "NEW"):
+        self.orders.append((
+            live_signal_id,
+            strategy_universe_id,
+            symbol,
+            timeframe,
+            side,
+            quantity,
+            price,
+            order_type,
+            status,
+        ))
+
+    def add_error(self, message: str, severity: str = "error", source: str = "execution",
+                  strategy_universe_id: Optional[int] = None,
+                  symbol: Optional[str] = None,
+                  timeframe: Optional[str] = None,
+                  details: Optional[Dict[str, Any]] = None):
+        signal_id = details.get("live_signal_id") if details else None
+        self.errors.append((signal_id, (
+            source,
+            severity,
+            strategy_universe_id,
+            symbol,
+            timeframe,
+            message,
+            Json(details) if details is not None else None,
+        )))
+
+    def mark_processed(self, signal_id: int):
+        self.processed_ids.append(signal_id)
+
+    def __len__(self) -> int:
+        return len(self.processed_ids)
+
+    def flush(self, conn) -> list:
+        """
+        Пишет накопленное и делает commit; после успешной записи буферы очищаются
+
+        Returns:
+            записанные заявки (строки live_orders)
+        """
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SAVEPOINT batch_writer")
+            try:
+                orders = self._write(cur, self.orders, [row for _, row in self.errors], self.processed_ids)
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_writer")
+                logger.warning(f"Пачечная запись {len(self.processed_ids)} сигналов не прошла, пишем по сигналу: {e}")
+                orders = self._write_per_signal(cur)
+        conn.commit()
+        self.clear()
+        return orders
+
+    def _write_per_signal(self, cur) -> list:
+        """Запись по одному сигналу под SAVEPOINT; сбойный сигнал закрывается ошибкой"""
+        orders_by_signal: Dict[int, List[tuple]] = {}
+        for order in self.orders:
+            orders_by_signal.setdefault(order[0], []).append(order)
+        errors_by_signal: Dict[Optional[int], List[tuple]] = {}
+        for signal_id, row in self.errors:
+            errors_by_signal.setdefault(signal_id, []).append(row)
+
+        written = []
+        for signal_id in dict.fromkeys(self.processed_ids):
+            signal_orders = orders_by_signal.pop(signal_id, [])
+            signal_errors = errors_by_signal.pop(signal_id, [])
+            cur.execute("SAVEPOINT batch_writer_signal")
+            try:
+                written.extend(self._write(cur, signal_orders, signal_errors, [signal_id]))
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_writer_signal")
+                logger.error(f"Результаты сигнала id={signal_id} не записаны, сигнал закрыт с ошибкой: {e}")
+                # strategy_universe_id, symbol, timeframe сигнала - из его заявки или отказа
+                if signal_orders:
+                    context = signal_orders[0][1:4]
+                elif signal_errors:
+                    context = signal_errors[0][2:5]
+                else:
+                    context = (None, None, None)
+                failed = (
+                    "execution", "error", *context, "signal_write_failed",
+                    Json({"live_signal_id": signal_id, "error": str(e),
+                          "orders": len(signal_orders), "errors": len(signal_errors)}),
+                )
+                self._write(cur, [], [failed], [signal_id])
+            else:
+                cur.execute("RELEASE SAVEPOINT batch_writer_signal")
+
+        # ошибки без сигнала (или сигнала вне processed_ids) - последним заходом
+        rest = [row for rows in errors_by_signal.values() for row in rows]
+        if rest:
+            self._write(cur, [], rest, [])
+        return written
+
+    @staticmethod
+    def _write(cur, orders: List[tuple], errors: List[tuple], processed_ids: List[int]) -> list:
+        written = []
+        if orders:
+            written = execute_values(
+                cur,
+                """
+                INSERT INTO live_orders (
+                    live_signal_id,
+                    strategy_universe_id,
+                    symbol,
+                    timeframe,
+                    side,
+                    quantity,
+                    price,
+                    order_type,
+                    status,
+                    created_at,
+                    updated_at
+                )
+                VALUES %s
+                RETURNING *
+                """,
+                orders,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, now(), now())",
+                page_size=1000,
+                fetch=True,
+            )
+        if errors:
+            execute_values(
+                cur,
+                """
+                INSERT INTO live_errors (
+                    timestamp, source, severity,
+                    strategy_universe_id, symbol, timeframe,
+                    message, details_json
+                )
+                VALUES %s
+                """,
+                errors,
+                template="(now(), %s, %s, %s, %s, %s, %s, %s)",
+                page_size=1000,
+            )
+        if processed_ids:
+            cur.execute(
+                """
+                UPDATE live_signals
+                SET processed = true,
+                    processed_at = now()
+                WHERE id = ANY(%s)
+                """,
+                (processed_ids,),
+            )
+        return written
+
+    def clear(self):
+        self.orders.clear()
+        self.errors.clear()
+        self.processed_ids.clear()
+
+
+# --- Снимок риска на пачку сигналов ---
 
 
-def count_open_positions_for_strategy(conn, strategy_universe_id: int) -> int:
-    with conn.cursor() as cur:
+@dataclass
+class RiskSnapshot:
+    """
+    Состояние счёта и лимитов на пачку сигналов
+
+    Загружается одним заходом на пачку (load_risk_snapshot), дальше
+    process_signal работает только с памятью: принятые заявки сразу
+    резервируют free_cash и слоты позиций в снимке.
+    """
+    allow_trading: bool
+    allow_new_positions: bool
+    equity: float
+    free_cash: float
+    # {strategy_universe_id: строка strategy_universe}
+    universe: Dict[int, Any]
+    # {ticker: (symbol_id | None, lot_size)}; lot_size уже с учётом lot_history
+    symbols: Dict[str, Tuple[Optional[int], int]]
+    # {(strategy_universe_id, symbol): строка live_positions | None}
+    positions: Dict[Tuple[int, str], Any]
+    total_positions: int
+    positions_per_strategy: Dict[int, int] = field(default_factory=dict)
+    # {ticker: reason} - инструменты, на которых health_monitor запретил новые позиции
+    blocked_symbols: Dict[str, str] = field(default_factory=dict)
+
+    def symbol_info(self, symbol: str) -> Tuple[Optional[int], int]:
+        return self.symbols.get(symbol, (None, 1))
+
+    def position(self, strategy_universe_id: int, symbol: str):
+        return self.positions.get((strategy_universe_id, symbol))
+
+    def open_for_strategy(self, strategy_universe_id: int) -> int:
+        return self.positions_per_strategy.get(strategy_universe_id, 0)
+
+    def reserve_open(self, strategy_universe_id: int, symbol: str, required_cash: float):
+        """Принята заявка на открытие/добавление: списываем деньги и занимаем слот позиции"""
+        self.free_cash -= required_cash
+        key = (strategy_universe_id, symbol)
+        if key not in self.positions:
+            self.positions[key] = None
+            self.total_positions += 1
+            self.positions_per_strategy[strategy_universe_id] = self.open_for_strategy(strategy_universe_id) + 1
+
+    def reserve_close(self, strategy_universe_id: int, symbol: str):
+        """Принята заявка на закрытие: повторное закрытие в этой пачке - уже без позиции"""
+        self.positions[(strategy_universe_id, symbol)] = None
+
+
+def load_risk_snapshot(conn, signals: List[Any], lot_cache: Optional[LotSizeCache] = None,
+                       now: Optional[datetime] = None) -> RiskSnapshot:
+    """
+    Загружает снимок риска для пачки сигналов
+
+    trading_control, account_state, строки strategy_universe и позиции
+    упомянутых стратегий, лоты упомянутых инструментов и счётчики позиций
+    читаются несколькими запросами на всю пачку, а не на каждый сигнал.
+
+    now - момент, на который берутся размеры лотов (None - текущее время).
+    """
+    su_ids = sorted({int(s["strategy_universe_id"]) for s in signals})
+    tickers = sorted({s["symbol"] for s in signals})
+    opening = any(signal_kind(s) in OPENING_SIGNAL_TYPES for s in signals)
+
+    allow_trading, allow_new_positions = load_trading_control(conn)
+    # при открытиях счёт блокируется первым: следующие запросы уже видят
+    # заявки, закоммиченные параллельными потребителями
+    equity, free_cash = load_account_state(conn, for_update=opening)
+
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT * FROM strategy_universe WHERE id = ANY(%s)", (su_ids,))
+        universe = {int(row["id"]): row for row in cur.fetchall()}
+
+        cur.execute("SELECT id, ticker, lot_size FROM symbols WHERE ticker = ANY(%s)", (tickers,))
+        symbol_rows = cur.fetchall()
+
         cur.execute(
             """
-            SELECT COUNT(*)
+            SELECT id, strategy_universe_id, symbol, direction, quantity, avg_price, gap_mode
             FROM live_positions
-            WHERE strategy_universe_id = %s
+            WHERE strategy_universe_id = ANY(%s)
             """,
-            (strategy_universe_id,),
+            (su_ids,),
         )
-        (cnt,) = cur.fetchone()
-        return int(cnt)
-
+        positions = {(int(row["strategy_universe_id"]), row["symbol"]): row for row in cur.fetchall()}
 
-def mark_signal_processed(conn, signal_id: int):
-    with conn.cursor() as cur:
         cur.execute(
             """
-            UPDATE live_signals
-            SET processed = true,
-                processed_at = now()
-            WHERE id = %s
-            """,
-            (signal_id,),
+            SELECT strategy_universe_id, COUNT(*) AS cnt
+            FROM live_positions
+            GROUP BY strategy_universe_id
+            """
         )
+        per_strategy = {row["strategy_universe_id"]: int(row["cnt"]) for row in cur.fetchall()}
 
+        blocked_symbols: Dict[str, str] = {}
+        if opening:
+            cur.execute("SELECT ticker, reason FROM symbol_blocks WHERE ticker = ANY(%s)", (tickers,))
+            blocked_symbols = {row["ticker"]: row["reason"] for row in cur.fetchall()}
 
-def insert_order(conn, live_signal_id: int, strategy_universe_id: int,
-                 symbol: str, timeframe: str,
-                 side: str, quantity: float, price: Optional[float],
-                 order_type: str, status: str = "NEW"):
-    with conn.cursor() as cur:
+        # заявки на открытие, ещё не исполненные брокером: их деньги и слоты позиций уже заняты.
+        # Статусы подставлены литералом: так планировщик берёт частичный индекс
+        # idx_live_orders_pending и не трогает исполненную историю live_orders
         cur.execute(
             """
-            INSERT INTO live_orders (
-                live_signal_id,
-                strategy_universe_id,
-                symbol,
-                timeframe,
-                side,
-                quantity,
-                price,
-                order_type,
-                status,
-                created_at,
-                updated_at
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, now(), now())
+            SELECT o.strategy_universe_id, o.symbol,
+                   SUM(o.quantity * COALESCE(o.price, (s.signal_json->>'entry_price')::numeric, 0)) AS reserved_cash,
+                   EXISTS (
+                       SELECT 1 FROM live_positions p
+                       WHERE p.strategy_universe_id = o.strategy_universe_id AND p.symbol = o.symbol
+                   ) AS has_position
+            FROM live_orders o
+            JOIN live_signals s ON s.id = o.live_signal_id
+            WHERE o.status IN (""" + PENDING_ORDER_STATUSES_SQL + """)
+              AND COALESCE(s.signal_json->>'type', s.signal_type) = ANY(%s)
+            GROUP BY o.strategy_universe_id, o.symbol
             """,
-            (
-                live_signal_id,
-                strategy_universe_id,
-                symbol,
-                timeframe,
-                side,
-                quantity,
-                price,
-                order_type,
-                status,
-            ),
+            (list(OPENING_SIGNAL_TYPES),),
         )
+        pending = cur.fetchall()
+
+    for row in pending:
+        free_cash -= float(row["reserved_cash"] or 0)
+        if not row["has_position"]:
+            key = (int(row["strategy_universe_id"]), row["symbol"])
+            positions.setdefault(key, None)
+            per_strategy[key[0]] = per_strategy.get(key[0], 0) + 1
+
+    if now is None:
+        now = datetime.now(timezone.utc)
+    symbols: Dict[str, Tuple[Optional[int], int]] = {}
+    for row in symbol_rows:
+        symbol_id, lot_size = int(row["id"]), int(row["lot_size"])
+        if lot_cache is not None and lot_cache.has_history(symbol_id):
+            lot_size = lot_cache.get_lotsize(symbol_id, now)
+        symbols[row["ticker"]] = (symbol_id, lot_size)
+
+    return RiskSnapshot(
+        allow_trading=allow_trading,
+        allow_new_positions=allow_new_positions,
+        equity=equity,
+        free_cash=free_cash,
+        universe=universe,
+        symbols=symbols,
+        positions=positions,
+        total_positions=sum(per_strategy.values()),
+        positions_per_strategy=per_strategy,
+        blocked_symbols=blocked_symbols,
+    )
 
 
 # --- Основная логика обработки сигнала ---
@@ -339,9 +635,19 @@ def compute_order_size(equity: float,
     return True, "ok", size_lots
 
 
-def process_signal(conn, signal_row):
+def process_signal(conn, signal_row, lot_cache: Optional[LotSizeCache] = None,
+                   snapshot: Optional[RiskSnapshot] = None,
+                   writer: Optional[BatchWriter] = None):
     """
     Обработка одного сигнала из live_signals.
+
+    snapshot - снимок риска пачки (load_risk_snapshot); принятые заявки
+    обновляют его в памяти. Без снимка он загружается под этот сигнал.
+    writer - накопитель пачки: заявки, отказы и отметка processed пишутся
+    в него, запись в БД - в writer.flush. Без writer результат сигнала
+    записывается и коммитится сразу.
+    lot_cache - кэш lot_history; если у инструмента есть история лотов,
+    размер лота берётся из неё на текущий момент, иначе из symbols.lot_size.
     """
     signal_id = signal_row["id"]
     su_id = signal_row["strategy_universe_id"]
@@ -351,14 +657,27 @@ def process_signal(conn, signal_row):
     signal_source = signal_row["signal_source"]
     signal_json = signal_row["signal_json"]
 
+    if snapshot is None:
+        snapshot = load_risk_snapshot(conn, [signal_row], lot_cache)
+
+    if writer is None:
+        writer = BatchWriter()
+        try:
+            process_signal(conn, signal_row, lot_cache, snapshot, writer)
+        except Exception:
+            writer.clear()
+            raise
+        writer.flush(conn)
+        return
+
     # MANUAL_CLOSE / FORCED_CLOSE должны работать всегда,
     # даже при allow_trading=false, но надо проверить allow_trading позже
-    allow_trading, allow_new_positions = load_trading_control(conn)
+    allow_trading = snapshot.allow_trading
+    allow_new_positions = snapshot.allow_new_positions
 
-    su_row = load_strategy_universe_row(conn, su_id)
+    su_row = snapshot.universe.get(su_id)
     if not su_row:
-        log_error(
-            conn,
+        writer.add_error(
             message="strategy_universe row not found",
             severity="error",
             source="execution",
@@ -367,7 +686,7 @@ def process_signal(conn, signal_row):
             timeframe=timeframe,
             details={"live_signal_id": signal_id},
         )
-        mark_signal_processed(conn, signal_id)
+        writer.mark_processed(signal_id)
         return
 
     mode = su_row["mode"]
@@ -376,13 +695,13 @@ def process_signal(conn, signal_row):
     max_positions_per_strategy = su_row.get("max_positions_per_strategy")
     max_total_positions = su_row.get("max_total_positions")
 
-    equity, free_cash = load_account_state(conn)
-    symbol_id, lot_size = load_symbol_info(conn, symbol)
-    pos_row = load_position_for_strategy(conn, su_id, symbol)
+    equity, free_cash = snapshot.equity, snapshot.free_cash
+    symbol_id, lot_size = snapshot.symbol_info(symbol)
+    pos_row = snapshot.position(su_id, symbol)
 
     # Глобальные лимиты new positions
-    total_open_positions = count_open_positions(conn)
-    open_for_strategy = count_open_positions_for_strategy(conn, su_id)
+    total_open_positions = snapshot.total_positions
+    open_for_strategy = snapshot.open_for_strategy(su_id)
 
     # Разбор сигнала
     signal_data = signal_json or {}
@@ -400,8 +719,7 @@ def process_signal(conn, signal_row):
 
     # Проверка allow_trading / allow_new_positions
     if not allow_trading and not (is_manual_close or is_forced_close):
-        log_error(
-            conn,
+        writer.add_error(
             message="trading_disabled_by_control",
             severity="info",
             source="execution",
@@ -410,12 +728,11 @@ def process_signal(conn, signal_row):
             timeframe=timeframe,
             details={"live_signal_id": signal_id},
         )
-        mark_signal_processed(conn, signal_id)
+        writer.mark_processed(signal_id)
         return
 
     if not allow_new_positions and s_type in ("OPEN", "ADD", "REVERSE") and not (is_manual_close or is_forced_close):
-        log_error(
-            conn,
+        writer.add_error(
             message="new_positions_disabled_by_control",
             severity="info",
             source="execution",
@@ -424,15 +741,29 @@ def process_signal(conn, signal_row):
             timeframe=timeframe,
             details={"live_signal_id": signal_id, "signal_type": s_type},
         )
-        mark_signal_processed(conn, signal_id)
+        writer.mark_processed(signal_id)
+        return
+
+    # Устаревшие/рваные данные по инструменту: новые позиции только на нём запрещены
+    block_reason = snapshot.blocked_symbols.get(symbol)
+    if block_reason and s_type in ("OPEN", "ADD", "REVERSE"):
+        writer.add_error(
+            message="new_positions_disabled_for_symbol",
+            severity="info",
+            source="execution",
+            strategy_universe_id=su_id,
+            symbol=symbol,
+            timeframe=timeframe,
+            details={"live_signal_id": signal_id, "signal_type": s_type, "reason": block_reason},
+        )
+        writer.mark_processed(signal_id)
         return
 
     # Ветки по типу сигнала
     if s_type in ("OPEN", "ADD", "REVERSE"):
         # Лимиты по позициям
         if max_total_positions is not None and total_open_positions >= max_total_positions:
-            log_error(
-                conn,
+            writer.add_error(
                 message="max_total_positions_reached",
                 severity="warning",
                 source="risk",
@@ -441,12 +772,11 @@ def process_signal(conn, signal_row):
                 timeframe=timeframe,
                 details={"live_signal_id": signal_id},
             )
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
         if max_positions_per_strategy is not None and open_for_strategy >= max_positions_per_strategy:
-            log_error(
-                conn,
+            writer.add_error(
                 message="max_positions_per_strategy_reached",
                 severity="warning",
                 source="risk",
@@ -455,7 +785,7 @@ def process_signal(conn, signal_row):
                 timeframe=timeframe,
                 details={"live_signal_id": signal_id},
             )
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
         ok, reason, size_lots = compute_order_size(
@@ -470,8 +800,7 @@ def process_signal(conn, signal_row):
             size_value=size_value,
         )
         if not ok or size_lots is None:
-            log_error(
-                conn,
+            writer.add_error(
                 message=f"signal_rejected: {reason}",
                 severity="warning",
                 source="risk",
@@ -485,7 +814,7 @@ def process_signal(conn, signal_row):
                     "stop_loss": stop_loss,
                 },
             )
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
         # side из direction
@@ -494,8 +823,7 @@ def process_signal(conn, signal_row):
         elif direction == "SHORT":
             side = "SELL"
         else:
-            log_error(
-                conn,
+            writer.add_error(
                 message="invalid_direction_for_open",
                 severity="warning",
                 source="execution",
@@ -504,11 +832,10 @@ def process_signal(conn, signal_row):
                 timeframe=timeframe,
                 details={"live_signal_id": signal_id, "direction": direction},
             )
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
-        insert_order(
-            conn,
+        writer.add_order(
             live_signal_id=signal_id,
             strategy_universe_id=su_id,
             symbol=symbol,
@@ -519,14 +846,14 @@ def process_signal(conn, signal_row):
             order_type=entry_type,
             status="NEW",
         )
-        mark_signal_processed(conn, signal_id)
+        writer.mark_processed(signal_id)
+        snapshot.reserve_open(su_id, symbol, size_lots * lot_size * entry_price)
 
     elif s_type in ("CLOSE", "MANUAL_CLOSE", "FORCED_CLOSE"):
         # закрытие позиции (полное)
         if not pos_row:
             # нет позиции — нечего закрывать
-            log_error(
-                conn,
+            writer.add_error(
                 message="close_without_position",
                 severity="info",
                 source="execution",
@@ -535,13 +862,13 @@ def process_signal(conn, signal_row):
                 timeframe=timeframe,
                 details={"live_signal_id": signal_id, "signal_type": s_type},
             )
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
         pos_direction = pos_row["direction"]
         pos_qty = float(pos_row["quantity"])
         if pos_qty <= 0:
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
         if pos_direction == "LONG":
@@ -549,12 +876,11 @@ def process_signal(conn, signal_row):
         elif pos_direction == "SHORT":
             side = "BUY"
         else:
-            mark_signal_processed(conn, signal_id)
+            writer.mark_processed(signal_id)
             return
 
         # закрываем по MARKET, цену может выставить брокер/фейк-брокер
-        insert_order(
-            conn,
+        writer.add_order(
             live_signal_id=signal_id,
             strategy_universe_id=su_id,
             symbol=symbol,
@@ -565,12 +891,12 @@ def process_signal(conn, signal_row):
             order_type="MARKET",
             status="NEW",
         )
-        mark_signal_processed(conn, signal_id)
+        writer.mark_processed(signal_id)
+        snapshot.reserve_close(su_id, symbol)
 
     else:
         # неизвестный тип сигнала
-        log_error(
-            conn,
+        writer.add_error(
             message="unknown_signal_type",
             severity="warning",
             source="execution",
@@ -579,63 +905,102 @@ def process_signal(conn, signal_row):
             timeframe=timeframe,
             details={"live_signal_id": signal_id, "signal_type": s_type},
         )
-        mark_signal_processed(conn, signal_id)
+        writer.mark_processed(signal_id)
 
 
 # --- Основной цикл демона ---
 
-def main_loop():
-    conn = get_connection()
+def process_signal_batch(conn, signals: list, lot_cache: Optional[LotSizeCache] = None,
+                         now: Optional[datetime] = None) -> list:
+    """
+    Пачка сигналов -> снимок риска -> заявки/отказы и processed одним commit.
+
+    Args:
+        signals: строки live_signals (claim_signals или переданные напрямую в pipeline)
+        now: момент для размеров лотов (None - текущее время)
+
+    Returns:
+        записанные заявки (строки live_orders)
+    """
+    started = time.perf_counter()
+    snapshot = load_risk_snapshot(conn, signals, lot_cache, now=now)
+    writer = BatchWriter()
+
+    for s in signals:
+        try:
+            # со снимком и writer обработка сигнала идёт только в памяти
+            process_signal(conn, s, lot_cache, snapshot, writer)
+        except Exception as e:
+            logger.exception(f"Ошибка при обработке сигнала id={s['id']}: {e}")
+            writer.add_error(
+                message="Ошибка при обработке сигнала в execution_engine",
+                severity="error",
+                source="execution",
+                strategy_universe_id=s["strategy_universe_id"],
+                symbol=s["symbol"],
+                timeframe=s["timeframe"],
+                details={"live_signal_id": s["id"], "error": str(e)},
+            )
+            # сигнал с ошибкой тоже помечаем processed, чтобы не зациклиться
+            writer.mark_processed(s["id"])
+
+    latency = LatencyRecorder("execution_engine")
+    latency.duration(time.perf_counter() - started, len(signals))
+    for s in signals:
+        latency.lag(s.get("created_at"))
+    latency.flush(conn)
+
+    # заявки, отказы, processed и замеры всей пачки - одним commit
+    return writer.flush(conn)
+
+
+def run_once(conn, lot_cache: Optional[LotSizeCache] = None,
+             consumer_name: str = "execution_engine", now: Optional[datetime] = None,
+             processed: Optional[Set[int]] = None) -> int:
+    """
+    Одна итерация: захват пачки сигналов -> снимок риска -> заявки/отказы одним commit.
+
+    Args:
+        now: момент для размеров лотов (None - текущее время; replay передаёт время истории)
+        processed: сюда добавляются id обработанных сигналов (pipeline сверяет с очередью)
+
+    Returns:
+        число обработанных сигналов
+    """
+    signals = claim_signals(conn)
+    if not signals:
+        return 0
+
+    logger.info(f"{consumer_name}: захвачено сигналов: {len(signals)}")
+    process_signal_batch(conn, signals, lot_cache, now=now)
+    if processed is not None:
+        processed.update(s["id"] for s in signals)
+    return len(signals)
+
+
+def main_loop(consumer_name: str = "execution_engine"):
+    conn = db_connect(application_name=consumer_name)
     conn.autocommit = False
-    logger.info("Старт execution_engine")
+    logger.info(f"Старт {consumer_name}")
+
+    lot_cache = LotSizeCache(conn=conn)
+    conn.commit()
+    lot_checked_at = time.monotonic()
+    logger.info(f"lot_history загружена: {lot_cache.version.row_count} строк")
 
     try:
         while True:
             try:
-                with conn.cursor(cursor_factory=DictCursor) as cur:
-                    cur.execute(
-                        """
-                        SELECT *
-                        FROM live_signals
-                        WHERE processed = false
-                        ORDER BY signal_timestamp
-                        LIMIT %s
-                        """,
-                        (MAX_SIGNALS_PER_BATCH,),
-                    )
-                    signals = cur.fetchall()
-
-                if not signals:
-                    update_service_heartbeat(conn)
-                    conn.commit()
-                    time.sleep(POLL_INTERVAL_SECONDS)
-                    continue
-
-                logger.info(f"Новых сигналов: {len(signals)}")
-
-                for s in signals:
-                    try:
-                        process_signal(conn, s)
-                    except Exception as e:
-                        conn.rollback()
-                        logger.exception(f"Ошибка при обработке сигнала id={s['id']}: {e}")
-                        log_error(
-                            conn,
-                            message="Ошибка при обработке сигнала в execution_engine",
-                            severity="error",
-                            source="execution",
-                            strategy_universe_id=s["strategy_universe_id"],
-                            symbol=s["symbol"],
-                            timeframe=s["timeframe"],
-                            details={"live_signal_id": s["id"], "error": str(e)},
-                        )
-                        # после rollback надо пометить сигнал processed, чтобы не зациклиться
-                        mark_signal_processed(conn, s["id"])
+                if time.monotonic() - lot_checked_at >= LOT_REFRESH_SECONDS:
+                    lot_checked_at = time.monotonic()
+                    if lot_cache.refresh(conn):
+                        logger.info(f"lot_history обновлена: {lot_cache.version.row_count} строк")
 
+                run_once(conn, lot_cache, consumer_name)
                 update_service_heartbeat(conn)
                 conn.commit()
             except Exception as e:
-                conn.rollback()
+                conn = recover_connection(conn)
                 logger.exception(f"Ошибка в основном цикле execution_engine: {e}")
                 log_error(
                     conn,
@@ -650,11 +1015,34 @@ def main_loop():
 
     finally:
         conn.close()
-        logger.info("execution_engine остановлен")
+        logger.info(f"{consumer_name} остановлен")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="execution_engine: сигналы → заявки")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="сколько потребителей сигналов запустить в этом процессе")
+    args = parser.parse_args()
+
+    if args.threads <= 1:
+        main_loop()
+        return
+
+    threads = [
+        threading.Thread(target=main_loop, args=(f"execution_engine-{i}",),
+                         name=f"execution_engine-{i}", daemon=True)
+        for i in range(args.threads)
+    ]
+    for t in threads:
+        t.start()
+    # join с таймаутом, чтобы Ctrl+C доходил до главного потока
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(timeout=1)
 
 
 if __name__ == "__main__":
     try:
-        main_loop()
+        main()
     except KeyboardInterrupt:
         logger.info("Остановка execution_engine по Ctrl+C")
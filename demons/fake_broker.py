@@ -11,42 +11,58 @@ fake_broker.py
 Цели:
     - Периодически опрашивать live_orders на предмет новых заявок (status='NEW').
     - Для каждой заявки:
-        * определить текущую рыночную цену по инструменту (из candles_1m);
-        * смоделировать исполнение (полное fill по MARKET, для LIMIT/STOP — простое правило);
+        * определить текущую рыночную цену по инструменту (из last_prices, одним запросом на пачку);
+        * смоделировать исполнение (MARKET — сразу; LIMIT/STOP — сразу, если цена достигнута,
+          иначе заявка ждёт в стакане со статусом 'WORKING');
         * записать сделку(и) в live_trades;
         * обновить live_positions (размер, среднюю цену, направление, last_price, unrealized/realized PnL);
-        * обновить account_state (equity/free_cash/used_margin по простой модели кэша + mark-to-market);
-        * изменить статус live_orders на 'FILLED' / 'REJECTED' и т.п.
+        * обновить account_state (free_cash по простой модели кэша);
+        * изменить статус live_orders на 'FILLED' / 'PARTIALLY_FILLED' / 'WORKING' / 'REJECTED'.
+    - Ожидающие LIMIT/STOP исполнять по high/low каждой новой минутки
+      (отсортированный стакан по инструменту, частичное исполнение по объёму минутки).
     - Обрабатывать ошибки:
         * логировать в live_errors с source='broker';
         * не останавливать основной цикл.
+    - Каждый цикл переоценивать открытые позиции по last_prices (unrealized_pnl,
+      drawdown_fraction) и equity = free_cash + рыночная стоимость позиций.
     - Обновлять heartbeat в service_status(service_name='fake_broker').
+    - Писать в latency_trace(stage='fake_broker') длительность пачки новых заявок
+      и задержку от создания заявки (live_orders.created_at) до её исполнения.
+
+    - Позиции, деньги и последние цены живут в памяти (Ledger) и пишутся в БД
+      одной транзакцией на пачку заявок (write-behind).
 
 Ключевые допущения:
     - Все timestamp в БД — UTC.
-    - Для MARKET-заявок используем последнюю 1m свечу (close).
-    - Для LIMIT/STOP пока тоже исполняем по market_price (упрощение).
+    - Для MARKET-заявок используем последнюю цену (close последней 1m свечи из last_prices).
+    - MARKET и сработавший STOP исполняются с проскальзыванием SLIPPAGE_RATE,
+      LIMIT — по цене заявки или лучше.
+    - Стакан видит только последнюю минутку из last_prices: если между опросами
+      пришло несколько минуток, проверяется последняя.
     - Комиссия fee моделируется как FEE_RATE от объёма сделки.
 """
 
 import logging
+import math
+import os
 import sys
 import time
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
-import psycopg2
-from psycopg2.extras import DictCursor, Json
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
 
-# --- Конфиг подключения к PostgreSQL ---
+import psycopg2
+from psycopg2.extras import DictCursor, Json, execute_values
 
-PG_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 5432,
-    "dbname": "stock_db",
-    "user": "postgres",
-    "password": "123",
-}
+from db_pool import connect as db_connect, recover_connection
+from utils_latency import LatencyRecorder
+from utils_lot import LotSizeCache
+from utils_prices import LastBar, load_last_bars
 
 # Параметры работы демона
 POLL_INTERVAL_SECONDS = 2
@@ -55,6 +71,16 @@ MAX_ORDERS_PER_BATCH = 100
 # Простая модель комиссии (например, 0.01% от объёма сделки)
 FEE_RATE = 0.0001
 
+# Проскальзывание для MARKET и сработавших STOP (доля цены, против заявки)
+SLIPPAGE_RATE = 0.0005
+
+# Доля объёма минутки, доступная для исполнения ожидающих LIMIT/STOP (остальное - частичное исполнение)
+MAX_BAR_VOLUME_FRACTION = 0.1
+
+# Как часто сверять версию lot_history и догружать изменения (секунд), как в execution_engine:
+# частичные исполнения режутся лотами того же размера, по которому считался объём заявки
+LOT_REFRESH_SECONDS = 60
+
 # --- Логирование ---
 
 logger = logging.getLogger("fake_broker")
@@ -72,16 +98,6 @@ logger.addHandler(handler)
 # --- Работа с БД ---
 
 
-def get_connection():
-    return psycopg2.connect(
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        dbname=PG_CONFIG["dbname"],
-        user=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-    )
-
-
 def log_error(
     conn,
     message: str,
@@ -118,6 +134,67 @@ def log_error(
         logger.error(f"Не удалось записать ошибку в live_errors: {e}")
 
 
+def mark_to_market(conn) -> Optional[Tuple[float, float, int]]:
+    """
+    Переоценка открытых позиций по last_prices и equity счёта (без commit)
+
+    Два set-based UPDATE на цикл: позиции (last_price, unrealized_pnl,
+    drawdown_fraction - только те, у которых цена изменилась) и account_state
+    (equity = free_cash + рыночная стоимость позиций со знаком: SHORT уже
+    увеличил кэш на выручку от продажи).
+
+    Returns:
+        (equity, free_cash, число переоценённых позиций) или None, если нет account_state
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE live_positions p
+            SET last_price = lp.price,
+                unrealized_pnl = CASE p.direction
+                                     WHEN 'LONG' THEN (lp.price - p.avg_price) * p.quantity
+                                     ELSE (p.avg_price - lp.price) * p.quantity
+                                 END,
+                drawdown_fraction = CASE
+                                        WHEN p.avg_price <= 0 THEN 0
+                                        WHEN p.direction = 'LONG'
+                                            THEN GREATEST(0, (p.avg_price - lp.price) / p.avg_price)
+                                        ELSE GREATEST(0, (lp.price - p.avg_price) / p.avg_price)
+                                    END
+            FROM last_prices lp
+            WHERE lp.ticker = p.symbol
+              AND p.direction IN ('LONG', 'SHORT')
+              AND p.quantity > 0
+              AND (p.last_price IS DISTINCT FROM lp.price::numeric(20,6) OR p.unrealized_pnl = 0)
+            """
+        )
+        marked = cur.rowcount
+
+        cur.execute(
+            """
+            UPDATE account_state a
+            SET equity = a.free_cash + mv.market_value,
+                updated_at = now()
+            FROM (
+                SELECT COALESCE(sum(
+                           CASE p.direction WHEN 'LONG' THEN 1 ELSE -1 END
+                           * p.quantity * COALESCE(p.last_price, p.avg_price)
+                       ), 0) AS market_value
+                FROM live_positions p
+                WHERE p.direction IN ('LONG', 'SHORT')
+                  AND p.quantity > 0
+            ) mv
+            WHERE a.id = 1
+            RETURNING a.equity, a.free_cash
+            """
+        )
+        row = cur.fetchone()
+
+    if row is None:
+        return None
+    return float(row[0]), float(row[1]), marked
+
+
 def update_service_heartbeat(conn):
     try:
         with conn.cursor() as cur:
@@ -135,113 +212,338 @@ def update_service_heartbeat(conn):
         logger.error(f"Не удалось обновить heartbeat fake_broker: {e}")
 
 
-def load_account_state(conn) -> Tuple[float, float, float]:
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute(
-            "SELECT equity, free_cash, used_margin FROM account_state WHERE id = 1"
-        )
-        row = cur.fetchone()
-    if not row:
-        return 0.0, 0.0, 0.0
-    return float(row["equity"]), float(row["free_cash"]), float(row["used_margin"])
+# --- Учёт позиций и денег в памяти ---
 
 
-def save_account_state(conn, equity: float, free_cash: float, used_margin: float):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO account_state (id, equity, free_cash, used_margin, updated_at)
-            VALUES (1, %s, %s, %s, now())
-            ON CONFLICT (id)
-            DO UPDATE SET equity = EXCLUDED.equity,
-                          free_cash = EXCLUDED.free_cash,
-                          used_margin = EXCLUDED.used_margin,
-                          updated_at = EXCLUDED.updated_at
-            """,
-            (equity, free_cash, used_margin),
-        )
-    conn.commit()
+@dataclass
+class LedgerPosition:
+    """Позиция fake_broker в памяти (строка live_positions)"""
+    strategy_universe_id: int
+    symbol: str
+    timeframe: Optional[str]
+    direction: str = "FLAT"
+    quantity: float = 0.0
+    avg_price: float = 0.0
+    realized_pnl: float = 0.0
+    last_price: Optional[float] = None
+    opened_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
 
+    def apply_trade(self, side: str, quantity: float, price: float, now_ts: datetime):
+        """
+        Обновляем позицию по результату сделки.
 
-def load_last_price_from_candles(conn, symbol: str) -> Optional[float]:
-    """
-    Находим последнюю цену (close) из candles_1m по тикеру.
-    """
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("SELECT id FROM symbols WHERE ticker = %s", (symbol,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        symbol_id = row["id"]
+        Простая модель:
+        - LONG позиция: BUY увеличивает/открывает, SELL уменьшает/закрывает.
+        - SHORT позиция: SELL открывает/увеличивает, BUY уменьшает/закрывает.
+        """
+        qty = self.quantity
+        avg_price = self.avg_price
 
-        cur.execute(
-            """
-            SELECT close
-            FROM candles_1m
-            WHERE symbol_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
-            """,
-            (symbol_id,),
-        )
-        row = cur.fetchone()
+        if self.direction == "LONG":
+            if side == "BUY":
+                # добавляем к LONG
+                new_qty = qty + quantity
+                avg_price = (avg_price * qty + price * quantity) / new_qty
+                qty = new_qty
+            else:  # SELL
+                # закрываем часть LONG
+                close_qty = min(qty, quantity)
+                self.realized_pnl += (price - avg_price) * close_qty
+                qty = qty - close_qty
 
-    if not row:
-        return None
-    return float(row["close"])
+        elif self.direction == "SHORT":
+            if side == "SELL":
+                # увеличиваем SHORT
+                new_qty = qty + quantity
+                avg_price = (avg_price * qty + price * quantity) / new_qty
+                qty = new_qty
+            else:  # BUY
+                close_qty = min(qty, quantity)
+                self.realized_pnl += (avg_price - price) * close_qty
+                qty = qty - close_qty
 
+        else:
+            # FLAT (или новой позиции ещё нет) -> открываем
+            self.direction = "LONG" if side == "BUY" else "SHORT"
+            qty = quantity
+            avg_price = price
+            if self.opened_at is None:
+                self.opened_at = now_ts
 
-def load_position(conn, strategy_universe_id: int, symbol: str):
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute(
-            """
-            SELECT id, direction, quantity, avg_price, realized_pnl
-            FROM live_positions
-            WHERE strategy_universe_id = %s AND symbol = %s
-            """,
-            (strategy_universe_id, symbol),
-        )
-        return cur.fetchone()
+        if qty == 0:
+            # позиция полностью закрыта
+            self.direction = "FLAT"
+            avg_price = 0.0
 
+        self.quantity = qty
+        self.avg_price = avg_price
+        self.last_price = price
+        self.updated_at = now_ts
 
-def upsert_position_after_trade(
-    conn,
-    strategy_universe_id: int,
-    symbol: str,
-    timeframe: str,
-    side: str,
-    quantity: float,
-    price: float,
-):
-    """
-    Обновляем live_positions по результату сделки.
 
-    Простая модель:
-    - LONG позиция: BUY увеличивает/открывает, SELL уменьшает/закрывает.
-    - SHORT позиция: SELL открывает/увеличивает, BUY уменьшает/закрывает.
+class Ledger:
     """
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute(
-            """
-            SELECT id, direction, quantity, avg_price, realized_pnl
-            FROM live_positions
-            WHERE strategy_universe_id = %s AND symbol = %s
-            FOR UPDATE
-            """,
-            (strategy_universe_id, symbol),
+    Позиции, деньги и последние цены fake_broker в памяти процесса
+
+    Внутри процесса ledger - источник истины: исполнение заявки меняет только
+    память, а flush пишет всё накопленное за пачку одной транзакцией
+    (write-behind). Деньги пишутся приращением free_cash, поэтому внешние
+    изменения account_state не затираются.
+
+    Изменения пачки дублируются в журнал по заявкам. Если пачечная запись
+    упала на ошибке БД, flush перечитывает состояние из БД и проигрывает
+    журнал заявка за заявкой, каждую под своим SAVEPOINT; заявка, которую
+    записать не удалось, переводится в REJECTED. Если flush не прошёл
+    совсем (потеря соединения), ledger перечитывается из БД (load), а заявки
+    пачки остаются в прежнем статусе.
+    """
+
+    def __init__(self, clock: Optional[Callable[[], datetime]] = None):
+        # часы для opened_at/updated_at позиций (replay подставляет время истории)
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
+        self.positions: Dict[Tuple[int, str], LedgerPosition] = {}
+        self.equity = 0.0
+        self.free_cash = 0.0
+        self.used_margin = 0.0
+        self.prices: Dict[str, float] = {}
+        self.bars: Dict[str, LastBar] = {}
+        self._dirty: Set[Tuple[int, str]] = set()
+        self._cash_delta = 0.0
+        self._trades: List[tuple] = []
+        # последнее изменение статуса по каждой заявке: {order_id: (id, status, broker_order_id)}
+        self._order_updates: Dict[int, tuple] = {}
+        self._errors: List[tuple] = []
+        # журнал изменений пачки: (order_id | None, вид, аргументы) - для записи по заявкам
+        self._journal: List[Tuple[Optional[int], str, tuple]] = []
+        self.latency = LatencyRecorder("fake_broker")
+
+    def load(self, conn):
+        """Загружает позиции и состояние счёта из БД, сбрасывая незаписанные изменения"""
+        self._read_state(conn)
+        self._clear_pending()
+
+    def _read_state(self, conn):
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                """
+                SELECT strategy_universe_id, symbol, timeframe, direction, quantity,
+                       avg_price, realized_pnl, last_price, opened_at, updated_at
+                FROM live_positions
+                """
+            )
+            rows = cur.fetchall()
+
+            cur.execute("SELECT equity, free_cash, used_margin FROM account_state WHERE id = 1")
+            account = cur.fetchone()
+
+        self.positions = {
+            (int(row["strategy_universe_id"]), row["symbol"]): LedgerPosition(
+                strategy_universe_id=int(row["strategy_universe_id"]),
+                symbol=row["symbol"],
+                timeframe=row["timeframe"],
+                direction=row["direction"] or "FLAT",
+                quantity=float(row["quantity"] or 0),
+                avg_price=float(row["avg_price"] or 0),
+                realized_pnl=float(row["realized_pnl"] or 0),
+                last_price=float(row["last_price"]) if row["last_price"] is not None else None,
+                opened_at=row["opened_at"],
+                updated_at=row["updated_at"],
+            )
+            for row in rows
+        }
+        if account:
+            self.equity = float(account["equity"])
+            self.free_cash = float(account["free_cash"])
+            self.used_margin = float(account["used_margin"] or 0)
+        else:
+            self.equity = self.free_cash = self.used_margin = 0.0
+
+    def refresh_prices(self, conn, symbols: List[str]):
+        """Обновляет последние минутки и цены инструментов (заявки пачки и стакан)"""
+        self.apply_bars(load_last_bars(conn, sorted(set(symbols))))
+
+    def apply_bars(self, bars: Dict[str, LastBar]):
+        """Принимает последние минутки инструментов (из last_prices или напрямую от pipeline)"""
+        self.bars.update(bars)
+        self.prices.update((ticker, bar.price) for ticker, bar in bars.items())
+
+    # --- Изменения в памяти ---
+
+    def fill(self, order_row, exec_price: float, fee: float,
+             quantity: Optional[float] = None, status: str = "FILLED"):
+        """
+        Исполнение заявки по exec_price
+
+        Args:
+            quantity: исполненный объём (None - вся заявка)
+            status: статус заявки после исполнения (FILLED / PARTIALLY_FILLED)
+        """
+        qty = float(order_row["quantity"]) if quantity is None else quantity
+        self._journal.append((order_row["id"], "fill", (order_row, exec_price, fee, qty, status)))
+        self._apply_fill(order_row, exec_price, fee, qty, status)
+
+    def _apply_fill(self, order_row, exec_price: float, fee: float, qty: float, status: str):
+        su_id = order_row["strategy_universe_id"]
+        symbol = order_row["symbol"]
+        side = order_row["side"]
+        notional = exec_price * qty
+        now_ts = self.clock()
+
+        key = (su_id, symbol)
+        pos = self.positions.get(key)
+        if pos is None:
+            pos = LedgerPosition(strategy_universe_id=su_id, symbol=symbol, timeframe=order_row["timeframe"])
+            self.positions[key] = pos
+        pos.apply_trade(side, qty, exec_price, now_ts)
+        self._dirty.add(key)
+
+        # account_state (упрощённо: кэш +/- notional -/+ fee)
+        delta = -(notional + fee) if side == "BUY" else notional - fee
+        self._cash_delta += delta
+        self.free_cash += delta
+        # equity пересчитывает mark_to_market (кэш + рыночная стоимость позиций)
+
+        self._trades.append((
+            order_row["id"],
+            su_id,
+            symbol,
+            order_row["timeframe"],
+            side,
+            qty,
+            exec_price,
+            fee,
+            "FILL",
+        ))
+        self._order_updates[order_row["id"]] = (order_row["id"], status, f"fake-{order_row['id']}")
+
+    def set_order_status(self, order_id: int, new_status: str, broker_order_id: Optional[str] = None):
+        self._journal.append((order_id, "status", (new_status, broker_order_id)))
+        self._order_updates[order_id] = (order_id, new_status, broker_order_id)
+
+    def add_error(
+        self,
+        message: str,
+        severity: str = "error",
+        source: str = "broker",
+        strategy_universe_id: Optional[int] = None,
+        symbol: Optional[str] = None,
+        timeframe: Optional[str] = None,
+        details=None,
+    ):
+        row = (
+            source,
+            severity,
+            strategy_universe_id,
+            symbol,
+            timeframe,
+            message,
+            Json(details) if details is not None else None,
         )
-        row = cur.fetchone()
+        self._journal.append(((details or {}).get("order_id"), "error", (row,)))
+        self._errors.append(row)
 
-        now_ts = datetime.now(timezone.utc)
+    # --- Запись в БД ---
 
-        if row is None:
-            # нет позиции — открываем новую
-            direction = "LONG" if side == "BUY" else "SHORT"
-            qty = quantity
-            avg_price = price
-            realized_pnl = 0.0
+    def flush(self, conn) -> Set[int]:
+        """
+        Пишет изменения пачки одной транзакцией и делает commit
 
-            cur.execute(
+        Returns:
+            id заявок, отклонённых из-за ошибки записи (стакан должен их забыть)
+        """
+        rejected: Set[int] = set()
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT ledger_flush")
+            try:
+                account = self._write(cur)
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT ledger_flush")
+                logger.warning(f"Пачечная запись ledger не прошла, пишем по заявкам: {e}")
+                rejected = self._write_per_order(conn, cur)
+                account = None
+
+        self.latency.flush(conn)
+        conn.commit()
+
+        if account is not None:
+            self.equity, self.free_cash, self.used_margin = account
+        self._clear_pending()
+        return rejected
+
+    def _write_per_order(self, conn, cur) -> Set[int]:
+        """
+        Проигрывает журнал пачки от состояния в БД и пишет заявку за заявкой
+
+        Заявка, чья запись упала, откатывается до своего SAVEPOINT, переводится
+        в REJECTED с записью order_write_failed в live_errors, а память
+        перечитывается из БД - следующие заявки идут уже без неё.
+        """
+        groups: Dict[Optional[int], List[Tuple[str, tuple]]] = {}
+        for order_id, kind, args in self._journal:
+            groups.setdefault(order_id, []).append((kind, args))
+        # ошибки без заявки пишутся последними
+        loose = groups.pop(None, [])
+
+        self._read_state(conn)
+        self._clear_writes()
+        rejected: Set[int] = set()
+        for order_id, ops in groups.items():
+            cur.execute("SAVEPOINT ledger_order")
+            for kind, args in ops:
+                self._replay(order_id, kind, args)
+            try:
+                self._write(cur)
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT ledger_order")
+                logger.error(f"Изменения заявки id={order_id} не записаны, заявка отклонена: {e}")
+                self._clear_writes()
+                self._read_state(conn)
+                order_row = next((args[0] for kind, args in ops if kind == "fill"), None)
+                self._order_updates[order_id] = (order_id, "REJECTED", None)
+                self._errors.append((
+                    "broker",
+                    "error",
+                    order_row["strategy_universe_id"] if order_row else None,
+                    order_row["symbol"] if order_row else None,
+                    order_row["timeframe"] if order_row else None,
+                    "order_write_failed",
+                    Json({"order_id": order_id, "error": str(e)}),
+                ))
+                self._write(cur)
+                rejected.add(order_id)
+            else:
+                cur.execute("RELEASE SAVEPOINT ledger_order")
+            self._clear_writes()
+
+        for kind, args in loose:
+            self._replay(None, kind, args)
+        self._write(cur)
+        self._clear_writes()
+
+        # деньги и позиции в памяти - как записано
+        self._read_state(conn)
+        return rejected
+
+    def _replay(self, order_id: Optional[int], kind: str, args: tuple):
+        if kind == "fill":
+            self._apply_fill(*args)
+        elif kind == "status":
+            self._order_updates[order_id] = (order_id, *args)
+        else:
+            self._errors.append(args[0])
+
+    def _write(self, cur) -> Optional[Tuple[float, float, float]]:
+        """
+        Пишет накопленные изменения (без commit)
+
+        Returns:
+            (equity, free_cash, used_margin) счёта после записи или None, если деньги не менялись
+        """
+        account = None
+        if self._dirty:
+            execute_values(
+                cur,
                 """
                 INSERT INTO live_positions (
                     strategy_universe_id,
@@ -257,194 +559,364 @@ def upsert_position_after_trade(
                     opened_at,
                     updated_at
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, 0, %s, false, %s, %s)
+                VALUES %s
+                ON CONFLICT (strategy_universe_id, symbol, timeframe)
+                DO UPDATE SET direction = EXCLUDED.direction,
+                              quantity = EXCLUDED.quantity,
+                              avg_price = EXCLUDED.avg_price,
+                              last_price = EXCLUDED.last_price,
+                              unrealized_pnl = 0,
+                              realized_pnl = EXCLUDED.realized_pnl,
+                              updated_at = EXCLUDED.updated_at
                 """,
-                (
+                [
+                    (p.strategy_universe_id, p.symbol, p.timeframe, p.direction, p.quantity,
+                     p.avg_price, p.last_price, p.realized_pnl, p.opened_at, p.updated_at)
+                    for p in (self.positions[key] for key in self._dirty)
+                ],
+                template="(%s, %s, %s, %s, %s, %s, %s, 0, %s, false, %s, %s)",
+            )
+
+        if self._trades:
+            execute_values(
+                cur,
+                """
+                INSERT INTO live_trades (
+                    live_order_id,
                     strategy_universe_id,
                     symbol,
                     timeframe,
-                    direction,
-                    qty,
-                    avg_price,
+                    side,
+                    quantity,
                     price,
-                    realized_pnl,
-                    now_ts,
-                    now_ts,
-                ),
+                    fee,
+                    executed_at,
+                    trade_type,
+                    created_at
+                )
+                VALUES %s
+                """,
+                self._trades,
+                template="(%s, %s, %s, %s, %s, %s, %s, %s, now(), %s, now())",
             )
-            return
 
-        # существующая позиция
-        pos_id = row["id"]
-        direction = row["direction"]
-        qty = float(row["quantity"])
-        avg_price = float(row["avg_price"])
-        realized_pnl = float(row["realized_pnl"])
+        if self._order_updates:
+            execute_values(
+                cur,
+                """
+                UPDATE live_orders o
+                SET status = v.status,
+                    broker_order_id = COALESCE(v.broker_order_id, o.broker_order_id),
+                    updated_at = now()
+                FROM (VALUES %s) AS v (id, status, broker_order_id)
+                WHERE o.id = v.id
+                """,
+                list(self._order_updates.values()),
+                template="(%s::bigint, %s::text, %s::text)",
+            )
 
-        if direction == "LONG":
-            if side == "BUY":
-                # добавляем к LONG
-                new_qty = qty + quantity
-                new_avg = (avg_price * qty + price * quantity) / new_qty
-                qty = new_qty
-                avg_price = new_avg
-            else:  # SELL
-                # закрываем часть LONG
-                close_qty = min(qty, quantity)
-                pnl = (price - avg_price) * close_qty
-                realized_pnl += pnl
-                qty = qty - close_qty
-                if qty == 0:
-                    # позиция полностью закрыта
-                    cur.execute(
-                        """
-                        UPDATE live_positions
-                        SET direction = 'FLAT',
-                            quantity = 0,
-                            avg_price = 0,
-                            last_price = %s,
-                            unrealized_pnl = 0,
-                            realized_pnl = %s,
-                            updated_at = %s
-                        WHERE id = %s
-                        """,
-                        (price, realized_pnl, now_ts, pos_id),
-                    )
-                    return
-
-        elif direction == "SHORT":
-            if side == "SELL":
-                # увеличиваем SHORT
-                new_qty = qty + quantity
-                new_avg = (avg_price * qty + price * quantity) / new_qty
-                qty = new_qty
-                avg_price = new_avg
-            else:  # BUY
-                close_qty = min(qty, quantity)
-                pnl = (avg_price - price) * close_qty
-                realized_pnl += pnl
-                qty = qty - close_qty
-                if qty == 0:
-                    cur.execute(
-                        """
-                        UPDATE live_positions
-                        SET direction = 'FLAT',
-                            quantity = 0,
-                            avg_price = 0,
-                            last_price = %s,
-                            unrealized_pnl = 0,
-                            realized_pnl = %s,
-                            updated_at = %s
-                        WHERE id = %s
-                        """,
-                        (price, realized_pnl, now_ts, pos_id),
-                    )
-                    return
-        else:
-            # FLAT -> открываем новую позицию
-            direction = "LONG" if side == "BUY" else "SHORT"
-            qty = quantity
-            avg_price = price
+        if self._errors:
+            execute_values(
+                cur,
+                """
+                INSERT INTO live_errors (
+                    timestamp, source, severity,
+                    strategy_universe_id, symbol, timeframe,
+                    message, details_json
+                )
+                VALUES %s
+                """,
+                self._errors,
+                template="(now(), %s, %s, %s, %s, %s, %s, %s)",
+            )
 
-        # обновляем существующую позицию
-        cur.execute(
-            """
-            UPDATE live_positions
-            SET direction = %s,
-                quantity = %s,
-                avg_price = %s,
-                last_price = %s,
-                unrealized_pnl = 0,
-                realized_pnl = %s,
-                updated_at = %s
-            WHERE id = %s
-            """,
-            (direction, qty, avg_price, price, realized_pnl, now_ts, pos_id),
-        )
+        if self._cash_delta:
+            cur.execute(
+                """
+                INSERT INTO account_state (id, equity, free_cash, used_margin, updated_at)
+                VALUES (1, %s, %s, 0, now())
+                ON CONFLICT (id)
+                DO UPDATE SET free_cash = account_state.free_cash + EXCLUDED.free_cash,
+                              updated_at = EXCLUDED.updated_at
+                RETURNING equity, free_cash, used_margin
+                """,
+                (self._cash_delta, self._cash_delta),
+            )
+            equity, free_cash, used_margin = cur.fetchone()
+            account = (float(equity), float(free_cash), float(used_margin or 0))
+        return account
 
+    def _clear_writes(self):
+        self._dirty.clear()
+        self._cash_delta = 0.0
+        self._trades.clear()
+        self._order_updates.clear()
+        self._errors.clear()
 
-def insert_trade(
-    conn,
-    live_order_id: int,
-    strategy_universe_id: int,
-    symbol: str,
-    timeframe: Optional[str],
-    side: str,
-    quantity: float,
-    price: float,
-    fee: float,
-    trade_type: str,
-):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO live_trades (
-                live_order_id,
-                strategy_universe_id,
-                symbol,
-                timeframe,
-                side,
-                quantity,
-                price,
-                fee,
-                executed_at,
-                trade_type,
-                created_at
+    def _clear_pending(self):
+        self._clear_writes()
+        self._journal.clear()
+        self.latency.clear()
+
+
+# --- Стакан LIMIT/STOP заявок ---
+
+
+@dataclass
+class RestingOrder:
+    """LIMIT/STOP заявка, ожидающая цены (status WORKING / PARTIALLY_FILLED)"""
+    row: Dict[str, Any]  # строка live_orders
+    price: float
+    remaining: float
+    # минутка, на которой заявка выставлена: её high/low заявку не исполняют
+    placed_after: Optional[datetime] = None
+
+
+class SymbolBook:
+    """
+    Заявки одного инструмента в отсортированных списках ключей (price, order_id)
+
+    Минутка с диапазоном [low, high] задевает непрерывный отрезок каждого списка:
+    - BUY LIMIT: price >= low (хвост), SELL LIMIT: price <= high (начало);
+    - BUY STOP: price <= high (начало), SELL STOP: price >= low (хвост).
+    Отрезок находится bisect за O(log n), дальше перебираются только задетые заявки.
+    """
+
+    def __init__(self, last_bar_ts: Optional[datetime] = None):
+        self.buy_limits: List[Tuple[float, int]] = []
+        self.sell_limits: List[Tuple[float, int]] = []
+        self.buy_stops: List[Tuple[float, int]] = []
+        self.sell_stops: List[Tuple[float, int]] = []
+        # последняя обработанная минутка (None - ещё не видели: первая только запоминается)
+        self.last_bar_ts = last_bar_ts
+
+    def keys_for(self, side: str, order_type: str) -> List[Tuple[float, int]]:
+        if order_type == "LIMIT":
+            return self.buy_limits if side == "BUY" else self.sell_limits
+        return self.buy_stops if side == "BUY" else self.sell_stops
+
+    def __len__(self):
+        return len(self.buy_limits) + len(self.sell_limits) + len(self.buy_stops) + len(self.sell_stops)
+
+
+def limit_fill_price(side: str, price: float, bar_open: float) -> float:
+    """LIMIT: по цене заявки или лучше (если минутка открылась гэпом за неё)"""
+    return min(price, bar_open) if side == "BUY" else max(price, bar_open)
+
+
+def stop_fill_price(side: str, price: float, bar_open: float) -> float:
+    """STOP: по цене стопа или хуже (гэп), плюс проскальзывание"""
+    if side == "BUY":
+        return max(price, bar_open) * (1 + SLIPPAGE_RATE)
+    return min(price, bar_open) * (1 - SLIPPAGE_RATE)
+
+
+class OrderBook:
+    """
+    Ожидающие LIMIT/STOP заявки fake_broker по инструментам
+
+    Живёт в памяти, как и Ledger; при старте и после ошибки записи
+    перечитывается из live_orders (WORKING / PARTIALLY_FILLED), исполненный
+    объём восстанавливается по live_trades.
+
+    Частичное исполнение идёт целыми лотами: размер лота берётся из
+    lot_cache (если у инструмента есть lot_history, на момент минутки)
+    или из symbols.lot_size.
+    """
+
+    def __init__(self, lot_cache: Optional[LotSizeCache] = None):
+        self.books: Dict[str, SymbolBook] = {}
+        self.orders: Dict[int, RestingOrder] = {}
+        self.lot_cache = lot_cache
+        self.lot_checked_at = time.monotonic()
+        # {ticker: (symbol_id | None, symbols.lot_size)}
+        self.symbol_lots: Dict[str, Tuple[Optional[int], int]] = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def symbols(self) -> List[str]:
+        return [symbol for symbol, book in self.books.items() if len(book)]
+
+    def load(self, conn):
+        """Загружает ожидающие заявки из БД"""
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                """
+                SELECT o.*, COALESCE(t.filled, 0) AS filled
+                FROM live_orders o
+                LEFT JOIN LATERAL (
+                    SELECT sum(quantity) AS filled
+                    FROM live_trades
+                    WHERE live_order_id = o.id
+                ) t ON true
+                WHERE o.status IN ('WORKING', 'PARTIALLY_FILLED')
+                  AND o.order_type IN ('LIMIT', 'STOP')
+                  AND o.price IS NOT NULL
+                """
             )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, now(), %s, now())
-            """,
-            (
-                live_order_id,
-                strategy_universe_id,
-                symbol,
-                timeframe,
-                side,
-                quantity,
-                price,
-                fee,
-                trade_type,
-            ),
+            rows = cur.fetchall()
+
+        self.books = {}
+        self.orders = {}
+        self.symbol_lots = {}
+        for row in rows:
+            remaining = float(row["quantity"]) - float(row["filled"])
+            if remaining > 0:
+                self.add(row, remaining)
+        self.ensure_lots(conn, self.symbols())
+
+    def ensure_lots(self, conn, tickers):
+        """Догружает размеры лотов инструментов, которых ещё нет в symbol_lots"""
+        missing = sorted(set(tickers) - self.symbol_lots.keys())
+        if not missing:
+            return
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT id, ticker, lot_size FROM symbols WHERE ticker = ANY(%s)", (missing,))
+            for row in cur.fetchall():
+                self.symbol_lots[row["ticker"]] = (int(row["id"]), int(row["lot_size"] or 1))
+        for ticker in missing:
+            self.symbol_lots.setdefault(ticker, (None, 1))
+
+    def refresh_lots(self, conn) -> bool:
+        """Сверяет lot_cache с lot_history не чаще LOT_REFRESH_SECONDS (True - кэш обновлён)"""
+        if self.lot_cache is None or time.monotonic() - self.lot_checked_at < LOT_REFRESH_SECONDS:
+            return False
+        self.lot_checked_at = time.monotonic()
+        if self.lot_cache.refresh(conn):
+            logger.info(f"lot_history обновлена: {self.lot_cache.version.row_count} строк")
+            return True
+        return False
+
+    def lot_size(self, ticker: str, as_of: Optional[datetime] = None) -> int:
+        """Размер лота инструмента (1 - инструмент неизвестен)"""
+        symbol_id, lot_size = self.symbol_lots.get(ticker, (None, 1))
+        if self.lot_cache is not None and symbol_id is not None and self.lot_cache.has_history(symbol_id):
+            lot_size = self.lot_cache.get_lotsize(symbol_id, as_of)
+        return max(lot_size, 1)
+
+    def add(self, order_row, remaining: float, placed_after: Optional[datetime] = None):
+        """Ставит заявку в стакан"""
+        order = RestingOrder(
+            row=dict(order_row),
+            price=float(order_row["price"]),
+            remaining=remaining,
+            placed_after=placed_after,
         )
+        book = self.books.get(order_row["symbol"])
+        if book is None:
+            book = SymbolBook(last_bar_ts=placed_after)
+            self.books[order_row["symbol"]] = book
+        self.orders[order_row["id"]] = order
+        insort(book.keys_for(order_row["side"], order_row["order_type"]), (order.price, order_row["id"]))
+
+    def discard(self, order_ids):
+        """Убирает заявки из стакана (отклонённые при записи)"""
+        for order_id in order_ids:
+            order = self.orders.pop(order_id, None)
+            if order is None:
+                continue
+            row = order.row
+            keys = self.books[row["symbol"]].keys_for(row["side"], row["order_type"])
+            keys.remove((order.price, order_id))
+
+    def match(self, ledger: Ledger, bar: LastBar) -> int:
+        """
+        Исполняет заявки инструмента, задетые новой минуткой (по high/low)
+
+        Объём исполнения за минутку ограничен долей MAX_BAR_VOLUME_FRACTION
+        от её объёма; остаток заявки ждёт следующих минуток (PARTIALLY_FILLED).
+        Частичное исполнение округляется вниз до целого числа лотов; если
+        на лот бюджета минутки не хватает, заявка ждёт дальше.
+
+        Returns:
+            число сделок
+        """
+        book = self.books.get(bar.ticker)
+        if book is None:
+            return 0
+        if book.last_bar_ts is None or bar.bar_timestamp <= book.last_bar_ts:
+            # первая увиденная минутка только запоминается: её могли уже учесть до рестарта
+            if book.last_bar_ts is None:
+                book.last_bar_ts = bar.bar_timestamp
+            return 0
+        book.last_bar_ts = bar.bar_timestamp
+
+        budget = None
+        if bar.volume is not None:
+            budget = float(math.floor(bar.volume * MAX_BAR_VOLUME_FRACTION))
+        lot = self.lot_size(bar.ticker, bar.bar_timestamp)
+
+        inf = float("inf")
+        fills = 0
+        # (ключи, начало, конец, по убыванию цены) - в порядке приоритета исполнения
+        segments = (
+            (book.buy_limits, bisect_left(book.buy_limits, (bar.low, -inf)), len(book.buy_limits), True),
+            (book.sell_limits, 0, bisect_right(book.sell_limits, (bar.high, inf)), False),
+            (book.buy_stops, 0, bisect_right(book.buy_stops, (bar.high, inf)), False),
+            (book.sell_stops, bisect_left(book.sell_stops, (bar.low, -inf)), len(book.sell_stops), True),
+        )
+        for keys, lo, hi, descending in segments:
+            if lo >= hi:
+                continue
+            segment = keys[lo:hi]
+            done = set()
+            for key in (reversed(segment) if descending else segment):
+                if budget is not None and budget < lot:
+                    break
+                order = self.orders[key[1]]
+                if order.placed_after is not None and bar.bar_timestamp <= order.placed_after:
+                    continue
 
+                row = order.row
+                if row["order_type"] == "LIMIT":
+                    exec_price = limit_fill_price(row["side"], order.price, bar.open)
+                else:
+                    exec_price = stop_fill_price(row["side"], order.price, bar.open)
 
-def update_order_status(
-    conn, order_id: int, new_status: str, broker_order_id: Optional[str] = None
-):
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            UPDATE live_orders
-            SET status = %s,
-                broker_order_id = COALESCE(%s, broker_order_id),
-                updated_at = now()
-            WHERE id = %s
-            """,
-            (new_status, broker_order_id, order_id),
-        )
+                qty = order.remaining
+                if budget is not None:
+                    if budget < qty:
+                        qty = math.floor(budget / lot) * lot
+                    budget -= qty
+                order.remaining -= qty
+                status = "FILLED" if order.remaining <= 0 else "PARTIALLY_FILLED"
+                ledger.fill(row, exec_price, exec_price * qty * FEE_RATE, quantity=qty, status=status)
+                fills += 1
+
+                if order.remaining <= 0:
+                    done.add(key)
+                    del self.orders[key[1]]
+
+            if done:
+                keys[lo:hi] = [key for key in segment if key not in done]
+        return fills
 
 
 # --- Основная логика исполнения заявки ---
 
 
-def execute_order(conn, order_row):
+def execute_order(ledger: Ledger, book: OrderBook, order_row):
     """
-    "Исполняет" одну заявку из live_orders.
-    Простая модель: MARKET/LIMIT/STOP — исполняются по последней цене.
+    "Исполняет" одну новую заявку из live_orders в ledger (без обращений к БД).
+
+    MARKET — сразу по последней цене с проскальзыванием.
+    LIMIT/STOP — сразу, если цена уже достигнута (по последней цене),
+    иначе заявка ставится в стакан со статусом WORKING и исполняется
+    по high/low следующих минуток (OrderBook.match).
     """
     order_id = order_row["id"]
     su_id = order_row["strategy_universe_id"]
     symbol = order_row["symbol"]
     timeframe = order_row["timeframe"]
-    side = order_row["side"]  # 'BUY' / 'SELL'
+    side = order_row["side"]
     qty = float(order_row["quantity"])
     order_type = order_row["order_type"]
-    price_hint = order_row["price"]
 
     # текущая рыночная цена
-    market_price = load_last_price_from_candles(conn, symbol)
+    market_price = ledger.prices.get(symbol)
     if market_price is None:
-        log_error(
-            conn,
+        ledger.add_error(
             message="no_market_price_for_symbol",
             severity="warning",
             source="broker",
@@ -453,18 +925,33 @@ def execute_order(conn, order_row):
             timeframe=timeframe,
             details={"order_id": order_id},
         )
-        update_order_status(conn, order_id, "REJECTED")
+        ledger.set_order_status(order_id, "REJECTED")
         return
 
+    slipped_price = market_price * (1 + SLIPPAGE_RATE) if side == "BUY" else market_price * (1 - SLIPPAGE_RATE)
+
     # определяем цену исполнения
-    if order_type == "MARKET":
-        exec_price = market_price
-    elif order_type in ("LIMIT", "STOP"):
-        # упрощение: исполняем по market_price
+    if order_type == "MARKET" or (order_type in ("LIMIT", "STOP") and order_row["price"] is None):
+        # LIMIT/STOP без цены исполняем как MARKET
+        exec_price = slipped_price
+    elif order_type == "LIMIT":
+        limit_price = float(order_row["price"])
+        if (side == "BUY" and limit_price < market_price) or (side == "SELL" and limit_price > market_price):
+            bar = ledger.bars.get(symbol)
+            book.add(order_row, qty, placed_after=bar.bar_timestamp if bar else None)
+            ledger.set_order_status(order_id, "WORKING", broker_order_id=f"fake-{order_id}")
+            return
         exec_price = market_price
+    elif order_type == "STOP":
+        stop_price = float(order_row["price"])
+        if (side == "BUY" and stop_price > market_price) or (side == "SELL" and stop_price < market_price):
+            bar = ledger.bars.get(symbol)
+            book.add(order_row, qty, placed_after=bar.bar_timestamp if bar else None)
+            ledger.set_order_status(order_id, "WORKING", broker_order_id=f"fake-{order_id}")
+            return
+        exec_price = slipped_price
     else:
-        log_error(
-            conn,
+        ledger.add_error(
             message="unsupported_order_type",
             severity="warning",
             source="broker",
@@ -473,113 +960,144 @@ def execute_order(conn, order_row):
             timeframe=timeframe,
             details={"order_id": order_id, "order_type": order_type},
         )
-        update_order_status(conn, order_id, "REJECTED")
+        ledger.set_order_status(order_id, "REJECTED")
         return
 
     # комиссия
-    notional = exec_price * qty
-    fee = notional * FEE_RATE
-
-    # обновляем позиции (важно: передаём timeframe, чтобы не было NULL)
-    upsert_position_after_trade(
-        conn,
-        strategy_universe_id=su_id,
-        symbol=symbol,
-        timeframe=timeframe,
-        side=side,
-        quantity=qty,
-        price=exec_price,
-    )
+    fee = exec_price * qty * FEE_RATE
 
-    # обновляем account_state (упрощённо: кэш +/- notional -/+ fee)
-    equity, free_cash, used_margin = load_account_state(conn)
-    if side == "BUY":
-        free_cash -= notional + fee
-    else:  # SELL
-        free_cash += notional - fee
-
-    # очень грубая модель equity
-    equity = free_cash + used_margin
-    save_account_state(conn, equity, free_cash, used_margin)
-
-    # записываем сделку
-    insert_trade(
-        conn,
-        live_order_id=order_id,
-        strategy_universe_id=su_id,
-        symbol=symbol,
-        timeframe=timeframe,
-        side=side,
-        quantity=qty,
-        price=exec_price,
-        fee=fee,
-        trade_type="FILL",
-    )
-
-    # обновляем статус ордера
-    update_order_status(conn, order_id, "FILLED", broker_order_id=f"fake-{order_id}")
+    # позиция, деньги, сделка и статус заявки - в памяти до flush
+    ledger.fill(order_row, exec_price, fee)
 
 
 # --- Основной цикл демона ---
 
 
+def revalue(conn, ledger: Ledger):
+    """Переоценка позиций и equity (mark_to_market) с обновлением ledger"""
+    result = mark_to_market(conn)
+    if result is not None:
+        ledger.equity, ledger.free_cash, _ = result
+
+
+def match_book(ledger: Ledger, book: OrderBook, symbols) -> int:
+    """
+    Исполняет ожидающие заявки инструментов по их последним минуткам из ledger
+
+    Returns:
+        число сделок
+    """
+    fills = 0
+    for symbol in symbols:
+        bar = ledger.bars.get(symbol)
+        if bar is not None:
+            fills += book.match(ledger, bar)
+    if fills:
+        logger.info(f"Исполнено по стакану: {fills}, ожидающих заявок {len(book)}")
+    return fills
+
+
+def execute_orders(ledger: Ledger, book: OrderBook, orders):
+    """Исполняет пачку новых заявок в ledger; ошибка заявки переводит её в REJECTED"""
+    started = time.perf_counter()
+    for order in orders:
+        try:
+            execute_order(ledger, book, order)
+        except Exception as e:
+            logger.exception(
+                f"Ошибка при исполнении заявки id={order['id']}: {e}"
+            )
+            ledger.add_error(
+                message="Ошибка при исполнении заявки в fake_broker",
+                severity="error",
+                source="broker",
+                strategy_universe_id=order["strategy_universe_id"],
+                symbol=order["symbol"],
+                timeframe=order["timeframe"],
+                details={"order_id": order["id"], "error": str(e)},
+            )
+            # помечаем ордер REJECTED, чтобы не зациклиться
+            ledger.set_order_status(order["id"], "REJECTED")
+
+    if not orders:
+        return
+    # замеры пишутся вместе с пачкой (Ledger.flush)
+    ledger.latency.duration(time.perf_counter() - started, len(orders))
+    now = ledger.clock()
+    for order in orders:
+        ledger.latency.lag(order.get("created_at"), until=now)
+
+
+def run_once(conn, ledger: Ledger, book: OrderBook, executed: Optional[Set[int]] = None) -> int:
+    """
+    Одна итерация: новые заявки и стакан -> сделки одним commit -> переоценка.
+
+    executed - сюда добавляются id обработанных новых заявок (pipeline сверяет с очередью).
+
+    Returns:
+        число новых заявок и исполнений по стакану
+    """
+    book.refresh_lots(conn)
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(
+            """
+            SELECT *
+            FROM live_orders
+            WHERE status = 'NEW'
+            ORDER BY created_at
+            LIMIT %s
+            """,
+            (MAX_ORDERS_PER_BATCH,),
+        )
+        orders = cur.fetchall()
+
+    if not orders and not len(book):
+        revalue(conn, ledger)
+        return 0
+
+    if orders:
+        logger.info(f"Новых заявок: {len(orders)}")
+
+    book_symbols = book.symbols()
+    ledger.refresh_prices(conn, book_symbols + [o["symbol"] for o in orders])
+    book.ensure_lots(conn, [o["symbol"] for o in orders])
+
+    # сначала ожидающие заявки - по новым минуткам
+    fills = match_book(ledger, book, book_symbols)
+    execute_orders(ledger, book, orders)
+
+    # сделки, позиции, деньги и статусы всей пачки - одним commit
+    book.discard(ledger.flush(conn))
+    if executed is not None:
+        executed.update(o["id"] for o in orders)
+    revalue(conn, ledger)
+    return len(orders) + fills
+
+
 def main_loop():
-    conn = get_connection()
+    conn = db_connect(application_name="fake_broker")
     conn.autocommit = False
     logger.info("Старт fake_broker")
 
+    ledger = Ledger()
+    book = OrderBook(LotSizeCache(conn=conn))
+    ledger.load(conn)
+    book.load(conn)
+    conn.commit()
+    logger.info(
+        f"Ledger загружен: позиций {len(ledger.positions)}, free_cash={ledger.free_cash:.2f}, "
+        f"ожидающих заявок {len(book)}"
+    )
+
     try:
         while True:
             try:
-                with conn.cursor(cursor_factory=DictCursor) as cur:
-                    cur.execute(
-                        """
-                        SELECT *
-                        FROM live_orders
-                        WHERE status = 'NEW'
-                        ORDER BY created_at
-                        LIMIT %s
-                        """,
-                        (MAX_ORDERS_PER_BATCH,),
-                    )
-                    orders = cur.fetchall()
-
-                if not orders:
-                    update_service_heartbeat(conn)
-                    conn.commit()
-                    time.sleep(POLL_INTERVAL_SECONDS)
-                    continue
-
-                logger.info(f"Новых заявок: {len(orders)}")
-
-                for order in orders:
-                    try:
-                        execute_order(conn, order)
-                        conn.commit()
-                    except Exception as e:
-                        conn.rollback()
-                        logger.exception(
-                            f"Ошибка при исполнении заявки id={order['id']}: {e}"
-                        )
-                        log_error(
-                            conn,
-                            message="Ошибка при исполнении заявки в fake_broker",
-                            severity="error",
-                            source="broker",
-                            strategy_universe_id=order["strategy_universe_id"],
-                            symbol=order["symbol"],
-                            timeframe=order["timeframe"],
-                            details={"order_id": order["id"], "error": str(e)},
-                        )
-                        # помечаем ордер REJECTED, чтобы не зациклиться
-                        update_order_status(conn, order["id"], "REJECTED")
-                        conn.commit()
-
+                run_once(conn, ledger, book)
                 update_service_heartbeat(conn)
                 conn.commit()
 
             except Exception as e:
-                conn.rollback()
+                conn = recover_connection(conn)
                 logger.exception(f"Ошибка в основном цикле fake_broker: {e}")
                 log_error(
                     conn,
@@ -588,6 +1106,14 @@ def main_loop():
                     source="broker",
                     details={"error": str(e)},
                 )
+                try:
+                    # память могла уйти вперёд незаписанной пачки - перечитываем из БД
+                    ledger.load(conn)
+                    book.load(conn)
+                    conn.commit()
+                except Exception as load_error:
+                    conn = recover_connection(conn)
+                    logger.error(f"Не удалось перечитать ledger: {load_error}")
                 time.sleep(5)
 
             time.sleep(POLL_INTERVAL_SECONDS)
@@ -18,50 +18,64 @@ health_monitor.py
             - 'execution_engine'
             - 'fake_broker' (и в будущем 'broker_adapter')
         * лаг рыночных данных:
-            - now - max(timestamp) в candles_1m.
+            - now - самая свежая минутка в last_prices (одна строка на инструмент),
+              а если она пуста - datafeed_state.last_1m_timestamp;
+        * данные по каждому инструменту:
+            - отставание его последней минутки (last_prices) от самой свежей минутки рынка;
+            - разрывы минуток за последний час (векторно по всем инструментам сразу).
+        * задержки цепочки по latency_trace (пишут сами демоны, см. utils_latency):
+            - p50/p95/p99 (по гистограммам пачек), среднее и максимум длительности обработки
+              и задержки от предыдущего этапа по каждому этапу за скользящее окно -
+              в service_status.details_json['latency'].
     - Реагировать на события:
-        * если сервис не подаёт heartbeat дольше порога:
+        * если сервис не подаёт heartbeat дольше порога или heartbeat есть (status='busy'),
+          но текущая итерация идёт дольше того же порога (зависла):
             - записать live_errors(message='<service>_down', severity='critical');
             - для брокера (fake_broker/broker_adapter) и execution_engine при необходимости
               выставить allow_trading=false или allow_new_positions=false.
         * если лаг минуток превышает порог:
             - записать live_errors(message='bar_too_old', severity='warning');
             - включить safe-mode: allow_new_positions=false, пока лаг не вернётся в норму.
+        * если данные одного инструмента устарели или рваные:
+            - записать live_errors(message='symbol_data_stale' / 'symbol_minutes_missing');
+            - запретить новые позиции только по нему (symbol_blocks, читает execution_engine),
+              пока данные не придут в норму.
     - Гарантировать, что ни один сбой не останавливает health_monitor.
 
 Ключевые допущения:
     - service_status(service_name, last_heartbeat, status, details_json) уже заполняется демонами.
     - trading_control(id=1) управляет глобальными флагами allow_trading и allow_new_positions.
-    - candles_1m(timestamp, symbol_id, ...) хранит минутные бары в UTC.
+    - candles_1m(timestamp, symbol_id, ...) хранит минутные бары в UTC;
+      last_prices и datafeed_state обновляются вместе с ними (datafeed_aggregator).
     - Все времена сравниваются в UTC (timezone-aware datetime).
 
 Архитектура:
     - Один процесс с циклом:
         1. Читает текущее время (UTC).
-        2. Проверяет heartbeats сервисов.
-        3. Проверяет лаг candles_1m.
-        4. При необходимости обновляет trading_control и пишет live_errors.
+        2. Читает heartbeats всех сервисов одним запросом и свежесть данных - одним запросом.
+        3. Проверяет лаг данных и heartbeats, копя события и изменения флагов в памяти.
+        4. Пишет trading_control (если флаги изменились), live_errors и перцентили задержек
+           одной транзакцией; старые замеры latency_trace удаляет.
         5. Спит заданный интервал и повторяет.
 """
 
 import logging
+import os
 import sys
 import time
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
-import psycopg2
-from psycopg2.extras import DictCursor, Json
+import numpy as np
 
-# --- Конфиг PostgreSQL ---
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
 
-PG_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 5432,
-    "dbname": "stock_db",
-    "user": "postgres",
-    "password": "123",
-}
+from psycopg2.extras import DictCursor, Json, execute_values
+
+from db_pool import connect as db_connect, recover_connection
+from utils_latency import histogram_percentile
 
 # --- Пороговые значения (настраиваются при необходимости) ---
 
@@ -76,6 +90,21 @@ TIMEOUTS = {
 # Порог safe-mode по лагу минутных свечей (секунд)
 CANDLES_1M_MAX_LAG = 120  # 2 минуты
 
+# Отставание инструмента от самой свежей минутки рынка, после которого он блокируется (секунд)
+SYMBOL_MAX_LAG_SECONDS = 300
+
+# Окно поиска пропущенных минуток по инструментам (минут до самой свежей минутки рынка)
+GAP_WINDOW_MINUTES = 60
+
+# Сколько минут рынка подряд без минутки инструмента считается разрывом данных
+MISSING_RUN_MINUTES = 10
+
+# Окно перцентилей задержек из latency_trace (минут)
+LATENCY_WINDOW_MINUTES = 15
+
+# Сколько хранить замеры latency_trace (часов)
+LATENCY_RETENTION_HOURS = 24
+
 # Пауза между проверками (секунд)
 POLL_INTERVAL_SECONDS = 10
 
@@ -95,16 +124,6 @@ logger.addHandler(handler)
 
 # --- Работа с БД ---
 
-def get_connection():
-    return psycopg2.connect(
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        dbname=PG_CONFIG["dbname"],
-        user=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-    )
-
-
 def log_error(conn, message: str, severity: str, source: str,
               details: Optional[Dict[str, Any]] = None):
     try:
@@ -130,29 +149,28 @@ def log_error(conn, message: str, severity: str, source: str,
         logger.error(f"Не удалось записать ошибку в live_errors: {e}")
 
 
-def get_service_status(conn, service_name: str) -> Optional[Dict[str, Any]]:
+def load_service_statuses(conn, service_names) -> Dict[str, Dict[str, Any]]:
+    """Статусы сервисов одним запросом: {service_name: строка service_status}"""
     with conn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute(
             """
             SELECT service_name, last_heartbeat, status, details_json
             FROM service_status
-            WHERE service_name = %s
+            WHERE service_name = ANY(%s)
             """,
-            (service_name,),
+            (list(service_names),),
         )
-        row = cur.fetchone()
-        if not row:
-            return None
-        return dict(row)
+        return {row["service_name"]: dict(row) for row in cur.fetchall()}
 
 
-def load_trading_control(conn) -> Dict[str, Any]:
+def load_trading_control(conn, for_update: bool = False) -> Dict[str, Any]:
     with conn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute(
-            """
+            f"""
             SELECT id, allow_trading, allow_new_positions, comment
             FROM trading_control
             WHERE id = 1
+            {"FOR UPDATE" if for_update else ""}
             """
         )
         row = cur.fetchone()
@@ -162,6 +180,7 @@ def load_trading_control(conn) -> Dict[str, Any]:
 
 
 def save_trading_control(conn, allow_trading: bool, allow_new_positions: bool, comment: Optional[str]):
+    """Записывает флаги trading_control (без commit: в транзакции цикла проверок)"""
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -175,35 +194,322 @@ def save_trading_control(conn, allow_trading: bool, allow_new_positions: bool, c
             """,
             (allow_trading, allow_new_positions, comment),
         )
-    conn.commit()
 
 
-def get_latest_candles_1m_ts(conn) -> Optional[datetime]:
+def write_events(conn, events: List[tuple]):
+    """Пишет события цикла в live_errors одним запросом (без commit)"""
+    if not events:
+        return
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            INSERT INTO live_errors (
+                timestamp, source, severity,
+                strategy_universe_id, symbol, timeframe,
+                message, details_json
+            )
+            VALUES %s
+            """,
+            [
+                (source, severity, symbol, message, Json(details) if details is not None else None)
+                for message, severity, source, symbol, details in events
+            ],
+            template="(now(), %s, %s, NULL, %s, NULL, %s, %s)",
+        )
+
+
+def get_latest_data_ts(conn) -> Optional[datetime]:
+    """
+    Время самой свежей минутки: по last_prices (одна строка на инструмент),
+    при пустой last_prices - datafeed_state.last_1m_timestamp
+    """
     with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute("SELECT max(timestamp) AS max_ts FROM candles_1m")
+        cur.execute(
+            """
+            SELECT (SELECT max(bar_timestamp) FROM last_prices) AS last_price_ts,
+                   (SELECT last_1m_timestamp FROM datafeed_state WHERE id = 1) AS feed_ts
+            """
+        )
         row = cur.fetchone()
-        if not row or row["max_ts"] is None:
-            return None
-        ts = row["max_ts"]
-        if ts.tzinfo is None:
-            ts = ts.replace(tzinfo=timezone.utc)
-        return ts
+    ts = row["last_price_ts"] if row["last_price_ts"] is not None else row["feed_ts"]
+    if ts is None:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
 
 
-# --- Проверки ---
+def load_symbol_freshness(conn) -> List[Dict[str, Any]]:
+    """Последняя минутка по каждому инструменту (last_prices: одна строка на инструмент)"""
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute("SELECT symbol_id, ticker, bar_timestamp FROM last_prices")
+        return [dict(row) for row in cur.fetchall()]
+
+
+def load_recent_minutes(conn, symbol_ids: List[int], since: datetime) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Минутки инструментов после since (по индексу candles_1m (symbol_id, timestamp))
+
+    Returns:
+        (symbol_id, минута с эпохи) - два массива одной длины
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT c.symbol_id, c.timestamp
+            FROM unnest(%s::integer[]) AS s (symbol_id)
+            CROSS JOIN LATERAL (
+                SELECT symbol_id, timestamp
+                FROM candles_1m
+                WHERE symbol_id = s.symbol_id
+                  AND timestamp > %s
+            ) c
+            """,
+            (symbol_ids, since),
+        )
+        rows = cur.fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    symbol_col, ts_col = zip(*rows)
+    minutes = np.array(ts_col, dtype="datetime64[m]").astype(np.int64)
+    return np.array(symbol_col, dtype=np.int64), minutes
+
+
+def load_symbol_blocks(conn) -> Dict[int, str]:
+    """Текущие блокировки инструментов: {symbol_id: reason}"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT symbol_id, reason FROM symbol_blocks")
+        return dict(cur.fetchall())
 
-def check_service_heartbeat(conn, now_utc: datetime, service_name: str, timeout_sec: int):
-    status = get_service_status(conn, service_name)
+
+def save_symbol_blocks(conn, blocked: Dict[int, Tuple[str, str, Dict[str, Any]]]):
+    """
+    Приводит symbol_blocks к набору blocked (без commit)
+
+    Args:
+        blocked: {symbol_id: (ticker, reason, details)}; остальные блокировки снимаются
+    """
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM symbol_blocks WHERE NOT (symbol_id = ANY(%s))", (list(blocked),))
+        if blocked:
+            execute_values(
+                cur,
+                """
+                INSERT INTO symbol_blocks (symbol_id, ticker, reason, details_json, blocked_at, updated_at)
+                VALUES %s
+                ON CONFLICT (symbol_id)
+                DO UPDATE SET reason = EXCLUDED.reason,
+                              details_json = EXCLUDED.details_json,
+                              updated_at = EXCLUDED.updated_at
+                """,
+                [
+                    (symbol_id, ticker, reason, Json(details))
+                    for symbol_id, (ticker, reason, details) in blocked.items()
+                ],
+                template="(%s, %s, %s, %s, now(), now())",
+            )
+
+
+def load_latency_percentiles(conn, since: datetime) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Перцентили замеров latency_trace после since
+
+    Строки latency_trace - агрегаты пачек (utils_latency): гистограммы окна
+    складываются по корзинам, перцентили оцениваются по сумме.
+
+    Returns:
+        {stage: {metric: {"count", "mean_ms", "max_ms", "p50_ms", "p95_ms", "p99_ms"}}}
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            WITH w AS (
+                SELECT * FROM latency_trace WHERE recorded_at >= %s
+            ),
+            h AS (
+                SELECT stage, metric, array_agg(n ORDER BY i) AS buckets
+                FROM (
+                    SELECT w.stage, w.metric, b.i, sum(b.n)::bigint AS n
+                    FROM w, unnest(w.buckets) WITH ORDINALITY AS b (n, i)
+                    GROUP BY w.stage, w.metric, b.i
+                ) per_bucket
+                GROUP BY stage, metric
+            )
+            SELECT w.stage, w.metric, sum(w.samples), min(w.min_ms), max(w.max_ms), sum(w.sum_ms), h.buckets
+            FROM w
+            JOIN h USING (stage, metric)
+            GROUP BY w.stage, w.metric, h.buckets
+            """,
+            (since,),
+        )
+        rows = cur.fetchall()
+
+    stats: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for stage, metric, count, min_ms, max_ms, sum_ms, buckets in rows:
+        stats.setdefault(stage, {})[metric] = {
+            "count": int(count),
+            "mean_ms": round(sum_ms / count, 1),
+            "max_ms": round(max_ms, 1),
+            **{
+                f"p{int(q * 100)}_ms": round(histogram_percentile(buckets, min_ms, max_ms, q), 1)
+                for q in (0.5, 0.95, 0.99)
+            },
+        }
+    return stats
+
+
+def save_latency_stats(conn, stats: Dict[str, Dict[str, Dict[str, Any]]], now_utc: datetime):
+    """
+    Кладёт перцентили этапов в service_status.details_json['latency'] (без commit)
+
+    Остальные ключи details_json сервиса не трогаются; этап без замеров в окне
+    получает latency без метрик.
+    """
+    rows = [
+        (service_name, Json({
+            "window_minutes": LATENCY_WINDOW_MINUTES,
+            "computed_at": now_utc.isoformat(),
+            **stats.get(service_name, {}),
+        }))
+        for service_name in TIMEOUTS
+    ]
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            UPDATE service_status s
+            SET details_json = COALESCE(s.details_json, '{}'::jsonb) || jsonb_build_object('latency', v.latency)
+            FROM (VALUES %s) AS v (service_name, latency)
+            WHERE s.service_name = v.service_name
+            """,
+            rows,
+            template="(%s, %s::jsonb)",
+        )
+
+
+def purge_latency_trace(conn, before: datetime):
+    """Удаляет замеры latency_trace старше before (без commit)"""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM latency_trace WHERE recorded_at < %s", (before,))
+
+
+def longest_missing_runs(symbol_ids: np.ndarray, row_symbols: np.ndarray,
+                         minutes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Самый длинный разрыв минуток по каждому инструменту (векторно, без цикла по инструментам)
+
+    Сетка - минуты, в которые была минутка хотя бы у одного инструмента: перерывы
+    торгов и закрытие рынка разрывами не считаются.
+
+    Args:
+        symbol_ids: инструменты (строки результата), по возрастанию
+        row_symbols, minutes: минутки окна - symbol_id и минута с эпохи
+
+    Returns:
+        (длина самого длинного разрыва в минутах сетки, его первая минута; -1 если разрыва нет)
+    """
+    n = len(symbol_ids)
+    grid = np.unique(minutes)
+    if n == 0 or grid.size == 0:
+        return np.zeros(n, dtype=np.int64), np.full(n, -1, dtype=np.int64)
+
+    present = np.zeros((n, grid.size), dtype=bool)
+    present[np.searchsorted(symbol_ids, row_symbols), np.searchsorted(grid, minutes)] = True
+
+    # границы серий пропусков: +1 - начало, -1 - конец (nonzero идёт по строкам, начала и концы парны)
+    edges = np.diff(np.pad((~present).astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)
+    lengths = end_cols - start_cols
+
+    longest = np.zeros(n, dtype=np.int64)
+    first_minute = np.full(n, -1, dtype=np.int64)
+    if lengths.size:
+        # по каждой строке - самая длинная серия (сортировка по строке, затем по убыванию длины)
+        order = np.lexsort((-lengths, start_rows))
+        rows_sorted = start_rows[order]
+        first = order[np.r_[True, rows_sorted[1:] != rows_sorted[:-1]]]
+        longest[start_rows[first]] = lengths[first]
+        first_minute[start_rows[first]] = grid[start_cols[first]]
+    return longest, first_minute
+
+
+def check_symbol_data(freshness: List[Dict[str, Any]], row_symbols: np.ndarray, minutes: np.ndarray,
+                      current_blocks: Dict[int, str], events: List[tuple]) -> Dict[int, Tuple[str, str, Dict[str, Any]]]:
+    """
+    Инструменты с устаревшими или рваными данными
+
+    Устаревший - последняя минутка отстаёт от самой свежей минутки рынка больше
+    SYMBOL_MAX_LAG_SECONDS (сравнение с рынком, а не с часами: после закрытия торгов
+    инструменты не блокируются). Рваный - за окно GAP_WINDOW_MINUTES пропущено
+    MISSING_RUN_MINUTES минут рынка подряд.
+
+    Returns:
+        {symbol_id: (ticker, reason, details)}; новые блокировки и снятые - в events
+    """
+    if not freshness:
+        return {}
+
+    freshness = sorted(freshness, key=lambda row: row["symbol_id"])
+    symbol_ids = np.array([row["symbol_id"] for row in freshness], dtype=np.int64)
+    last_ts = np.array([row["bar_timestamp"] for row in freshness], dtype="datetime64[s]")
+    lag_seconds = (last_ts.max() - last_ts).astype(np.int64)
+    longest, first_minute = longest_missing_runs(symbol_ids, row_symbols, minutes)
+
+    blocked: Dict[int, Tuple[str, str, Dict[str, Any]]] = {}
+    for i in np.nonzero((lag_seconds > SYMBOL_MAX_LAG_SECONDS) | (longest >= MISSING_RUN_MINUTES))[0]:
+        row = freshness[i]
+        details = {
+            "lag_seconds": int(lag_seconds[i]),
+            "last_bar": row["bar_timestamp"].isoformat(),
+            "missing_minutes": int(longest[i]),
+        }
+        if lag_seconds[i] > SYMBOL_MAX_LAG_SECONDS:
+            reason = "symbol_data_stale"
+        else:
+            reason = "symbol_minutes_missing"
+            details["missing_from"] = str(np.datetime64(int(first_minute[i]), "m"))
+        blocked[row["symbol_id"]] = (row["ticker"], reason, details)
+
+        if current_blocks.get(row["symbol_id"]) != reason:
+            logger.warning(f"{row['ticker']}: {reason} {details}, запрещаем новые позиции по инструменту")
+            events.append((reason, "warning", "system", row["ticker"], details))
+
+    tickers = {row["symbol_id"]: row["ticker"] for row in freshness}
+    for symbol_id in current_blocks.keys() - blocked.keys():
+        ticker = tickers.get(symbol_id)
+        logger.info(f"{ticker}: данные в норме, снимаем запрет новых позиций по инструменту")
+        events.append(("symbol_data_recovered", "info", "system", ticker, None))
+
+    return blocked
+
+
+# --- Проверки ---
+#
+# Проверки не пишут в БД: события копятся в events [(message, severity, source, symbol, details)],
+# изменения флагов - в control (копия trading_control); записывает их run_checks.
+
+def busy_seconds(status: Dict[str, Any], lag: float) -> float:
+    """
+    Сколько идёт текущая итерация сервиса (0 - не занят)
+
+    async_runner пишет status='busy' и details_json['iteration_seconds'] на момент
+    heartbeat; к нему добавляется время, прошедшее с этого heartbeat.
+    """
+    details = status.get("details_json") or {}
+    if status.get("status") != "busy" or "iteration_seconds" not in details:
+        return 0.0
+    return float(details["iteration_seconds"]) + max(lag, 0.0)
+
+
+def check_service_heartbeat(status: Optional[Dict[str, Any]], now_utc: datetime,
+                            service_name: str, timeout_sec: int,
+                            control: Dict[str, Any], events: List[tuple]):
     if not status:
         # сервис ещё ни разу не писал heartbeat — можно просто предупредить
         logger.warning(f"service_status для {service_name} не найден")
-        log_error(
-            conn,
-            message=f"{service_name}_status_missing",
-            severity="warning",
-            source="system",
-            details=None,
-        )
+        events.append((f"{service_name}_status_missing", "warning", "system", None, None))
         return
 
     last_hb = status["last_heartbeat"]
@@ -211,91 +517,124 @@ def check_service_heartbeat(conn, now_utc: datetime, service_name: str, timeout_
         last_hb = last_hb.replace(tzinfo=timezone.utc)
 
     lag = (now_utc - last_hb).total_seconds()
-    if lag > timeout_sec:
-        # критический лаг
-        logger.error(f"{service_name} down: lag={lag:.1f} sec > {timeout_sec}")
-        log_error(
-            conn,
-            message=f"{service_name}_down",
-            severity="critical",
-            source="system",
-            details={"service_name": service_name, "lag_seconds": lag},
-        )
+    busy_for = busy_seconds(status, lag)
+    if lag > timeout_sec or busy_for > timeout_sec:
+        # критический лаг или итерация, которая висит дольше таймаута (heartbeat при этом свежий)
+        logger.error(f"{service_name} down: lag={lag:.1f} sec, busy={busy_for:.1f} sec > {timeout_sec}")
+        events.append((
+            f"{service_name}_down",
+            "critical",
+            "system",
+            None,
+            {"service_name": service_name, "lag_seconds": lag, "busy_seconds": busy_for},
+        ))
 
         # реакция для брокера/исполнения: стоп-торговля
         if service_name in ("fake_broker", "broker_adapter", "execution_engine"):
-            tc = load_trading_control(conn)
-            if tc["allow_trading"]:
+            if control["allow_trading"]:
                 logger.warning("Устанавливаем allow_trading=false из-за падения брокера/исполнения")
-                save_trading_control(
-                    conn,
+                control.update(
                     allow_trading=False,
                     allow_new_positions=False,
                     comment=f"auto stop-trading by health_monitor: {service_name}_down",
                 )
 
 
-def check_candles_1m_lag(conn, now_utc: datetime):
-    latest_ts = get_latest_candles_1m_ts(conn)
+def check_data_lag(latest_ts: Optional[datetime], now_utc: datetime,
+                   control: Dict[str, Any], events: List[tuple]):
     if latest_ts is None:
-        logger.warning("Нет данных в candles_1m, пропускаем проверку лага")
+        logger.warning("Нет данных в last_prices/datafeed_state, пропускаем проверку лага")
         return
 
     lag = (now_utc - latest_ts).total_seconds()
     if lag > CANDLES_1M_MAX_LAG:
         logger.warning(f"Лаг минутных свечей {lag:.1f} sec > {CANDLES_1M_MAX_LAG}, включаем safe-mode")
-        log_error(
-            conn,
-            message="bar_too_old",
-            severity="warning",
-            source="system",
-            details={"lag_seconds": lag, "latest_ts": latest_ts.isoformat()},
-        )
+        events.append((
+            "bar_too_old",
+            "warning",
+            "system",
+            None,
+            {"lag_seconds": lag, "latest_ts": latest_ts.isoformat()},
+        ))
 
         # включаем safe-mode: запрещаем новые позиции, но не выключаем полностью торговлю
-        tc = load_trading_control(conn)
-        if tc["allow_new_positions"]:
-            save_trading_control(
-                conn,
-                allow_trading=tc["allow_trading"],
+        if control["allow_new_positions"]:
+            control.update(
                 allow_new_positions=False,
                 comment="safe-mode by health_monitor: candles_1m lag too high",
             )
     else:
         # если лаг пришёл в норму, можно (опционально) автоматически снять safe-mode
-        tc = load_trading_control(conn)
-        if not tc["allow_new_positions"]:
+        if not control["allow_new_positions"]:
             logger.info("Лаг минуток нормализовался, можно разрешить новые позиции (выключить safe-mode)")
-            save_trading_control(
-                conn,
-                allow_trading=tc["allow_trading"],
+            control.update(
                 allow_new_positions=True,
                 comment="safe-mode disabled: candles_1m lag back to normal",
             )
 
 
+def run_checks(conn, now_utc: datetime):
+    """
+    Один цикл проверок: чтения пачкой, решения в памяти, одна транзакция записи
+    (trading_control, symbol_blocks, live_errors, перцентили задержек в service_status)
+
+    Лаг данных проверяется раньше heartbeats: если в этом же цикле упал брокер
+    или исполнение, stop-trading не будет отменён снятием safe-mode.
+    """
+    statuses = load_service_statuses(conn, TIMEOUTS)
+    latest_ts = get_latest_data_ts(conn)
+    current = load_trading_control(conn, for_update=True)
+
+    freshness = load_symbol_freshness(conn)
+    row_symbols, minutes = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if freshness:
+        market_ts = max(row["bar_timestamp"] for row in freshness)
+        row_symbols, minutes = load_recent_minutes(
+            conn,
+            [row["symbol_id"] for row in freshness],
+            market_ts - timedelta(minutes=GAP_WINDOW_MINUTES),
+        )
+
+    control = dict(current)
+    events: List[tuple] = []
+
+    blocked = check_symbol_data(freshness, row_symbols, minutes, load_symbol_blocks(conn), events)
+    check_data_lag(latest_ts, now_utc, control, events)
+    for service_name, timeout_sec in TIMEOUTS.items():
+        check_service_heartbeat(statuses.get(service_name), now_utc, service_name, timeout_sec,
+                                control, events)
+
+    if control != current:
+        save_trading_control(
+            conn,
+            allow_trading=control["allow_trading"],
+            allow_new_positions=control["allow_new_positions"],
+            comment=control["comment"],
+        )
+    save_symbol_blocks(conn, blocked)
+    write_events(conn, events)
+    save_latency_stats(
+        conn,
+        load_latency_percentiles(conn, now_utc - timedelta(minutes=LATENCY_WINDOW_MINUTES)),
+        now_utc,
+    )
+    purge_latency_trace(conn, now_utc - timedelta(hours=LATENCY_RETENTION_HOURS))
+    conn.commit()
+
+
 # --- Основной цикл демона ---
 
 def main_loop():
-    conn = get_connection()
+    conn = db_connect(application_name="health_monitor")
     conn.autocommit = False
     logger.info("Старт health_monitor")
 
     try:
         while True:
             try:
-                now_utc = datetime.now(timezone.utc)
-
-                # Проверка сервисов по heartbeat
-                for service_name, timeout_sec in TIMEOUTS.items():
-                    check_service_heartbeat(conn, now_utc, service_name, timeout_sec)
-
-                # Проверка лага минуток
-                check_candles_1m_lag(conn, now_utc)
-
-                conn.commit()
+                run_checks(conn, datetime.now(timezone.utc))
             except Exception as e:
-                conn.rollback()
+                conn = recover_connection(conn)
                 logger.exception(f"Ошибка в health_monitor: {e}")
                 log_error(
                     conn,
@@ -0,0 +1,536 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pipeline.py
+
+Назначение:
+    Режим одного процесса для небольших установок: datafeed_aggregator → strategy_runner →
+    execution_engine → fake_broker работают как этапы-потоки, связанные очередями
+    в памяти (queue.Queue), а не опросом таблиц друг друга.
+
+Цели:
+    - Убрать по секунде-другой задержки на каждом переходе и лишние чтения из БД:
+      закрытые бары, сигналы, заявки и последние минутки передаются дальше по цепочке
+      прямо из памяти.
+    - Таблицы по-прежнему пишутся (свечи, last_prices, live_signals, live_orders,
+      live_trades, live_positions, account_state, bar_state, service_status) -
+      для аудита, health_monitor и восстановления, но горячий путь их обратно не читает.
+
+Устройство:
+    - FeedStage опрашивает candles_1m (её пишет внешняя загрузка) и отдаёт:
+      последние минутки - в очередь брокера, закрытые бары - в очередь стратегий.
+    - StrategyStage держит историю баров в памяти (из candles_xx читается только
+      один раз на инструмент/ТФ) и передаёт записанные сигналы в очередь исполнения.
+    - ExecutionStage обрабатывает сигналы из очереди пачкой (снимок риска, заявки
+      одним commit) и передаёт записанные заявки брокеру.
+    - BrokerStage исполняет заявки и стакан по минуткам из очереди в Ledger/OrderBook,
+      пишет результат одной транзакцией и переоценивает позиции.
+    - У каждого этапа своё соединение с БД и heartbeat под именем своего демона.
+
+Восстановление:
+    - При старте, до запуска потоков, цепочка догоняет то, что осталось в таблицах:
+      бары после bar_state (strategy_runner.run_once), необработанные сигналы
+      (execution_engine.run_once), заявки NEW (fake_broker.run_once).
+    - Потоки запускаются от конца цепочки к началу, каждый после готовности
+      следующего, поэтому строка из таблиц и та же строка из очереди не исполняются дважды.
+    - Если пачка этапа исполнения или брокера не записалась, её строки остаются
+      в таблицах необработанными: этап после ошибки дочитывает их оттуда
+      (execution_engine.run_once / fake_broker.run_once до нуля), а те же строки,
+      пришедшие позже из очереди, пропускает по id.
+
+Ключевые допущения:
+    - Pipeline заменяет отдельные демоны strategy_runner, execution_engine и fake_broker
+      (и datafeed_aggregator) - одновременно с ними его не запускают.
+    - Позиции и заявки для контекста стратегий, снимок риска и переоценка
+      по-прежнему берутся из БД: это состояние, а не поток данных между этапами.
+
+Запуск:
+    python demons/pipeline.py
+"""
+
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from datetime import timezone
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from db_pool import connect as db_connect, recover_connection
+from utils_lot import LotSizeCache
+from utils_prices import LastBar, latest_by_symbol
+
+import datafeed_aggregator
+import execution_engine
+import fake_broker
+import strategy_runner
+
+# live-стратегии импортируют demons.strategy_runner: отдаём им уже загруженный модуль, а не вторую копию
+sys.modules.setdefault("demons.strategy_runner", strategy_runner)
+
+# Пауза между опросами candles_1m (секунд)
+FEED_POLL_SECONDS = 1
+
+# Сколько ждать сообщения в очереди, прежде чем заняться heartbeat/остановкой (секунд)
+QUEUE_WAIT_SECONDS = 1
+
+# Размер очередей между этапами (при заполнении производитель ждёт потребителя)
+QUEUE_MAXSIZE = 10_000
+
+# Как часто этапы обновляют heartbeat своего демона (секунд)
+HEARTBEAT_INTERVAL_SECONDS = 10
+
+# Пауза после ошибки этапа (секунд)
+ERROR_PAUSE_SECONDS = 5
+
+# --- Логирование ---
+
+logger = logging.getLogger("pipeline")
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter(
+    fmt="%(asctime)s [%(levelname)s] %(threadName)s: %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def load_symbol_tickers(conn) -> Dict[int, str]:
+    """{symbol_id: ticker} по таблице symbols"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, ticker FROM symbols")
+        return {symbol_id: ticker for symbol_id, ticker in cur.fetchall()}
+
+
+def skip_drained(rows: list, drained: Set[int]) -> list:
+    """
+    Убирает из пачки очереди строки, уже обработанные дочиткой из БД после ошибки
+
+    id забывается при первой встрече: строка приходит из очереди не больше одного раза.
+    """
+    kept = []
+    for row in rows:
+        if row["id"] in drained:
+            drained.discard(row["id"])
+        else:
+            kept.append(row)
+    return kept
+
+
+# --- Этапы ---
+
+
+class Stage(threading.Thread):
+    """
+    Этап pipeline: поток со своим соединением, входной очередью и heartbeat
+
+    Подклассы задают daemon_module (модуль демона: log_error, update_service_heartbeat),
+    start_stage (загрузка состояния) и handle (обработка сообщения из inbox).
+    """
+
+    daemon_module = None
+
+    def __init__(self, name: str, inbox: Optional[queue.Queue], outbox: Optional[queue.Queue],
+                 stop_event: threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stop_event = stop_event
+        self.ready = threading.Event()
+        self.conn = None
+        self._heartbeat_at = 0.0
+
+    def run(self):
+        self.conn = db_connect(application_name=f"pipeline_{self.name}")
+        self.conn.autocommit = False
+        try:
+            while not self.stop_event.is_set() and not self._guarded(self.start_stage):
+                pass
+            self.ready.set()
+            logger.info("этап готов")
+
+            while not self.stop_event.is_set():
+                self._guarded(self.step)
+                self.heartbeat()
+        finally:
+            self.conn.close()
+            logger.info("этап остановлен")
+
+    def _guarded(self, fn) -> bool:
+        """Вызывает fn; ошибку логирует в live_errors от имени демона этапа"""
+        try:
+            fn()
+            return True
+        except Exception as e:
+            self.conn = recover_connection(self.conn)
+            logger.exception(f"Ошибка этапа {self.name}: {e}")
+            self.daemon_module.log_error(
+                self.conn,
+                message=f"Ошибка этапа pipeline {self.name}",
+                severity="error",
+                details={"error": str(e)},
+            )
+            try:
+                self.on_error()
+            except Exception as reset_error:
+                self.conn = recover_connection(self.conn)
+                logger.error(f"Не удалось восстановить состояние этапа {self.name}: {reset_error}")
+            time.sleep(ERROR_PAUSE_SECONDS)
+            return False
+
+    def heartbeat(self):
+        if time.monotonic() - self._heartbeat_at >= HEARTBEAT_INTERVAL_SECONDS:
+            self._heartbeat_at = time.monotonic()
+            self.daemon_module.update_service_heartbeat(self.conn)
+
+    def start_stage(self):
+        pass
+
+    def step(self):
+        try:
+            item = self.inbox.get(timeout=QUEUE_WAIT_SECONDS)
+        except queue.Empty:
+            return
+        self.handle(item)
+
+    def handle(self, item):
+        raise NotImplementedError
+
+    def on_error(self):
+        pass
+
+
+class FeedStage(Stage):
+    """Минутки из candles_1m -> агрегаты; минутки - брокеру, закрытые бары - стратегиям"""
+
+    daemon_module = datafeed_aggregator
+
+    def __init__(self, broker_queue: queue.Queue, strategy_queue: queue.Queue,
+                 stop_event: threading.Event):
+        super().__init__("feed", None, strategy_queue, stop_event)
+        self.broker_queue = broker_queue
+        self.gap_threshold = datafeed_aggregator.DEFAULT_GAP_THRESHOLD
+        self.last_1m_ts = None
+        self.tickers: Dict[int, str] = {}
+
+    def start_stage(self):
+        self.gap_threshold = datafeed_aggregator.get_gap_threshold(self.conn)
+        self.last_1m_ts = datafeed_aggregator.load_last_state(self.conn)
+        if self.last_1m_ts is None:
+            self.last_1m_ts = datafeed_aggregator.init_last_1m_timestamp(self.conn)
+            datafeed_aggregator.save_last_1m_timestamp(self.conn, self.last_1m_ts)
+        self.tickers = load_symbol_tickers(self.conn)
+        self.conn.commit()
+
+    def step(self):
+        rows = datafeed_aggregator.fetch_new_minutes(self.conn, self.last_1m_ts)
+        if not rows:
+            self.conn.commit()
+            time.sleep(FEED_POLL_SECONDS)
+            return
+
+        # агрегаты, last_prices и прогресс записаны (commit) до передачи дальше
+        self.last_1m_ts, closed = datafeed_aggregator.process_minutes(
+            self.conn, rows, self.last_1m_ts, self.gap_threshold
+        )
+
+        prices = latest_by_symbol(rows)
+        if any(symbol_id not in self.tickers for symbol_id, *_ in prices):
+            self.tickers = load_symbol_tickers(self.conn)
+            self.conn.commit()
+
+        bars: Dict[str, LastBar] = {}
+        for symbol_id, ts, price, open_, high, low, volume in prices:
+            ticker = self.tickers.get(symbol_id)
+            if ticker is None:
+                continue
+            bars[ticker] = LastBar(
+                ticker=ticker,
+                bar_timestamp=ts,
+                price=price,
+                open=open_ if open_ is not None else price,
+                high=high if high is not None else price,
+                low=low if low is not None else price,
+                volume=volume,
+            )
+
+        # брокер получает минутки раньше, чем появятся заявки по закрытым на них барам
+        self.broker_queue.put(("bars", bars))
+        if closed:
+            self.outbox.put(closed)
+
+
+class StrategyStage(Stage):
+    """Закрытые бары -> стратегии (история в памяти) -> сигналы в очередь исполнения"""
+
+    daemon_module = strategy_runner
+
+    def __init__(self, inbox: queue.Queue, outbox: queue.Queue, stop_event: threading.Event):
+        super().__init__("strategy", inbox, outbox, stop_event)
+        self.tickers: Dict[int, str] = {}
+        # history[(timeframe, symbol_id)] = последние HISTORY_BARS баров
+        self.history: Dict[Tuple[str, int], Deque[strategy_runner.BarInfo]] = {}
+
+    def start_stage(self):
+        self.tickers = load_symbol_tickers(self.conn)
+        self.conn.commit()
+
+    def on_error(self):
+        # история могла разойтись с candles_xx - перечитаем при следующем баре
+        self.history.clear()
+
+    def handle(self, closed):
+        signals = []
+        last_ts = {}
+        for tf_name, agg, is_gap, gap_dir in closed:
+            tf_cfg = strategy_runner.TF_CONFIG.get(tf_name)
+            if tf_cfg is None:
+                continue
+
+            bar = strategy_runner.BarInfo(
+                timestamp=agg.end_ts.replace(tzinfo=timezone.utc),
+                open=float(agg.open),
+                high=float(agg.high),
+                low=float(agg.low),
+                close=float(agg.close),
+                volume=float(agg.volume),
+                is_gap=is_gap,
+                gap_dir=gap_dir,
+            )
+            signals.extend(self.process_bar(tf_name, tf_cfg["table"], agg.symbol_id, bar, agg.ingested_at))
+            if tf_name not in last_ts or bar.timestamp > last_ts[tf_name]:
+                last_ts[tf_name] = bar.timestamp
+
+        if signals:
+            self.outbox.put(signals)
+        for tf_name, ts in last_ts.items():
+            strategy_runner.save_last_bar_timestamp(self.conn, tf_name, ts)
+
+    def process_bar(self, timeframe: str, tf_table: str, symbol_id: int,
+                    bar: strategy_runner.BarInfo, ingested_at=None) -> list:
+        ticker = self.tickers.get(symbol_id)
+        if ticker is None:
+            self.tickers = load_symbol_tickers(self.conn)
+            ticker = self.tickers.get(symbol_id)
+            if ticker is None:
+                logger.warning(f"Не найден ticker для symbol_id={symbol_id}, пропускаем бар.")
+                return []
+
+        strategies = strategy_runner.load_strategies_for_symbol_tf(self.conn, ticker, timeframe)
+        key = (timeframe, symbol_id)
+        history = self.history.get(key)
+        if strategies and history is None:
+            # candles_xx читается один раз на инструмент/ТФ, дальше история копится в памяти
+            history = deque(
+                strategy_runner.load_bar_history(
+                    self.conn, tf_table, symbol_id, bar.timestamp, strategy_runner.HISTORY_BARS
+                ),
+                maxlen=strategy_runner.HISTORY_BARS,
+            )
+            self.history[key] = history
+
+        signals = []
+        if strategies:
+            signals = strategy_runner.run_strategies_for_bar(
+                self.conn, timeframe, ticker, bar, list(history), strategies, ingested_at
+            )
+        if history is not None:
+            history.append(bar)
+        self.conn.commit()
+        return signals
+
+
+class ExecutionStage(Stage):
+    """Сигналы из очереди -> заявки одним commit -> заявки в очередь брокера"""
+
+    daemon_module = execution_engine
+
+    def __init__(self, inbox: queue.Queue, outbox: queue.Queue, stop_event: threading.Event):
+        super().__init__("execution", inbox, outbox, stop_event)
+        self.lot_cache: Optional[LotSizeCache] = None
+        self._lot_checked_at = 0.0
+        # id сигналов, обработанных дочиткой из live_signals после ошибки
+        self.drained: Set[int] = set()
+
+    def start_stage(self):
+        self.lot_cache = LotSizeCache(conn=self.conn)
+        self.conn.commit()
+        self._lot_checked_at = time.monotonic()
+
+    def on_error(self):
+        # сигналы упавшей пачки остались в live_signals (processed = false) - дочитываем
+        # их из БД, как execution_engine; заявки по ним брокер заберёт из live_orders
+        if self.lot_cache is None:
+            return
+        while execution_engine.run_once(self.conn, self.lot_cache, "pipeline_execution",
+                                        processed=self.drained):
+            pass
+        self.conn.commit()
+        self.outbox.put(("backlog", None))
+
+    def handle(self, signals):
+        # всё, что уже накопилось в очереди, - одной пачкой
+        while len(signals) < execution_engine.MAX_SIGNALS_PER_BATCH:
+            try:
+                signals.extend(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        if self.drained:
+            signals = skip_drained(signals, self.drained)
+            if not signals:
+                return
+
+        if time.monotonic() - self._lot_checked_at >= execution_engine.LOT_REFRESH_SECONDS:
+            self._lot_checked_at = time.monotonic()
+            self.lot_cache.refresh(self.conn)
+
+        orders = execution_engine.process_signal_batch(self.conn, signals, self.lot_cache)
+        logger.info(f"Сигналов: {len(signals)}, заявок: {len(orders)}")
+        if orders:
+            self.outbox.put(("orders", orders))
+
+
+class BrokerStage(Stage):
+    """Минутки и заявки из очереди -> Ledger/OrderBook -> одна транзакция -> переоценка"""
+
+    daemon_module = fake_broker
+
+    def __init__(self, inbox: queue.Queue, stop_event: threading.Event):
+        super().__init__("broker", inbox, None, stop_event)
+        self.ledger = fake_broker.Ledger()
+        self.book = fake_broker.OrderBook()
+        # id заявок, исполненных дочиткой из live_orders после ошибки
+        self.drained: Set[int] = set()
+
+    def start_stage(self):
+        # лоты из lot_history, как у этапа исполнения: частичные исполнения - лотами заявки
+        self.book = fake_broker.OrderBook(LotSizeCache(conn=self.conn))
+        self.ledger.load(self.conn)
+        self.book.load(self.conn)
+        self.conn.commit()
+        # заявки NEW, оставшиеся в live_orders, - до того как заявки пойдут через очередь
+        self.drain_backlog()
+        self.drained.clear()
+        logger.info(
+            f"Ledger загружен: позиций {len(self.ledger.positions)}, "
+            f"free_cash={self.ledger.free_cash:.2f}, ожидающих заявок {len(self.book)}"
+        )
+
+    def on_error(self):
+        # память могла уйти вперёд незаписанной пачки - перечитываем из БД
+        self.ledger.load(self.conn)
+        self.book.load(self.conn)
+        self.conn.commit()
+        self.drain_backlog()
+
+    def drain_backlog(self):
+        """Заявки NEW из live_orders (не дошедшие через очередь) - как fake_broker"""
+        while fake_broker.run_once(self.conn, self.ledger, self.book, executed=self.drained):
+            pass
+        self.conn.commit()
+
+    def handle(self, item):
+        kind, payload = item
+        self.book.refresh_lots(self.conn)
+        if kind == "backlog":
+            # этап исполнения дочитал сигналы после ошибки: заявки - только в live_orders
+            self.drain_backlog()
+            return
+        if kind == "bars":
+            self.ledger.apply_bars(payload)
+            symbols = [symbol for symbol in self.book.symbols() if symbol in payload]
+            if not fake_broker.match_book(self.ledger, self.book, symbols):
+                fake_broker.revalue(self.conn, self.ledger)
+                self.conn.commit()
+                return
+        else:
+            if self.drained:
+                payload = skip_drained(payload, self.drained)
+                if not payload:
+                    return
+            missing = [o["symbol"] for o in payload if o["symbol"] not in self.ledger.prices]
+            if missing:
+                # инструмент ещё не приходил от FeedStage после старта
+                self.ledger.refresh_prices(self.conn, missing)
+            self.book.ensure_lots(self.conn, [o["symbol"] for o in payload])
+            logger.info(f"Новых заявок: {len(payload)}")
+            fake_broker.execute_orders(self.ledger, self.book, payload)
+
+        self.book.discard(self.ledger.flush(self.conn))
+        fake_broker.revalue(self.conn, self.ledger)
+        self.conn.commit()
+
+
+# --- Запуск ---
+
+
+def recover_backlog():
+    """Догоняет бары и сигналы, оставшиеся в таблицах от прошлого запуска"""
+    conn = db_connect(application_name="pipeline_recovery")
+    conn.autocommit = False
+    try:
+        # только ТФ с bar_state: без него strategy_runner прогнал бы всю историю
+        for timeframe, cfg in strategy_runner.TF_CONFIG.items():
+            last_ts = strategy_runner.get_last_bar_timestamp(conn, timeframe)
+            if last_ts is None:
+                continue
+            new_last_ts = strategy_runner.process_bar_for_timeframe(conn, timeframe, cfg["table"], last_ts)
+            if new_last_ts and new_last_ts > last_ts:
+                strategy_runner.save_last_bar_timestamp(conn, timeframe, new_last_ts)
+
+        lot_cache = LotSizeCache(conn=conn)
+        conn.commit()
+        while execution_engine.run_once(conn, lot_cache, "pipeline"):
+            pass
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main():
+    logger.info("Старт pipeline")
+    recover_backlog()
+
+    stop_event = threading.Event()
+    signal_queue: queue.Queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+    broker_queue: queue.Queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+    bar_queue: queue.Queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+
+    # от конца цепочки к началу: потребитель готов раньше, чем производитель начнёт писать
+    stages: List[Stage] = [
+        BrokerStage(broker_queue, stop_event),
+        ExecutionStage(signal_queue, broker_queue, stop_event),
+        StrategyStage(bar_queue, signal_queue, stop_event),
+        FeedStage(broker_queue, bar_queue, stop_event),
+    ]
+
+    try:
+        for stage in stages:
+            stage.start()
+            while not stage.ready.wait(timeout=1):
+                if not stage.is_alive():
+                    raise RuntimeError(f"Этап {stage.name} завершился при старте")
+        logger.info("Все этапы запущены")
+
+        # join с таймаутом, чтобы Ctrl+C доходил до главного потока
+        while all(stage.is_alive() for stage in stages):
+            time.sleep(1)
+        logger.error("Один из этапов завершился, останавливаем pipeline")
+    except KeyboardInterrupt:
+        logger.info("Остановка pipeline по Ctrl+C")
+    finally:
+        stop_event.set()
+        for stage in stages:
+            if stage.is_alive():
+                stage.join(timeout=QUEUE_WAIT_SECONDS + FEED_POLL_SECONDS + 5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+replay.py
+
+Назначение:
+    Детерминированный прогон live-цепочки по истории на максимальной скорости:
+    datafeed_aggregator → strategy_runner → execution_engine → fake_broker
+    в одном процессе, через те же функции run_once, без пауз.
+
+Цели:
+    - Сверить live-порт стратегии с её бэктестом, не дожидаясь реального времени.
+    - Подавать минутки из public.candles_1m за период по одной (или по --step-minutes)
+      и после каждой прогонять все этапы цепочки до конца.
+    - Показать скорость (минуток/сек) и итог: сигналы, заявки, сделки, позиции, equity.
+
+Устройство:
+    - Временная схема replay_<pid>: таблицы создаются как
+      CREATE UNLOGGED TABLE ... (LIKE public.<таблица> INCLUDING ALL), со своими
+      последовательностями; справочники (symbols, strategy_*, lot_history)
+      копируются с данными, свечи старших ТФ - за период прогрева (--warmup-days).
+    - search_path = replay_<pid>, pg_catalog: демоны пишут только во временную схему,
+      таблица, которую забыли скопировать, даёт ошибку, а не запись в public.
+    - Симулированные часы: в схеме создаётся функция now(), возвращающая
+      current_setting('replay.clock'); так как схема стоит в search_path раньше
+      pg_catalog, now() в запросах демонов возвращает время истории.
+      Python-часть (размеры лотов, opened_at позиций) получает то же время явно.
+    - Замеры задержек (utils_latency) выключены: у истории нет реального времени поступления.
+    - По окончании схема удаляется (кроме --keep-schema).
+
+Ключевые допущения:
+    - Время минуток (naive) трактуется как UTC, как в strategy_runner.
+    - Значения по умолчанию колонок (DEFAULT now()) ссылаются на pg_catalog.now()
+      и остаются реальным временем - демоны передают время явно там, где оно важно.
+
+Запуск:
+    python demons/replay.py --start 2024-01-01 --end 2025-01-01 --symbols SBER,GAZP
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.append(BASE_DIR)
+
+from psycopg2.extras import execute_values
+
+import utils_latency
+from db_pool import connect as db_connect
+from utils_lot import LotSizeCache
+
+import datafeed_aggregator
+import execution_engine
+import fake_broker
+import strategy_runner
+
+# live-стратегии импортируют demons.strategy_runner: отдаём им уже загруженный модуль, а не вторую копию
+sys.modules.setdefault("demons.strategy_runner", strategy_runner)
+
+# Таблицы, создаваемые пустыми (состояние цепочки)
+STATE_TABLES = (
+    "candles_1m",
+    "candles_5m",
+    "candles_15m",
+    "candles_30m",
+    "candles_1h",
+    "candles_4h",
+    "candles_1d",
+    "datafeed_state",
+    "bar_state",
+    "last_prices",
+    "live_signals",
+    "live_orders",
+    "live_trades",
+    "live_positions",
+    "live_errors",
+    "service_status",
+    "account_state",
+    "trading_control",
+    "symbol_blocks",
+)
+
+# Справочники, копируемые с данными
+REFERENCE_TABLES = (
+    "symbols",
+    "lot_history",
+    "strategy_catalog",
+    "strategy_params",
+    "strategy_universe",
+    "timeframe_weights",
+)
+
+# Стартовый капитал по умолчанию
+DEFAULT_CASH = 1_000_000
+
+# Сколько дней старших ТФ до начала периода копировать для истории стратегий
+DEFAULT_WARMUP_DAYS = 60
+
+# Размер порции при чтении истории из public.candles_1m
+SOURCE_FETCH_SIZE = 10_000
+
+# Логгеры демонов: в replay по умолчанию только предупреждения
+DAEMON_LOGGERS = ("datafeed_aggregator", "strategy_runner", "execution_engine", "fake_broker")
+
+# --- Логирование ---
+
+logger = logging.getLogger("replay")
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter(
+    fmt="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+# --- Временная схема ---
+
+
+def create_replay_schema(conn, schema: str, symbol_ids: List[int], start: datetime,
+                         warmup_days: int, cash: float):
+    """Создаёт временную схему с копиями таблиц, часами и стартовым состоянием (commit)"""
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        for table in STATE_TABLES + REFERENCE_TABLES:
+            cur.execute(f"CREATE UNLOGGED TABLE {schema}.{table} (LIKE public.{table} INCLUDING ALL)")
+
+        # свои последовательности вместо public.*_seq
+        cur.execute(
+            """
+            SELECT table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema = %s AND column_default LIKE 'nextval(%%'
+            """,
+            (schema,),
+        )
+        for table, column in cur.fetchall():
+            seq = f"{schema}.{table}_{column}_seq"
+            cur.execute(f"CREATE SEQUENCE {seq} OWNED BY {schema}.{table}.{column}")
+            cur.execute(f"ALTER TABLE {schema}.{table} ALTER COLUMN {column} SET DEFAULT nextval('{seq}')")
+
+        for table in REFERENCE_TABLES:
+            cur.execute(f"INSERT INTO {schema}.{table} SELECT * FROM public.{table}")
+        cur.execute(
+            """
+            SELECT c.table_name, c.column_name
+            FROM information_schema.columns c
+            WHERE c.table_schema = %s AND c.column_default LIKE 'nextval(%%' AND c.table_name = ANY(%s)
+            """,
+            (schema, list(REFERENCE_TABLES)),
+        )
+        for table, column in cur.fetchall():
+            cur.execute(
+                f"SELECT setval('{schema}.{table}_{column}_seq', COALESCE(max({column}), 0) + 1, false) "
+                f"FROM {schema}.{table}"
+            )
+
+        # история старших ТФ для стратегий и детектора гэпов
+        warmup_from = start - timedelta(days=warmup_days)
+        for cfg in datafeed_aggregator.TIMEFRAMES.values():
+            table = cfg["table"]
+            cur.execute(
+                f"""
+                INSERT INTO {schema}.{table}
+                SELECT * FROM public.{table}
+                WHERE symbol_id = ANY(%s) AND timestamp >= %s AND timestamp < %s
+                """,
+                (symbol_ids, warmup_from, start),
+            )
+
+        # индексы под запросы демонов, которые в public обходятся полным сканом
+        for table in ("candles_1m",) + tuple(cfg["table"] for cfg in datafeed_aggregator.TIMEFRAMES.values()):
+            cur.execute(f"CREATE INDEX ON {schema}.{table} (timestamp)")
+            cur.execute(f"CREATE INDEX ON {schema}.{table} (symbol_id, timestamp)")
+
+        # симулированные часы
+        cur.execute(
+            f"""
+            CREATE FUNCTION {schema}.now() RETURNS timestamp with time zone
+            LANGUAGE sql STABLE
+            AS $$ SELECT current_setting('replay.clock')::timestamp with time zone $$
+            """
+        )
+
+        # стартовое состояние: деньги, торговля разрешена, стратегии начинают с начала периода
+        cur.execute(
+            f"INSERT INTO {schema}.account_state (id, equity, free_cash, used_margin, updated_at) "
+            f"VALUES (1, %s, %s, 0, %s)",
+            (cash, cash, start.replace(tzinfo=timezone.utc)),
+        )
+        cur.execute(
+            f"INSERT INTO {schema}.trading_control (id, allow_trading, allow_new_positions) VALUES (1, true, true)"
+        )
+        for timeframe in strategy_runner.TF_CONFIG:
+            cur.execute(
+                f"INSERT INTO {schema}.bar_state (service_name, timeframe, last_bar_timestamp, updated_at) "
+                f"VALUES ('strategy_runner', %s, %s, now())",
+                (timeframe, start.replace(tzinfo=timezone.utc)),
+            )
+    conn.commit()
+
+
+def use_replay_schema(conn, schema: str):
+    """Переключает сессию на временную схему (её now() раньше pg_catalog.now())"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT set_config('search_path', %s, false)", (f"{schema}, pg_catalog",))
+    conn.commit()
+
+
+def set_clock(conn, ts: datetime):
+    """Симулированное время для now() в запросах демонов"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT set_config('replay.clock', %s, false)", (ts.isoformat(),))
+
+
+def drop_replay_schema(conn, schema: str):
+    with conn.cursor() as cur:
+        cur.execute("SELECT set_config('search_path', 'public', false)")
+        cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    conn.commit()
+
+
+# --- Источник истории ---
+
+
+def resolve_symbol_ids(conn, tickers: Optional[List[str]]) -> Dict[int, str]:
+    """symbol_id -> ticker; по умолчанию - инструменты активных paper/live стратегий"""
+    with conn.cursor() as cur:
+        if tickers:
+            cur.execute("SELECT id, ticker FROM public.symbols WHERE ticker = ANY(%s)", (tickers,))
+        else:
+            cur.execute(
+                """
+                SELECT DISTINCT s.id, s.ticker
+                FROM public.symbols s
+                JOIN public.strategy_universe su ON su.symbol = s.ticker
+                WHERE su.enabled = true AND su.mode IN ('paper', 'live')
+                """
+            )
+        return {int(symbol_id): ticker for symbol_id, ticker in cur.fetchall()}
+
+
+def iter_minute_steps(src_conn, symbol_ids: List[int], start: datetime, end: datetime, step_minutes: int):
+    """Минутки периода порциями по step_minutes минут истории (по возрастанию времени)"""
+    with src_conn.cursor(name="replay_candles_1m") as cur:
+        cur.itersize = SOURCE_FETCH_SIZE
+        cur.execute(
+            """
+            SELECT symbol_id, timestamp, open, high, low, close, volume
+            FROM public.candles_1m
+            WHERE symbol_id = ANY(%s) AND timestamp >= %s AND timestamp < %s
+            ORDER BY timestamp, symbol_id
+            """,
+            (symbol_ids, start, end),
+        )
+        step = timedelta(minutes=step_minutes)
+        batch = []
+        batch_end = None
+        for row in cur:
+            if batch_end is not None and row[1] >= batch_end:
+                yield batch
+                batch = []
+            if not batch:
+                batch_end = row[1] + step
+            batch.append(row)
+        if batch:
+            yield batch
+
+
+# --- Прогон ---
+
+
+def run_replay(conn, src_conn, symbol_ids: List[int], start: datetime, end: datetime,
+               step_minutes: int) -> Dict[str, float]:
+    """
+    Прогоняет историю через все этапы цепочки
+
+    Returns:
+        {'candles', 'steps', 'seconds'}
+    """
+    utils_latency.ENABLED = False
+    gap_threshold = datafeed_aggregator.get_gap_threshold(conn)
+    # схема прогона пустая: состояние агрегатора начинается с минутки до start
+    last_1m_ts = start - timedelta(minutes=1)
+
+    lot_cache = LotSizeCache(conn=conn)
+    clock_ts = start.replace(tzinfo=timezone.utc)
+    ledger = fake_broker.Ledger(clock=lambda: clock_ts)
+    book = fake_broker.OrderBook(lot_cache)
+    ledger.load(conn)
+    conn.commit()
+
+    # бары старших ТФ закрываются только первой минуткой нового интервала младшего из них
+    min_tf_minutes = min(cfg["minutes"] for cfg in datafeed_aggregator.TIMEFRAMES.values())
+    last_bucket = None
+
+    candles = 0
+    steps = 0
+    started = time.perf_counter()
+
+    for batch in iter_minute_steps(src_conn, symbol_ids, start, end, step_minutes):
+        # время закрытия последней минутки порции
+        clock_ts = (batch[-1][1] + timedelta(minutes=1)).replace(tzinfo=timezone.utc)
+        set_clock(conn, clock_ts)
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                "INSERT INTO candles_1m (symbol_id, timestamp, open, high, low, close, volume) VALUES %s",
+                batch,
+            )
+        conn.commit()
+
+        last_1m_ts, _ = datafeed_aggregator.run_once(conn, last_1m_ts, gap_threshold)
+        conn.commit()
+        bucket = datafeed_aggregator.floor_timestamp_to_bucket(batch[-1][1], min_tf_minutes)
+        if bucket != last_bucket:
+            # без закрытых баров strategy_runner нечего делать - не опрашиваем его таблицы
+            last_bucket = bucket
+            strategy_runner.run_once(conn)
+            conn.commit()
+        while execution_engine.run_once(conn, lot_cache, "replay", now=clock_ts):
+            conn.commit()
+        conn.commit()
+        while fake_broker.run_once(conn, ledger, book):
+            conn.commit()
+        conn.commit()
+
+        candles += len(batch)
+        steps += 1
+        if steps % 10_000 == 0:
+            elapsed = time.perf_counter() - started
+            logger.info(f"{clock_ts:%Y-%m-%d %H:%M}: минуток {candles}, {candles / elapsed:.0f} минуток/сек")
+
+    return {"candles": candles, "steps": steps, "seconds": time.perf_counter() - started}
+
+
+def report(conn, stats: Dict[str, float]):
+    """Скорость и итог прогона в лог"""
+    seconds = max(stats["seconds"], 1e-9)
+    logger.info(
+        f"Прогон: минуток {stats['candles']}, шагов {stats['steps']}, {seconds:.1f} сек, "
+        f"{stats['candles'] / seconds:.0f} минуток/сек ({stats['steps'] / seconds:.0f} шагов/сек)"
+    )
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM live_signals")
+        logger.info(f"Сигналов: {cur.fetchone()[0]}")
+
+        cur.execute("SELECT status, count(*) FROM live_orders GROUP BY status ORDER BY status")
+        logger.info("Заявки: " + (", ".join(f"{status}={n}" for status, n in cur.fetchall()) or "нет"))
+
+        cur.execute("SELECT count(*), COALESCE(sum(fee), 0) FROM live_trades")
+        trades, fees = cur.fetchone()
+        logger.info(f"Сделок: {trades}, комиссия: {float(fees):.2f}")
+
+        cur.execute("SELECT equity, free_cash FROM account_state WHERE id = 1")
+        row = cur.fetchone()
+        if row:
+            logger.info(f"Счёт: equity={float(row[0]):.2f}, free_cash={float(row[1]):.2f}")
+
+        cur.execute(
+            """
+            SELECT strategy_universe_id, symbol, direction, quantity, realized_pnl, unrealized_pnl
+            FROM live_positions
+            ORDER BY strategy_universe_id, symbol
+            """
+        )
+        for su_id, symbol, direction, qty, realized, unrealized in cur.fetchall():
+            logger.info(
+                f"  su={su_id} {symbol}: {direction} {float(qty):g}, "
+                f"realized={float(realized):.2f}, unrealized={float(unrealized):.2f}"
+            )
+
+        cur.execute("SELECT message, count(*) FROM live_errors GROUP BY message ORDER BY count(*) DESC LIMIT 10")
+        for message, n in cur.fetchall():
+            logger.info(f"  live_errors: {message} x{n}")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay: прогон live-цепочки по истории candles_1m")
+    parser.add_argument("--start", required=True, type=datetime.fromisoformat, help="начало периода (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, type=datetime.fromisoformat, help="конец периода, не включая")
+    parser.add_argument("--symbols", default=None,
+                        help="тикеры через запятую (по умолчанию - инструменты paper/live стратегий)")
+    parser.add_argument("--cash", type=float, default=DEFAULT_CASH, help="стартовый капитал")
+    parser.add_argument("--warmup-days", type=int, default=DEFAULT_WARMUP_DAYS,
+                        help="дней истории старших ТФ до начала периода")
+    parser.add_argument("--step-minutes", type=int, default=1,
+                        help="сколько минут истории подавать за шаг (1 - как в реальном времени)")
+    parser.add_argument("--keep-schema", action="store_true", help="не удалять временную схему")
+    parser.add_argument("--verbose", action="store_true", help="INFO-логи демонов")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        for name in DAEMON_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    schema = f"replay_{os.getpid()}"
+    conn = db_connect(application_name="replay")
+    src_conn = db_connect(application_name="replay_source")
+
+    try:
+        tickers = [t.strip() for t in args.symbols.split(",")] if args.symbols else None
+        symbols = resolve_symbol_ids(conn, tickers)
+        conn.commit()
+        if not symbols:
+            logger.error("Нет инструментов для прогона")
+            return
+        logger.info(f"Схема {schema}, инструменты: {', '.join(sorted(symbols.values()))}")
+
+        create_replay_schema(conn, schema, sorted(symbols), args.start, args.warmup_days, args.cash)
+        use_replay_schema(conn, schema)
+
+        stats = run_replay(conn, src_conn, sorted(symbols), args.start, args.end, args.step_minutes)
+        report(conn, stats)
+
+    finally:
+        src_conn.close()
+        try:
+            if args.keep_schema:
+                logger.info(f"Схема {schema} сохранена")
+            else:
+                conn.rollback()
+                drop_replay_schema(conn, schema)
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        logger.info("Остановка replay по Ctrl+C")
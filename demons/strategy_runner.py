@@ -36,7 +36,9 @@ strategy_runner.py
 
 - Обновлять:
   - bar_state(service_name='strategy_runner', timeframe, last_bar_timestamp);
-  - service_status(service_name='strategy_runner') — heartbeat и статус.
+  - service_status(service_name='strategy_runner') — heartbeat и статус;
+  - latency_trace(stage='strategy_runner') — длительность прогона стратегий по бару
+    и задержка от записи бара в candles_xx (ingested_at) до его сигналов.
 """
 
 import importlib
@@ -53,18 +55,10 @@ from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
 
-import psycopg2
 from psycopg2.extras import DictCursor, Json
 
-# --- Конфиг подключения к PostgreSQL (под твою БД) ---
-
-PG_CONFIG = {
-    "host": "127.0.0.1",
-    "port": 5432,
-    "dbname": "stock_db",
-    "user": "postgres",
-    "password": "123",
-}
+from db_pool import connect as db_connect, recover_connection
+from utils_latency import LatencyRecorder
 
 # --- Таймфреймы и соответствующие таблицы свечей ---
 
@@ -110,7 +104,7 @@ class PositionInfo:
 class OrderInfo:
     id: int
     side: str  # 'BUY' / 'SELL'
-    status: str  # 'NEW' / 'PARTIALLY_FILLED' / 'FILLED' / ...
+    status: str  # 'NEW' / 'WORKING' / 'PARTIALLY_FILLED' / 'FILLED' / ...
     quantity: float
     price: Optional[float]
 
@@ -144,16 +138,6 @@ class StrategyContext:
 # --- Работа с БД ---
 
 
-def get_connection():
-    return psycopg2.connect(
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        dbname=PG_CONFIG["dbname"],
-        user=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-    )
-
-
 def log_error(
     conn,
     message,
@@ -321,7 +305,7 @@ def load_orders(conn, strategy_universe_id: int, symbol: str) -> List[OrderInfo]
             FROM live_orders
             WHERE strategy_universe_id = %s
               AND symbol = %s
-              AND status IN ('NEW', 'PARTIALLY_FILLED')
+              AND status IN ('NEW', 'WORKING', 'PARTIALLY_FILLED')
             """,
             (strategy_universe_id, symbol),
         )
@@ -378,7 +362,8 @@ def insert_signal(
     signal: Dict[str, Any],
     signal_source: str = "strategy",
 ):
-    with conn.cursor() as cur:
+    """Записывает сигнал в live_signals (с commit) и возвращает записанную строку"""
+    with conn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute(
             """
             INSERT INTO live_signals (
@@ -395,6 +380,7 @@ def insert_signal(
                 created_at
             )
             VALUES (%s, %s, %s, %s, now(), %s, %s, %s, %s, false, now())
+            RETURNING *
             """,
             (
                 strategy_universe_id,
@@ -407,7 +393,9 @@ def insert_signal(
                 bar.is_gap,
             ),
         )
+        row = cur.fetchone()
     conn.commit()
+    return row
 
 
 # --- Загрузка/исполнение стратегий через strategy_catalog ---
@@ -481,6 +469,150 @@ def get_strategy_instance(su_row) -> Optional[Any]:
 # --- Основная логика обработки баров и запуск стратегий ---
 
 
+def run_strategies_for_bar(
+    conn, timeframe: str, ticker: str, bar: BarInfo,
+    history: List[BarInfo], strategies, ingested_at: Optional[datetime] = None,
+) -> list:
+    """
+    Запускает стратегии на одном закрытом баре и пишет их сигналы в live_signals.
+
+    Args:
+        strategies: строки strategy_universe (load_strategies_for_symbol_tf)
+        history: бары до текущего (не включая bar)
+        ingested_at: время записи бара в candles_xx (для задержки в latency_trace)
+
+    Returns:
+        записанные сигналы (строки live_signals)
+    """
+    signals = []
+    started = time.perf_counter()
+
+    for s_row in strategies:
+        su_id = s_row["id"]
+        strategy_id_code = s_row["strategy_id"]
+        params = s_row["params_json"] or {}
+        risk_per_trade = s_row.get("risk_per_trade")
+        max_dd = s_row.get("max_drawdown_fraction")
+        gap_thr = s_row.get("gap_threshold_fraction")
+
+        position = load_position(conn, su_id, ticker)
+        orders = load_orders(conn, su_id, ticker)
+
+        ctx = StrategyContext(
+            symbol=ticker,
+            timeframe=timeframe,
+            bar=bar,
+            history=history,
+            position=position,
+            orders=orders,
+            params=params,
+            risk_per_trade=risk_per_trade,
+            max_drawdown_fraction=max_dd,
+            gap_threshold_fraction=gap_thr,
+        )
+
+        strategy_instance = get_strategy_instance(s_row)
+        if strategy_instance is None:
+            log_error(
+                conn,
+                message=f"Стратегия {strategy_id_code} не найдена/не загружена",
+                severity="error",
+                source="strategy",
+                strategy_universe_id=su_id,
+                symbol=ticker,
+                timeframe=timeframe,
+                details={
+                    "strategy_id": strategy_id_code,
+                    "py_module": s_row["py_module"],
+                    "py_class": s_row["py_class"],
+                    "live_py_module": s_row.get("live_py_module"),
+                    "live_py_class": s_row.get("live_py_class"),
+                },
+            )
+            continue
+
+        if not hasattr(strategy_instance, "on_bar"):
+            log_error(
+                conn,
+                message=f"Стратегия {strategy_id_code} не имеет метода on_bar",
+                severity="error",
+                source="strategy",
+                strategy_universe_id=su_id,
+                symbol=ticker,
+                timeframe=timeframe,
+                details={
+                    "strategy_id": strategy_id_code,
+                    "py_module": s_row["py_module"],
+                    "py_class": s_row["py_class"],
+                    "live_py_module": s_row.get("live_py_module"),
+                    "live_py_class": s_row.get("live_py_class"),
+                },
+            )
+            continue
+
+        try:
+            signal = strategy_instance.on_bar(ctx)
+        except Exception as e:
+            logger.exception(
+                f"Ошибка в стратегии {strategy_id_code} (strategy_universe_id={su_id})"
+            )
+            log_error(
+                conn,
+                message=f"Ошибка выполнения стратегии {strategy_id_code}",
+                severity="error",
+                source="strategy",
+                strategy_universe_id=su_id,
+                symbol=ticker,
+                timeframe=timeframe,
+                details={
+                    "strategy_id": strategy_id_code,
+                    "py_module": s_row["py_module"],
+                    "py_class": s_row["py_class"],
+                    "live_py_module": s_row.get("live_py_module"),
+                    "live_py_class": s_row.get("live_py_class"),
+                    "error": str(e),
+                },
+            )
+            continue
+
+        if not signal:
+            # стратегия вернула None или пустой dict — нет сигнала
+            continue
+
+        # простая валидация
+        if not isinstance(signal, dict) or "type" not in signal:
+            log_error(
+                conn,
+                message="Некорректный формат сигнала от стратегии",
+                severity="warning",
+                source="strategy",
+                strategy_universe_id=su_id,
+                symbol=ticker,
+                timeframe=timeframe,
+                details={
+                    "strategy_id": strategy_id_code,
+                    "signal": str(signal),
+                    "py_module": s_row["py_module"],
+                    "py_class": s_row["py_class"],
+                    "live_py_module": s_row.get("live_py_module"),
+                    "live_py_class": s_row.get("live_py_class"),
+                },
+            )
+            continue
+
+        signals.append(
+            insert_signal(conn, su_id, ticker, timeframe, bar, signal, signal_source="strategy")
+        )
+
+    # замеры уходят в БД со следующим commit (сигнал, bar_state)
+    latency = LatencyRecorder("strategy_runner")
+    latency.duration(time.perf_counter() - started, len(strategies))
+    latency.lag(ingested_at, len(signals))
+    latency.flush(conn)
+
+    return signals
+
+
 def process_bar_for_timeframe(
     conn, timeframe: str, tf_table: str, last_ts: Optional[datetime]
 ) -> Optional[datetime]:
@@ -495,7 +627,7 @@ def process_bar_for_timeframe(
             # берём все бары (для оффлайн-прогона истории)
             cur.execute(
                 f"""
-                SELECT symbol_id, timestamp, open, high, low, close, volume, is_gap, gap_dir
+                SELECT symbol_id, timestamp, open, high, low, close, volume, is_gap, gap_dir, ingested_at
                 FROM {tf_table}
                 ORDER BY timestamp, symbol_id
                 """
@@ -503,7 +635,7 @@ def process_bar_for_timeframe(
         else:
             cur.execute(
                 f"""
-                SELECT symbol_id, timestamp, open, high, low, close, volume, is_gap, gap_dir
+                SELECT symbol_id, timestamp, open, high, low, close, volume, is_gap, gap_dir, ingested_at
                 FROM {tf_table}
                 WHERE timestamp > %s
                 ORDER BY timestamp, symbol_id
@@ -552,121 +684,7 @@ def process_bar_for_timeframe(
             continue
 
         history = load_bar_history(conn, tf_table, symbol_id, ts, HISTORY_BARS)
-
-        for s_row in strategies:
-            su_id = s_row["id"]
-            strategy_id_code = s_row["strategy_id"]
-            params = s_row["params_json"] or {}
-            risk_per_trade = s_row.get("risk_per_trade")
-            max_dd = s_row.get("max_drawdown_fraction")
-            gap_thr = s_row.get("gap_threshold_fraction")
-
-            position = load_position(conn, su_id, ticker)
-            orders = load_orders(conn, su_id, ticker)
-
-            ctx = StrategyContext(
-                symbol=ticker,
-                timeframe=timeframe,
-                bar=bar,
-                history=history,
-                position=position,
-                orders=orders,
-                params=params,
-                risk_per_trade=risk_per_trade,
-                max_drawdown_fraction=max_dd,
-                gap_threshold_fraction=gap_thr,
-            )
-
-            strategy_instance = get_strategy_instance(s_row)
-            if strategy_instance is None:
-                log_error(
-                    conn,
-                    message=f"Стратегия {strategy_id_code} не найдена/не загружена",
-                    severity="error",
-                    source="strategy",
-                    strategy_universe_id=su_id,
-                    symbol=ticker,
-                    timeframe=timeframe,
-                    details={
-                        "strategy_id": strategy_id_code,
-                        "py_module": s_row["py_module"],
-                        "py_class": s_row["py_class"],
-                        "live_py_module": s_row.get("live_py_module"),
-                        "live_py_class": s_row.get("live_py_class"),
-                    },
-                )
-                continue
-
-            if not hasattr(strategy_instance, "on_bar"):
-                log_error(
-                    conn,
-                    message=f"Стратегия {strategy_id_code} не имеет метода on_bar",
-                    severity="error",
-                    source="strategy",
-                    strategy_universe_id=su_id,
-                    symbol=ticker,
-                    timeframe=timeframe,
-                    details={
-                        "strategy_id": strategy_id_code,
-                        "py_module": s_row["py_module"],
-                        "py_class": s_row["py_class"],
-                        "live_py_module": s_row.get("live_py_module"),
-                        "live_py_class": s_row.get("live_py_class"),
-                    },
-                )
-                continue
-
-            try:
-                signal = strategy_instance.on_bar(ctx)
-            except Exception as e:
-                logger.exception(
-                    f"Ошибка в стратегии {strategy_id_code} (strategy_universe_id={su_id})"
-                )
-                log_error(
-                    conn,
-                    message=f"Ошибка выполнения стратегии {strategy_id_code}",
-                    severity="error",
-                    source="strategy",
-                    strategy_universe_id=su_id,
-                    symbol=ticker,
-                    timeframe=timeframe,
-                    details={
-                        "strategy_id": strategy_id_code,
-                        "py_module": s_row["py_module"],
-                        "py_class": s_row["py_class"],
-                        "live_py_module": s_row.get("live_py_module"),
-                        "live_py_class": s_row.get("live_py_class"),
-                        "error": str(e),
-                    },
-                )
-                continue
-
-            if not signal:
-                # стратегия вернула None или пустой dict — нет сигнала
-                continue
-
-            # простая валидация
-            if not isinstance(signal, dict) or "type" not in signal:
-                log_error(
-                    conn,
-                    message="Некорректный формат сигнала от стратегии",
-                    severity="warning",
-                    source="strategy",
-                    strategy_universe_id=su_id,
-                    symbol=ticker,
-                    timeframe=timeframe,
-                    details={
-                        "strategy_id": strategy_id_code,
-                        "signal": str(signal),
-                        "py_module": s_row["py_module"],
-                        "py_class": s_row["py_class"],
-                        "live_py_module": s_row.get("live_py_module"),
-                        "live_py_class": s_row.get("live_py_class"),
-                    },
-                )
-                continue
-
-            insert_signal(conn, su_id, ticker, timeframe, bar, signal, signal_source="strategy")
+        run_strategies_for_bar(conn, timeframe, ticker, bar, history, strategies, r["ingested_at"])
 
         # обновляем новый last_ts
         new_last_ts = ts if (new_last_ts is None or ts > new_last_ts) else new_last_ts
@@ -677,26 +695,38 @@ def process_bar_for_timeframe(
 # --- Основной цикл демона ---
 
 
+def run_once(conn) -> int:
+    """
+    Одна итерация: новые бары всех ТФ -> стратегии -> live_signals, bar_state.
+
+    Returns:
+        число ТФ, по которым были новые бары
+    """
+    advanced = 0
+    for timeframe, cfg in TF_CONFIG.items():
+        tf_table = cfg["table"]
+        last_ts = get_last_bar_timestamp(conn, timeframe)
+        new_last_ts = process_bar_for_timeframe(conn, timeframe, tf_table, last_ts)
+        if new_last_ts and (last_ts is None or new_last_ts > last_ts):
+            save_last_bar_timestamp(conn, timeframe, new_last_ts)
+            advanced += 1
+    return advanced
+
+
 def main_loop():
-    conn = get_connection()
+    conn = db_connect(application_name="strategy_runner")
     conn.autocommit = False
     logger.info("Старт strategy_runner")
 
     try:
         while True:
             try:
-                for timeframe, cfg in TF_CONFIG.items():
-                    tf_table = cfg["table"]
-                    last_ts = get_last_bar_timestamp(conn, timeframe)
-                    new_last_ts = process_bar_for_timeframe(conn, timeframe, tf_table, last_ts)
-                    if new_last_ts and (last_ts is None or new_last_ts > last_ts):
-                        save_last_bar_timestamp(conn, timeframe, new_last_ts)
-
+                run_once(conn)
                 update_service_heartbeat(conn)
                 conn.commit()
 
             except Exception as e:
-                conn.rollback()
+                conn = recover_connection(conn)
                 logger.exception(f"Ошибка в основном цикле strategy_runner: {e}")
                 log_error(
                     conn,
@@ -68,8 +68,26 @@ function getIndicatorColor(name) {
     return colors[index];
 }
 
+// Точки индикатора: [{time, value}, ...] или колоночный {time: [...], value: [...]}
 function processIndicatorData(indicatorArray) {
-    if (!indicatorArray || !Array.isArray(indicatorArray)) return [];
+    if (!indicatorArray) return [];
+
+    if (!Array.isArray(indicatorArray)) {
+        const times = indicatorArray.time;
+        const values = indicatorArray.value;
+        if (!Array.isArray(times) || !Array.isArray(values)) return [];
+
+        const points = [];
+        const length = Math.min(times.length, values.length);
+        for (let i = 0; i < length; i++) {
+            const ts = isoToUtcTimestamp(times[i]);
+            const value = Number(values[i]);
+            if (ts && Number.isFinite(value)) {
+                points.push({ time: ts, value: value });
+            }
+        }
+        return points;
+    }
 
     return indicatorArray
         .map(p => {
@@ -271,26 +289,35 @@ async function main() {
         let trades = [];
         let indicators = {};
 
-        if (trial.trades_json) {
-            try {
-                trades = JSON.parse(trial.trades_json);
-                console.log('Trades loaded:', trades.length);
-
-                // Логируем структуру первой сделки для отладки
-                if (trades.length > 0) {
-                    console.log('First trade structure:', trades[0]);
-                    console.log('Trade has is_long property:', 'is_long' in trades[0]);
-                    console.log('Trade is_long value:', trades[0].is_long);
-                    console.log('Trade direction (computed):', trades[0].is_long ? 'long' : 'short');
-                }
-
-                updateTradesCount(trades.length);
-            } catch (e) {
-                console.warn('Failed to parse trades_json:', e);
+        // Сделки - отдельным запросом (из блоба прогона или старого trades_json)
+        try {
+            const tradesData = await apiGet(`api/backtest-run-details.php?run_id=${trial.run_id}&kind=trades`);
+            trades = columnarToRows(tradesData.data);
+            console.log('Trades loaded:', trades.length);
+
+            // Логируем структуру первой сделки для отладки
+            if (trades.length > 0) {
+                console.log('First trade structure:', trades[0]);
+                console.log('Trade has is_long property:', 'is_long' in trades[0]);
+                console.log('Trade is_long value:', trades[0].is_long);
+                console.log('Trade direction (computed):', trades[0].is_long ? 'long' : 'short');
             }
+
+            updateTradesCount(trades.length);
+        } catch (e) {
+            console.warn('Failed to load trades:', e);
         }
 
-        if (trial.indicators_json) {
+        // ?full_indicators=1 - индикаторы в полном разрешении вместо прореженного indicators_json
+        if (getQueryParam('full_indicators') === '1') {
+            try {
+                const indicatorsData = await apiGet(`api/backtest-run-details.php?run_id=${trial.run_id}&kind=indicators`);
+                indicators = indicatorsData.data || {};
+                console.log('Full indicators loaded:', Object.keys(indicators));
+            } catch (e) {
+                console.warn('Failed to load full indicators:', e);
+            }
+        } else if (trial.indicators_json) {
             try {
                 indicators = JSON.parse(trial.indicators_json);
                 console.log('Indicators loaded:', Object.keys(indicators));
@@ -1,6 +1,10 @@
-// Преобразование ISO строки в timestamp для Lightweight Charts
+// Преобразование времени в timestamp для Lightweight Charts
+// Принимает ISO строку или число миллисекунд Unix epoch (UTC)
 function isoToUtcTimestamp(isoString) {
-    if (!isoString) return null;
+    if (isoString === null || isoString === undefined || isoString === '') return null;
+    if (typeof isoString === 'number') {
+        return Number.isFinite(isoString) ? Math.floor(isoString / 1000) : null;
+    }
     try {
         // Удаляем миллисекунды если есть
         const dateStr = isoString.split('.')[0].replace('T', ' ');
@@ -12,6 +16,26 @@ function isoToUtcTimestamp(isoString) {
     }
 }
 
+// Колоночный JSON ({field: [...], ...}) в массив объектов; массив возвращается как есть
+function columnarToRows(data) {
+    if (!data) return [];
+    if (Array.isArray(data)) return data;
+
+    const keys = Object.keys(data).filter(k => Array.isArray(data[k]));
+    if (!keys.length) return [];
+
+    const length = data[keys[0]].length;
+    const rows = new Array(length);
+    for (let i = 0; i < length; i++) {
+        const row = {};
+        for (const k of keys) {
+            row[k] = data[k][i];
+        }
+        rows[i] = row;
+    }
+    return rows;
+}
+
 // Проверка, является ли индикатор осциллятором
 function isOscillator(name) {
     if (!name || typeof name !== 'string') return false;
@@ -156,6 +180,7 @@ function getPanelHeightForIndicator(name) {
 
 // Экспорт функций в глобальную область видимости
 window.isoToUtcTimestamp = isoToUtcTimestamp;
+window.columnarToRows = columnarToRows;
 window.isOscillator = isOscillator;
 window.isTrendIndicator = isTrendIndicator;
 window.isVolumeIndicator = isVolumeIndicator;
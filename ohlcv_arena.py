@@ -0,0 +1,159 @@
+"""
+ohlcv_arena.py - Общая память (multiprocessing.shared_memory) для OHLCV в пуле процессов
+
+Родительский процесс один раз кладёт свечи в блок shared memory, воркеры
+подключаются к нему по имени и получают DataFrame поверх того же буфера,
+без копирования данных в каждом процессе.
+
+Раскладка блока (n = число баров):
+    [ n x int64: timestamp, нс UTC ][ 5 x n x float64: Open, High, Low, Close, Volume ]
+Колонки лежат подряд (column-major), поэтому каждая колонка DataFrame -
+непрерывный view на общую память.
+"""
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, Hashable, List, Tuple
+import gc
+import sys
+import numpy as np
+import pandas as pd
+
+
+OHLCV_COLUMNS: Tuple[str, ...] = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+
+@dataclass(frozen=True)
+class ArenaHandle:
+    """Описание блока shared memory, передаваемое в воркер (pickle-friendly)"""
+    shm_name: str
+    n_rows: int
+    columns: Tuple[str, ...] = OHLCV_COLUMNS
+
+
+def _block_size(n_rows: int, n_cols: int) -> int:
+    # shared_memory не допускает блоков нулевого размера
+    return max(8 * n_rows * (1 + n_cols), 1)
+
+
+def _open_shm(name: str) -> shared_memory.SharedMemory:
+    """Подключение к существующему блоку без регистрации в resource_tracker (Python 3.13+)"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+class OhlcvArena:
+    """
+    Владелец блоков shared memory на стороне родительского процесса
+
+    Блок живёт, пока не вызван release(key) или close(); воркеры должны
+    закончить работу с DataFrame до освобождения блока.
+    """
+
+    def __init__(self):
+        self._blocks: Dict[Hashable, Tuple[shared_memory.SharedMemory, ArenaHandle]] = {}
+
+    def put(self, key: Hashable, df: pd.DataFrame) -> ArenaHandle:
+        """
+        Копирует OHLCV в новый блок shared memory
+
+        Args:
+            key: ключ набора данных (например, (symbol_id, timeframe_table))
+            df: DataFrame с колонками Open..Volume и DatetimeIndex
+
+        Returns:
+            ArenaHandle для передачи в воркер
+        """
+        if key in self._blocks:
+            return self._blocks[key][1]
+
+        n_rows = len(df)
+        n_cols = len(OHLCV_COLUMNS)
+        shm = shared_memory.SharedMemory(create=True, size=_block_size(n_rows, n_cols))
+
+        index = df.index
+        if isinstance(index, pd.DatetimeIndex) and index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        ts = np.ndarray((n_rows,), dtype=np.int64, buffer=shm.buf)
+        ts[:] = np.asarray(pd.DatetimeIndex(index).values, dtype='datetime64[ns]').view(np.int64)
+
+        values = np.ndarray((n_cols, n_rows), dtype=np.float64, buffer=shm.buf, offset=8 * n_rows)
+        for i, col in enumerate(OHLCV_COLUMNS):
+            values[i, :] = df[col].to_numpy(dtype=np.float64)
+
+        # локальные view на буфер должны исчезнуть до возможного close()
+        del ts, values
+
+        handle = ArenaHandle(shm_name=shm.name, n_rows=n_rows)
+        self._blocks[key] = (shm, handle)
+        return handle
+
+    def release(self, key: Hashable):
+        """Освобождает блок набора данных"""
+        item = self._blocks.pop(key, None)
+        if item is None:
+            return
+        shm = item[0]
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        """Освобождает все блоки"""
+        for key in list(self._blocks):
+            self.release(key)
+
+    def __enter__(self) -> 'OhlcvArena':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# --- Сторона воркера ---
+
+# Подключённые блоки: {shm_name: SharedMemory}; держим ссылку, пока данные используются
+_attached: Dict[str, shared_memory.SharedMemory] = {}
+
+# Блоки, которые не удалось закрыть из-за живых view (закроются при следующем detach)
+_pending_close: List[shared_memory.SharedMemory] = []
+
+
+def attach(handle: ArenaHandle) -> pd.DataFrame:
+    """
+    Возвращает DataFrame поверх блока shared memory (без копирования колонок)
+
+    Данные общие для всех процессов: изменять их нельзя.
+    """
+    shm = _attached.get(handle.shm_name)
+    if shm is None:
+        shm = _open_shm(handle.shm_name)
+        _attached[handle.shm_name] = shm
+
+    n_rows = handle.n_rows
+    n_cols = len(handle.columns)
+    ts = np.ndarray((n_rows,), dtype=np.int64, buffer=shm.buf)
+    values = np.ndarray((n_cols, n_rows), dtype=np.float64, buffer=shm.buf, offset=8 * n_rows)
+
+    index = pd.DatetimeIndex(ts.view('datetime64[ns]'), name='timestamp').tz_localize('UTC')
+    # values.T - view (n_rows, n_cols) в column-major: DataFrame берёт его одним блоком без копии
+    return pd.DataFrame(values.T, index=index, columns=list(handle.columns), copy=False)
+
+
+def detach(handle: ArenaHandle):
+    """
+    Отключает воркер от блока
+
+    Вызывать после того, как все DataFrame/view на этот блок больше не нужны.
+    """
+    shm = _attached.pop(handle.shm_name, None)
+    if shm is not None:
+        _pending_close.append(shm)
+
+    gc.collect()
+    still_pending = []
+    for item in _pending_close:
+        try:
+            item.close()
+        except BufferError:
+            still_pending.append(item)
+    _pending_close[:] = still_pending
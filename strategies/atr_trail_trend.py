@@ -1,6 +1,6 @@
 # strategies/atr_trail_trend.py
 from strategies.base_lot_strategy import BaseLotStrategy
-import pandas as pd
+from utils_indicators import sma, atr
 import numpy as np
 
 
@@ -15,23 +15,13 @@ class ATRTrailTrendStrategy(BaseLotStrategy):
         close = self.data.Close
 
         self.trend_ma = self.I(
-            lambda x: pd.Series(x).rolling(self.trend_ma_period).mean().values,
+            lambda x: self.shared_indicator('sma', (self.trend_ma_period,), sma, x, inputs=('Close',)),
             close,
             name="trend_ma"
         )
 
-        def atr_series(o, h, l, c, period):
-            df = pd.DataFrame({"o": o, "h": h, "l": l, "c": c})
-            prev_close = df["c"].shift(1)
-            tr1 = df["h"] - df["l"]
-            tr2 = (df["h"] - prev_close).abs()
-            tr3 = (df["l"] - prev_close).abs()
-            tr = pd.concat([tr1, tr2, tr3], axis=1).max(axis=1)
-            atr = tr.rolling(period).mean()
-            return atr.values
-
         self.atr = self.I(
-            lambda o, h, l, c: atr_series(o, h, l, c, self.atr_period),
+            lambda o, h, l, c: self.shared_indicator('atr', (self.atr_period,), atr, o, h, l, c, inputs=('Open', 'High', 'Low', 'Close')),
             self.data.Open, self.data.High, self.data.Low, self.data.Close,
             name="atr"
         )
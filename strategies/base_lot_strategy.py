@@ -1,9 +1,13 @@
 # strategies/base_lot_strategy.py
 from backtesting import Strategy
 from datetime import datetime
-from typing import Callable, Optional
+from typing import Any, Callable, Hashable, Optional, Sequence
 
-from utils_lot import get_lotsize, calc_shares_by_risk
+import numpy as np
+import pandas as pd
+
+from utils_lot import get_lotsize, lot_sizes_for_index, calc_shares_by_risk
+from utils_indicators import get_or_compute
 
 
 class BaseLotStrategy(Strategy):
@@ -12,12 +16,36 @@ class BaseLotStrategy(Strategy):
     Требует атрибутов класса:
       - symbol_id: int
       - lot_size_getter: callable(symbol_id, dt) -> int
+      - lot_sizes_getter: callable(symbol_id, DatetimeIndex) -> np.ndarray
+        (размеры лота по всем барам сразу; None - lot_size_getter на каждом баре)
+      - data_key: ключ набора данных для кэша индикаторов (None - без кэша)
     """
 
     lot_size_getter: Callable[[int, Optional[datetime]], int] = staticmethod(get_lotsize)
+    lot_sizes_getter: Optional[Callable[[int, pd.DatetimeIndex], np.ndarray]] = staticmethod(lot_sizes_for_index)
     symbol_id: Optional[int] = None
+    data_key: Optional[Hashable] = None
+
+    def __init__(self, broker, data, params):
+        super().__init__(broker, data, params)
+        # В __init__ данные ещё полной длины: размеры лота считаются один раз на все бары
+        self._lot_sizes: Optional[np.ndarray] = None
+        if self.symbol_id is not None and self.lot_sizes_getter is not None:
+            self._lot_sizes = self.lot_sizes_getter(self.symbol_id, self.data.index)
+
+    def shared_indicator(self, name: str, params: tuple, func: Callable[..., Any], *args,
+                         inputs: Sequence[str]) -> Any:
+        """
+        Индикатор из общего кэша процесса: считается один раз на набор данных,
+        входные серии (inputs - имена колонок data по порядку args) и параметры,
+        переиспользуется другими trial-ами и стратегиями.
+        """
+        return get_or_compute(self.data_key, name, params, func, *args, inputs=inputs)
 
     def _get_lot_size(self) -> int:
+        if self._lot_sizes is not None:
+            return int(self._lot_sizes[len(self.data) - 1])
+
         idx = self.data.index[-1]
         if isinstance(idx, datetime):
             dt = idx
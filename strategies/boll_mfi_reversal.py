@@ -1,5 +1,5 @@
 from strategies.base_lot_strategy import BaseLotStrategy
-import pandas as pd
+from utils_indicators import sma, rolling_std, mfi
 import numpy as np
 
 
@@ -20,34 +20,19 @@ class BollMFIReversalStrategy(BaseLotStrategy):
         volume = self.data.Volume
 
         def bollinger(c, period, mult):
-            s = pd.Series(c)
-            ma = s.rolling(period).mean()
-            std = s.rolling(period).std()
+            ma = self.shared_indicator('sma', (period,), sma, c, inputs=('Close',))
+            std = self.shared_indicator('rolling_std', (period,), rolling_std, c, inputs=('Close',))
             upper = ma + mult * std
             lower = ma - mult * std
-            return ma.values, upper.values, lower.values
+            return ma, upper, lower
 
         ma, upper, lower = bollinger(close, self.boll_period, self.boll_std_mult)
         self.boll_mid = self.I(lambda x: ma, close, name="boll_mid")
         self.boll_up = self.I(lambda x: upper, close, name="boll_up")
         self.boll_dn = self.I(lambda x: lower, close, name="boll_dn")
 
-        def mfi_series(h, l, c, v, period):
-            tp = (h + l + c) / 3.0
-            mf = tp * v
-            df = pd.DataFrame({"tp": tp, "mf": mf})
-            delta_tp = df["tp"].diff()
-            pos_mf = df["mf"].where(delta_tp > 0, 0.0)
-            neg_mf = df["mf"].where(delta_tp < 0, 0.0)
-            sum_pos = pos_mf.rolling(period).sum()
-            sum_neg = (-neg_mf).rolling(period).sum()
-            sum_neg = sum_neg.replace(0, 1e-8)
-            mr = sum_pos / sum_neg
-            mfi = 100 - (100 / (1 + mr))
-            return mfi.values
-
         self.mfi = self.I(
-            lambda h, l, c, v: mfi_series(h, l, c, v, self.mfi_period),
+            lambda h, l, c, v: self.shared_indicator('mfi', (self.mfi_period,), mfi, h, l, c, v, inputs=('High', 'Low', 'Close', 'Volume')),
             high, low, close, volume,
             name="mfi"
         )
@@ -1,6 +1,6 @@
 # strategies/breakout_donchian.py
 from strategies.base_lot_strategy import BaseLotStrategy
-import pandas as pd
+from utils_indicators import rolling_max, rolling_min, atr
 import numpy as np
 
 
@@ -18,12 +18,10 @@ class BreakoutDonchianStrategy(BaseLotStrategy):
         low = self.data.Low
 
         def donchian(h, l, period):
-            h_s = pd.Series(h)
-            l_s = pd.Series(l)
-            upper = h_s.rolling(period).max()
-            lower = l_s.rolling(period).min()
+            upper = self.shared_indicator('rolling_max', (period,), rolling_max, h, inputs=('High',))
+            lower = self.shared_indicator('rolling_min', (period,), rolling_min, l, inputs=('Low',))
             mid = (upper + lower) / 2.0
-            return upper.values, lower.values, mid.values
+            return upper, lower, mid
 
         upper, lower, mid = donchian(high, low, self.channel_period)
         self.dc_up = self.I(lambda x: upper, high, name="dc_up")
@@ -32,20 +30,8 @@ class BreakoutDonchianStrategy(BaseLotStrategy):
 
         self.atr = None
         if self.use_trailing:
-            close = self.data.Close
-
-            def atr_series(o, h, l, c, period):
-                df = pd.DataFrame({"o": o, "h": h, "l": l, "c": c})
-                prev_close = df["c"].shift(1)
-                tr1 = df["h"] - df["l"]
-                tr2 = (df["h"] - prev_close).abs()
-                tr3 = (df["l"] - prev_close).abs()
-                tr = pd.concat([tr1, tr2, tr3], axis=1).max(axis=1)
-                atr = tr.rolling(period).mean()
-                return atr.values
-
             self.atr = self.I(
-                lambda o, h, l, c: atr_series(o, h, l, c, self.trailing_atr_period),
+                lambda o, h, l, c: self.shared_indicator('atr', (self.trailing_atr_period,), atr, o, h, l, c, inputs=('Open', 'High', 'Low', 'Close')),
                 self.data.Open, self.data.High, self.data.Low, self.data.Close,
                 name="dc_atr"
             )
@@ -1,5 +1,5 @@
 from strategies.base_lot_strategy import BaseLotStrategy
-import pandas as pd
+from utils_indicators import ema, rsi
 
 
 class EMARSIPullbackStrategy(BaseLotStrategy):
@@ -15,23 +15,16 @@ class EMARSIPullbackStrategy(BaseLotStrategy):
         close = self.data.Close
 
         self.ema = self.I(
-            lambda x: pd.Series(x).ewm(span=self.ema_period, adjust=False).mean().values,
+            lambda x: self.shared_indicator('ema', (self.ema_period,), ema, x, inputs=('Close',)),
             close,
             name='ema'
         )
 
-        def rsi_series(x, period):
-            s = pd.Series(x)
-            delta = s.diff()
-            gain = delta.clip(lower=0)
-            loss = -delta.clip(upper=0)
-            avg_gain = gain.rolling(period).mean()
-            avg_loss = loss.rolling(period).mean()
-            rs = avg_gain / avg_loss.replace(0, 1e-8)
-            rsi = 100 - (100 / (1 + rs))
-            return rsi.values
-
-        self.rsi = self.I(lambda x: rsi_series(x, self.rsi_period), close, name='rsi')
+        self.rsi = self.I(
+            lambda x: self.shared_indicator('rsi', (self.rsi_period,), rsi, x, inputs=('Close',)),
+            close,
+            name='rsi'
+        )
 
     def next(self):
         price = self.data.Close[-1]
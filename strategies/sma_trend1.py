@@ -1,6 +1,6 @@
 from backtesting.lib import crossover
-import pandas as pd
 from strategies.base_lot_strategy import BaseLotStrategy
+from utils_indicators import sma
 
 
 class SMATrend1Strategy(BaseLotStrategy):
@@ -14,12 +14,12 @@ class SMATrend1Strategy(BaseLotStrategy):
         close = self.data.Close
 
         self.sma_fast = self.I(
-            lambda x: pd.Series(x).rolling(self.fast_period).mean().values,
+            lambda x: self.shared_indicator('sma', (self.fast_period,), sma, x, inputs=('Close',)),
             close,
             name="sma_fast"
         )
         self.sma_slow = self.I(
-            lambda x: pd.Series(x).rolling(self.slow_period).mean().values,
+            lambda x: self.shared_indicator('sma', (self.slow_period,), sma, x, inputs=('Close',)),
             close,
             name="sma_slow"
         )
@@ -1,16 +1,19 @@
 """
 strategy_optimizer.py - Оптимизация стратегий с использованием Optuna
 """
-from typing import Tuple, Dict, Any, Optional
+from typing import Tuple, Dict, Any, Optional, List, Callable
 from datetime import datetime
 import json
+import pandas as pd
 import optuna
-import psycopg2
+from optuna.trial import TrialState, FrozenTrial
 from psycopg2.extras import RealDictCursor
 import math
-from configloader import load_strategy_config, DBCFG
+from configloader import get_strategy_config, DBCFG
+from db_pool import connection, register_statement, execute_prepared
 from optuna_helpers import suggest_params_from_trial
-from backtest_runner import run_backtest
+from backtest_runner import run_backtest, load_ohlcv_from_db, add_details
+from backtest_blobs import save_run_details
 
 def create_optimization_session(
     strategy_code: str,
@@ -24,10 +27,9 @@ def create_optimization_session(
     study_name: Optional[str]
 ) -> int:
     """Создает сессию оптимизации в БД"""
-    cfg = load_strategy_config(strategy_code, DBCFG)
-    conn = psycopg2.connect(**DBCFG)
+    cfg = get_strategy_config(strategy_code, DBCFG)
 
-    try:
+    with connection(DBCFG) as conn:
         with conn.cursor() as cur:
             # ИСПРАВЛЕНИЕ: Используем правильные имена колонок с подчёркиваниями
             sql = """
@@ -41,18 +43,11 @@ def create_optimization_session(
                 cfg.id, symbol_id, timeframe_table, window[0], window[1],
                 study_name, storage_url, target_metric, direction, n_trials
             ))
-            opt_id = cur.fetchone()[0]
-            conn.commit()
-            return opt_id
-
-    finally:
-        conn.close()
+            return cur.fetchone()[0]
 
 def update_optimization_session_finished(opt_id: int, best_value: float, best_params: Dict[str, Any]):
     """Обновляет сессию оптимизации после завершения"""
-    conn = psycopg2.connect(**DBCFG)
-
-    try:
+    with connection(DBCFG) as conn:
         with conn.cursor() as cur:
             # ИСПРАВЛЕНИЕ: Используем правильные имена колонок
             sql = """
@@ -61,10 +56,6 @@ def update_optimization_session_finished(opt_id: int, best_value: float, best_pa
                 WHERE id = %s
             """
             cur.execute(sql, (best_value, json.dumps(best_params), opt_id))
-            conn.commit()
-
-    finally:
-        conn.close()
 
 def nan_to_none(v):
     """Конвертирует NaN в None для PostgreSQL"""
@@ -77,6 +68,17 @@ def nan_to_none(v):
         pass
     return v
 
+# Запись прогона выполняется на каждый trial: запрос готовится (PREPARE) один раз на соединение
+# ИСПРАВЛЕНИЕ: Используем правильные имена колонок с подчёркиваниями
+INSERT_BACKTEST_RUN = register_statement("insert_backtest_run", """
+    INSERT INTO backtest_runs
+    (optimization_id, strategy_id, symbol_id, timeframe_table, window_start, window_end,
+     trial_number, is_best, params_json, cagr, sharpe, max_dd, profit_factor,
+     trades_count, target_metric_value, trades_json, indicators_json)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    RETURNING id
+""")
+
 def insert_backtest_run(
     optimization_id: int,
     cfg_id: int,
@@ -86,46 +88,61 @@ def insert_backtest_run(
     trial_number: int,
     params: Dict[str, Any],
     metrics: Dict[str, Any],
-    is_best: bool
-):
-    """Сохраняет результат одного прогона бэктеста"""
-    conn = psycopg2.connect(**DBCFG)
+    is_best: bool,
+    guard: Optional[Callable[[Any], None]] = None
+) -> int:
+    """
+    Сохраняет результат одного прогона бэктеста
+
+    Для лучшего прогона сделки и индикаторы в полном разрешении
+    (trade_columns/indicator_series из run_backtest) пишутся сжатыми
+    в backtest_run_blobs в той же транзакции; trades_json при этом
+    остаётся пустым, indicators_json - прореженные ряды для графика.
+
+    guard(conn) вызывается в той же транзакции до записи; исключение из него
+    отменяет запись (батч так проверяет, что комбинация всё ещё за этим воркером).
+
+    Returns:
+        id записи backtest_runs
+    """
+    cagr = nan_to_none(metrics.get('CAGR'))
+    sharpe = nan_to_none(metrics.get('Sharpe'))
+    maxdd = nan_to_none(metrics.get('MaxDD'))
+    profitfactor = nan_to_none(metrics.get('ProfitFactor'))
+    tradescount = metrics.get('Trades')
+    targetmetric = nan_to_none(metrics.get('target_metric'))
+
+    if is_best:
+        # Сделки с блобом в trades_json не дублируются: график берёт их
+        # через api/backtest-run-details.php
+        tradesjson = None if metrics.get('trade_columns') else metrics.get('trades_json')
+        indicatorsjson = metrics.get('indicators_json')
+    else:
+        tradesjson = None
+        indicatorsjson = None
+
+    with connection(DBCFG) as conn:
+        if guard is not None:
+            guard(conn)
 
-    try:
         with conn.cursor() as cur:
-            # ИСПРАВЛЕНИЕ: Используем правильные имена колонок с подчёркиваниями
-            sql = """
-                INSERT INTO backtest_runs
-                (optimization_id, strategy_id, symbol_id, timeframe_table, window_start, window_end,
-                 trial_number, is_best, params_json, cagr, sharpe, max_dd, profit_factor,
-                 trades_count, target_metric_value, trades_json, indicators_json)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-
-            cagr = nan_to_none(metrics.get('CAGR'))
-            sharpe = nan_to_none(metrics.get('Sharpe'))
-            maxdd = nan_to_none(metrics.get('MaxDD'))
-            profitfactor = nan_to_none(metrics.get('ProfitFactor'))
-            tradescount = metrics.get('Trades')
-            targetmetric = nan_to_none(metrics.get('target_metric'))
-
-            if is_best:
-                tradesjson = metrics.get('trades_json')
-                indicatorsjson = metrics.get('indicators_json')
-            else:
-                tradesjson = None
-                indicatorsjson = None
-
-            cur.execute(sql, (
+            execute_prepared(cur, INSERT_BACKTEST_RUN, (
                 optimization_id, cfg_id, symbol_id, timeframe_table, window[0], window[1],
                 trial_number, 1 if is_best else 0, json.dumps(params),
                 cagr, sharpe, maxdd, profitfactor, tradescount, targetmetric,
                 tradesjson, indicatorsjson
             ))
-            conn.commit()
+            run_id = cur.fetchone()[0]
+
+        if is_best:
+            save_run_details(
+                conn,
+                run_id,
+                metrics.get('trade_columns'),
+                metrics.get('indicator_series')
+            )
 
-    finally:
-        conn.close()
+    return run_id
 
 def make_objective(
     strategy_code: str,
@@ -134,12 +151,22 @@ def make_objective(
     window: Tuple[datetime, datetime],
     optimization_id: int,
     min_trades: int = 10,
-    max_dd_limit: float = -30.0
+    max_dd_limit: float = -30.0,
+    data: Optional[pd.DataFrame] = None,
+    best_holder: Optional[Dict[str, Any]] = None,
+    direction: str = 'maximize'
 ):
-    """Создает функцию цели для Optuna"""
+    """
+    Создает функцию цели для Optuna
+
+    Если передан data, trial-ы используют эти свечи вместо загрузки из БД.
+    Если передан best_holder, в нём держится результат лучшего trial-а этого
+    запуска ({'trial_number', 'value', 'metrics'} с raw_stats), чтобы
+    финальная запись is_best не повторяла бэктест.
+    """
 
     def objective(trial: optuna.Trial) -> float:
-        cfg = load_strategy_config(strategy_code, DBCFG)
+        cfg = get_strategy_config(strategy_code, DBCFG)
         opt_params = suggest_params_from_trial(trial, cfg)
 
         metrics = run_backtest(
@@ -149,7 +176,8 @@ def make_objective(
             window,
             opt_params,
             DBCFG,
-            extract_details=False
+            extract_details=False,
+            data=data
         )
 
         value = metrics['target_metric']
@@ -169,10 +197,37 @@ def make_objective(
             is_best=False
         )
 
+        if best_holder is not None:
+            best_value = best_holder.get('value')
+            if (best_value is None
+                    or (direction == 'maximize' and value > best_value)
+                    or (direction == 'minimize' and value < best_value)):
+                best_holder['trial_number'] = trial.number
+                best_holder['value'] = value
+                best_holder['metrics'] = metrics
+
         return value
 
     return objective
 
+def fail_stale_trials(study: optuna.Study) -> int:
+    """
+    Помечает FAIL trial-ы, оставшиеся в состоянии RUNNING после прерванного запуска.
+
+    Вызывать только когда study гарантированно не оптимизируется другим процессом
+    (батч захватывает комбинацию целиком).
+    """
+    stale = study.get_trials(deepcopy=False, states=(TrialState.RUNNING,))
+    for t in stale:
+        study.tell(t.number, state=TrialState.FAIL)
+    return len(stale)
+
+
+def count_done_trials(study: optuna.Study) -> int:
+    """Количество trial-ов, которые не нужно повторять (COMPLETE/PRUNED)"""
+    return len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED)))
+
+
 def optimize_strategy(
     strategy_code: str,
     symbol_id: int,
@@ -182,20 +237,49 @@ def optimize_strategy(
     storage_url: Optional[str] = None,
     study_name: Optional[str] = None,
     target_metric: str = 'Sharpe',
-    direction: str = 'maximize'
+    direction: str = 'maximize',
+    optimization_id: Optional[int] = None,
+    data: Optional[pd.DataFrame] = None,
+    callbacks: Optional[List[Callable[[optuna.Study, FrozenTrial], None]]] = None,
+    fail_stale: bool = True,
+    best_run_guard: Optional[Callable[[Any], None]] = None
 ) -> optuna.Study:
-    """Оптимизирует стратегию"""
-    opt_id = create_optimization_session(
-        strategy_code=strategy_code,
-        symbol_id=symbol_id,
-        timeframe_table=timeframe_table,
-        window=window,
-        target_metric=target_metric,
-        direction=direction,
-        n_trials=n_trials,
-        storage_url=storage_url,
-        study_name=study_name
-    )
+    """
+    Оптимизирует стратегию
+
+    Если передан optimization_id, новая сессия в optimization_sessions не создаётся
+    (продолжение прерванного запуска). При persistent storage_url + study_name
+    study подхватывается из хранилища, и запускаются только недостающие trial-ы.
+    Если передан data, свечи не загружаются из БД ни в trial-ах, ни в финальном прогоне.
+    callbacks передаются в study.optimize (исключение из callback прерывает оптимизацию
+    без записи лучшего прогона).
+    fail_stale=False оставляет RUNNING trial-ы как есть: их может ещё считать другой процесс.
+    best_run_guard передаётся в insert_backtest_run лучшего прогона (guard).
+    """
+    if optimization_id is None:
+        opt_id = create_optimization_session(
+            strategy_code=strategy_code,
+            symbol_id=symbol_id,
+            timeframe_table=timeframe_table,
+            window=window,
+            target_metric=target_metric,
+            direction=direction,
+            n_trials=n_trials,
+            storage_url=storage_url,
+            study_name=study_name
+        )
+    else:
+        opt_id = optimization_id
+
+    # Свечи загружаем один раз на всю оптимизацию, а не в каждом trial-е
+    if data is None:
+        data = load_ohlcv_from_db(
+            symbol_id=symbol_id,
+            timeframe_table=timeframe_table,
+            start=window[0],
+            end=window[1],
+            db_cfg=DBCFG
+        )
 
     study_kwargs: Dict[str, Any] = {'direction': direction}
 
@@ -208,28 +292,48 @@ def optimize_strategy(
 
     study = optuna.create_study(**study_kwargs)
 
+    if storage_url is not None and fail_stale:
+        stale = fail_stale_trials(study)
+        if stale:
+            print(f"Study {study.study_name}: {stale} stale RUNNING trial(s) marked as FAIL")
+
+    remaining = max(0, n_trials - count_done_trials(study))
+
+    # Лучший trial этого запуска вместе с raw_stats
+    best_holder: Dict[str, Any] = {}
+
     objective = make_objective(
         strategy_code=strategy_code,
         symbol_id=symbol_id,
         timeframe_table=timeframe_table,
         window=window,
-        optimization_id=opt_id
+        optimization_id=opt_id,
+        data=data,
+        best_holder=best_holder,
+        direction=direction
     )
 
-    study.optimize(objective, n_trials=n_trials)
+    if remaining > 0:
+        study.optimize(objective, n_trials=remaining, callbacks=callbacks)
 
     best_trial = study.best_trial
-    cfg = load_strategy_config(strategy_code, DBCFG)
-
-    best_metrics = run_backtest(
-        cfg,
-        symbol_id,
-        timeframe_table,
-        window,
-        best_trial.params,
-        DBCFG,
-        extract_details=True
-    )
+    cfg = get_strategy_config(strategy_code, DBCFG)
+
+    if best_holder.get('trial_number') == best_trial.number:
+        best_metrics = add_details(best_holder['metrics'], data)
+    else:
+        # лучший trial получен в прерванном ранее запуске (или другим воркером) - считаем заново
+        best_metrics = run_backtest(
+            cfg,
+            symbol_id,
+            timeframe_table,
+            window,
+            best_trial.params,
+            DBCFG,
+            extract_details=True,
+            data=data
+        )
+    best_holder.clear()
 
     insert_backtest_run(
         optimization_id=opt_id,
@@ -240,7 +344,8 @@ def optimize_strategy(
         trial_number=best_trial.number,
         params=best_trial.params,
         metrics=best_metrics,
-        is_best=True
+        is_best=True,
+        guard=best_run_guard
     )
 
     update_optimization_session_finished(
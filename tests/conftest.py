@@ -0,0 +1,7 @@
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (BASE_DIR, os.path.join(BASE_DIR, "demons")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,76 @@
+"""Заглушки psycopg2-соединения для тестов без БД"""
+
+
+def sql_text(sql):
+    """Текст запроса из executed (execute_values передаёт его в bytes)"""
+    return sql.decode() if isinstance(sql, bytes) else sql
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.connection = conn
+        self.rowcount = 0
+        # ответ responder на последний запрос (None - общий conn.rows)
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        # списки в параметрах копируются: вызывающий может очистить их после запроса
+        if isinstance(params, tuple):
+            params = tuple(list(p) if isinstance(p, list) else p for p in params)
+        self.conn.executed.append((sql, params))
+        if self.conn.fail_on and self.conn.fail_on(sql, params):
+            raise self.conn.error("fake failure")
+        if self.conn.responder is not None:
+            self.result = list(self.conn.responder(sql, params) or [])
+
+    def mogrify(self, sql, params=None):
+        # execute_values склеивает строки VALUES через mogrify
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        return (sql % tuple(repr(p) for p in params)).encode()
+
+    def fetchone(self):
+        rows = self.result if self.result is not None else self.conn.rows
+        return rows.pop(0) if rows else None
+
+    def fetchall(self):
+        if self.result is not None:
+            rows, self.result = self.result, []
+            return rows
+        rows, self.conn.rows = self.conn.rows, []
+        return rows
+
+
+class FakeConnection:
+    """
+    Запоминает запросы; fail_on(sql, params) -> True роняет запрос исключением error
+
+    rows - общая очередь ответов; responder(sql, params) -> строки отвечает
+    на каждый запрос отдельно (для кода, который читает несколько запросов подряд).
+    """
+
+    def __init__(self, rows=None, fail_on=None, error=RuntimeError, responder=None):
+        self.rows = list(rows or [])
+        self.encoding = "UTF8"
+        self.fail_on = fail_on
+        self.responder = responder
+        self.error = error
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+import backtest_blobs
+from backtest_blobs import (
+    decode_columns,
+    encode_columns,
+    pack_indicator_series,
+    unpack_indicator_series,
+)
+
+
+def sample_trades():
+    return {
+        'entry_time': np.array([1_700_000_000_000, 1_700_000_060_000], dtype=np.int64),
+        'entry_price': np.array([100.5, 101.25]),
+        'exit_time': np.array([1_700_000_120_000, np.iinfo(np.int64).min], dtype=np.int64),
+        'exit_price': np.array([102.0, np.nan]),
+        'is_long': np.array([True, False]),
+    }
+
+
+def assert_same_columns(decoded, expected):
+    assert list(decoded) == list(expected)
+    for key, values in expected.items():
+        assert decoded[key].dtype == values.dtype
+        np.testing.assert_array_equal(decoded[key], values)
+
+
+@pytest.mark.parametrize("zstd", [True, False])
+def test_encode_decode_round_trip(monkeypatch, zstd):
+    if not zstd:
+        monkeypatch.setattr(backtest_blobs, "zstandard", None)
+    elif backtest_blobs.zstandard is None:
+        pytest.skip("zstandard не установлен")
+
+    columns = sample_trades()
+    codec, raw_bytes, payload = encode_columns(columns)
+
+    assert codec == ("zstd" if zstd else "zlib")
+    assert_same_columns(decode_columns(codec, memoryview(payload)), columns)
+
+
+def test_empty_columns_round_trip():
+    columns = {'pnl': np.array([], dtype=np.float64)}
+    codec, _, payload = encode_columns(columns)
+    assert_same_columns(decode_columns(codec, payload), columns)
+
+
+def test_indicator_series_keys_survive_round_trip():
+    series = {
+        'sma': (np.array([1, 2, 3], dtype=np.int64), np.array([1.0, 2.0, 3.0])),
+        'rsi': (np.array([2, 3], dtype=np.int64), np.array([40.0, 60.0])),
+    }
+    codec, _, payload = encode_columns(pack_indicator_series(series))
+    decoded = decode_columns(codec, payload)
+
+    assert ('sma', 'time') in decoded
+    restored = unpack_indicator_series(decoded, names=['rsi'])
+    assert list(restored) == ['rsi']
+    np.testing.assert_array_equal(restored['rsi'][0], series['rsi'][0])
+    np.testing.assert_array_equal(restored['rsi'][1], series['rsi'][1])
+
+
+def test_decoded_columns_are_writable():
+    codec, _, payload = encode_columns({'x': np.arange(3, dtype=np.float64)})
+    decoded = decode_columns(codec, payload)
+    decoded['x'][0] = 42.0
+    assert decoded['x'][0] == 42.0
+
+
+def test_encode_rejects_2d_column():
+    with pytest.raises(ValueError):
+        encode_columns({'x': np.zeros((2, 2))})
+
+
+def test_decode_rejects_unknown_codec():
+    with pytest.raises(ValueError):
+        decode_columns('lz4', b'')
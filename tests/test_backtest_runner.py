@@ -0,0 +1,33 @@
+import numpy as np
+
+from backtest_runner import downsample_series
+
+
+def test_short_series_is_returned_as_is():
+    times = np.arange(5)
+    values = np.arange(5, dtype=float)
+    out_times, out_values = downsample_series(times, values, 10)
+    assert out_times is times and out_values is values
+
+
+def test_no_limit_keeps_all_points():
+    times = np.arange(100)
+    values = np.sin(times)
+    out_times, _ = downsample_series(times, values, None)
+    assert len(out_times) == 100
+
+
+def test_downsample_bounds_points_and_keeps_shape():
+    times = np.arange(1000, dtype=np.int64)
+    values = np.sin(times / 50.0)
+    values[123] = 10.0
+    values[777] = -10.0
+
+    out_times, out_values = downsample_series(times, values, 100)
+
+    assert len(out_times) <= 102  # max_points + первая и последняя точки
+    assert out_times[0] == 0 and out_times[-1] == 999
+    assert np.all(np.diff(out_times) > 0)
+    # выбросы не теряются при прореживании
+    assert 123 in out_times and 777 in out_times
+    np.testing.assert_array_equal(out_values, values[out_times])
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+
+import pytest
+
+import strategy_optimizer
+from batch_optimize import LeaseLostError, check_lease
+from batch_worker import should_fail_stale_trials
+from fakes import FakeConnection
+
+
+@pytest.mark.parametrize("attempts, prev_status, expected", [
+    (1, "pending", False),   # первая попытка: чужих RUNNING trial-ов нет
+    (2, "pending", False),
+    (2, "running", True),    # перехват у воркера с истёкшим lease
+    (3, "failed", True),     # прежний владелец сам записал failed
+    (1, "running", False),
+])
+def test_should_fail_stale_trials(attempts, prev_status, expected):
+    assert should_fail_stale_trials({"attempts": attempts, "prev_status": prev_status}) is expected
+
+
+def test_check_lease_passes_for_owner():
+    conn = FakeConnection(rows=[(1,)])
+    check_lease(conn, 7, "host:1")
+    sql, params = conn.executed[0]
+    assert "FOR UPDATE" in sql
+    assert params == (7, "host:1")
+
+
+def test_check_lease_raises_when_taken_over():
+    with pytest.raises(LeaseLostError):
+        check_lease(FakeConnection(rows=[]), 7, "host:1")
+
+
+def test_best_run_is_not_written_after_lease_loss(monkeypatch):
+    conn = FakeConnection(rows=[])
+
+    @contextmanager
+    def fake_connection(cfg=None):
+        yield conn
+
+    written = []
+    monkeypatch.setattr(strategy_optimizer, "connection", fake_connection)
+    monkeypatch.setattr(strategy_optimizer, "execute_prepared", lambda *a, **k: written.append(a))
+    monkeypatch.setattr(strategy_optimizer, "save_run_details", lambda *a, **k: written.append(a))
+
+    with pytest.raises(LeaseLostError):
+        strategy_optimizer.insert_backtest_run(
+            optimization_id=1, cfg_id=1, symbol_id=1, timeframe_table="candles_5m",
+            window=(None, None), trial_number=0, params={}, metrics={}, is_best=True,
+            guard=lambda c: check_lease(c, 7, "host:1"),
+        )
+    assert written == []
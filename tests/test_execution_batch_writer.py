@@ -0,0 +1,70 @@
+import psycopg2
+import pytest
+
+from execution_engine import BatchWriter
+from fakes import FakeConnection, sql_text
+
+
+# количество, которое не лезет в numeric(20, 6): DataError на одной строке пачки
+POISON_QTY = 1e30
+
+
+def fail_on_poison(sql, params):
+    return sql_text(sql).lstrip().startswith("INSERT") and repr(POISON_QTY) in sql_text(sql)
+
+
+def make_writer():
+    writer = BatchWriter()
+    for signal_id, symbol, qty in ((1, "SBER", 10.0), (2, "VTBR", POISON_QTY), (3, "GAZP", 10.0)):
+        writer.add_order(signal_id, 10, symbol, "1h", "BUY", qty, 100.0, "LIMIT")
+        writer.mark_processed(signal_id)
+    writer.add_error("too_wide_stop", severity="info", strategy_universe_id=10, symbol="LKOH",
+                     timeframe="1h", details={"live_signal_id": 4})
+    writer.mark_processed(4)
+    return writer
+
+
+def processed_updates(conn):
+    return [params[0] for sql, params in conn.executed if "UPDATE live_signals" in sql_text(sql)]
+
+
+def test_flush_writes_batch_in_one_go():
+    conn = FakeConnection()
+    writer = make_writer()
+    writer.orders = [o for o in writer.orders if o[5] != POISON_QTY]
+
+    writer.flush(conn)
+
+    assert processed_updates(conn) == [[1, 2, 3, 4]]
+    assert not any("ROLLBACK" in sql_text(sql) for sql, _ in conn.executed)
+    assert conn.commits == 1
+    assert len(writer) == 0
+
+
+def test_poison_signal_is_isolated_and_closed():
+    conn = FakeConnection(fail_on=fail_on_poison, error=psycopg2.DataError)
+    writer = make_writer()
+
+    writer.flush(conn)
+
+    executed = [sql_text(sql) for sql, _ in conn.executed]
+    assert "ROLLBACK TO SAVEPOINT batch_writer" in executed
+    assert executed.count("ROLLBACK TO SAVEPOINT batch_writer_signal") == 1
+    # после пачечной попытки (без UPDATE) - по сигналу, плохой закрыт отдельно
+    assert processed_updates(conn) == [[1], [2], [3], [4]]
+    failed = [sql for sql in executed if "signal_write_failed" in sql]
+    assert len(failed) == 1 and "'VTBR'" in failed[0]
+    assert conn.commits == 1
+    assert len(writer) == 0
+
+
+def test_connection_failure_keeps_batch_for_retry():
+    conn = FakeConnection(fail_on=lambda sql, params: "SAVEPOINT" not in sql_text(sql) or "ROLLBACK" in sql_text(sql),
+                          error=psycopg2.OperationalError)
+    writer = make_writer()
+
+    with pytest.raises(psycopg2.OperationalError):
+        writer.flush(conn)
+
+    assert conn.commits == 0
+    assert len(writer) == 4
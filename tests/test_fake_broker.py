@@ -0,0 +1,292 @@
+from datetime import datetime, timezone
+
+import psycopg2
+import pytest
+
+import fake_broker
+from fake_broker import Ledger, OrderBook
+from utils_prices import LastBar
+from fakes import FakeConnection, sql_text
+
+NOW = datetime(2024, 3, 4, 10, 0, tzinfo=timezone.utc)
+
+# количество, которое не лезет в numeric(20, 6): DataError на одной заявке пачки
+POISON_QTY = 1e30
+
+
+def order(order_id, side="BUY", qty=10.0, symbol="SBER", su_id=1, order_type="MARKET", price=None):
+    return {
+        "id": order_id,
+        "strategy_universe_id": su_id,
+        "symbol": symbol,
+        "timeframe": "1h",
+        "side": side,
+        "quantity": qty,
+        "order_type": order_type,
+        "price": price,
+    }
+
+
+def make_ledger(free_cash=100_000.0):
+    ledger = Ledger(clock=lambda: NOW)
+    ledger.equity = ledger.free_cash = free_cash
+    return ledger
+
+
+# --- Учёт позиций и денег ---
+
+
+def test_fill_opens_and_averages_long():
+    ledger = make_ledger()
+    ledger.fill(order(1, qty=10), 100.0, fee=1.0)
+    ledger.fill(order(2, qty=10), 110.0, fee=1.1)
+
+    pos = ledger.positions[(1, "SBER")]
+    assert (pos.direction, pos.quantity, pos.avg_price) == ("LONG", 20, pytest.approx(105.0))
+    assert pos.opened_at == NOW
+    assert ledger.free_cash == pytest.approx(100_000 - 1000 - 1 - 1100 - 1.1)
+
+
+def test_partial_close_realizes_pnl_and_full_close_goes_flat():
+    ledger = make_ledger()
+    ledger.fill(order(1, qty=20), 105.0, fee=0.0)
+    ledger.fill(order(2, side="SELL", qty=5), 120.0, fee=0.0)
+
+    pos = ledger.positions[(1, "SBER")]
+    assert pos.quantity == 15
+    assert pos.realized_pnl == pytest.approx(75.0)
+
+    ledger.fill(order(3, side="SELL", qty=15), 100.0, fee=0.0)
+    assert (pos.direction, pos.quantity, pos.avg_price) == ("FLAT", 0, 0.0)
+    assert pos.realized_pnl == pytest.approx(75.0 - 75.0)
+
+
+def test_short_position_accounting():
+    ledger = make_ledger()
+    ledger.fill(order(1, side="SELL", qty=10), 50.0, fee=0.5)
+    ledger.fill(order(2, side="BUY", qty=4), 45.0, fee=0.0)
+
+    pos = ledger.positions[(1, "SBER")]
+    assert (pos.direction, pos.quantity) == ("SHORT", 6)
+    assert pos.realized_pnl == pytest.approx(20.0)
+    assert ledger.free_cash == pytest.approx(100_000 + 500 - 0.5 - 180)
+
+
+def test_fill_records_trade_and_status():
+    ledger = make_ledger()
+    ledger.fill(order(7, qty=10), 100.0, fee=0.1, quantity=4, status="PARTIALLY_FILLED")
+
+    assert ledger._trades == [(7, 1, "SBER", "1h", "BUY", 4, 100.0, 0.1, "FILL")]
+    assert ledger._order_updates[7] == (7, "PARTIALLY_FILLED", "fake-7")
+
+
+# --- Запись пачки ---
+
+
+def broker_db(fail_on=None):
+    def responder(sql, params):
+        text = sql_text(sql)
+        if "FROM live_positions" in text:
+            return []
+        if "FROM account_state" in text:
+            return [{"equity": 100_000.0, "free_cash": 100_000.0, "used_margin": 0}]
+        if "INTO account_state" in text:
+            return [(100_000.0, 99_000.0, 0)]
+        return []
+
+    return FakeConnection(fail_on=fail_on, error=psycopg2.DataError, responder=responder)
+
+
+def test_flush_writes_batch_in_one_go():
+    conn = broker_db()
+    ledger = make_ledger()
+    ledger.fill(order(1), 100.0, fee=0.1)
+
+    assert ledger.flush(conn) == set()
+    assert conn.commits == 1
+    assert not any("ROLLBACK" in sql_text(sql) for sql, _ in conn.executed)
+    assert ledger.free_cash == 99_000.0
+    assert not ledger._journal and not ledger._trades
+
+
+def test_poison_order_is_rejected_and_rest_is_written():
+    def fail_on(sql, params):
+        return sql_text(sql).lstrip().startswith("INSERT") and repr(POISON_QTY) in sql_text(sql)
+
+    conn = broker_db(fail_on)
+    ledger = make_ledger()
+    ledger.fill(order(1, symbol="SBER"), 100.0, fee=0.1)
+    ledger.fill(order(2, symbol="GAZP", qty=POISON_QTY), 150.0, fee=0.0)
+    ledger.fill(order(3, symbol="LKOH"), 50.0, fee=0.1)
+    ledger.add_error("no_market_price_for_symbol", symbol="VTBR", details={"order_id": 4})
+    ledger.set_order_status(4, "REJECTED")
+
+    rejected = ledger.flush(conn)
+
+    assert rejected == {2}
+    executed = [sql_text(sql) for sql, _ in conn.executed]
+    assert "ROLLBACK TO SAVEPOINT ledger_flush" in executed
+    assert executed.count("ROLLBACK TO SAVEPOINT ledger_order") == 1
+    assert executed.count("RELEASE SAVEPOINT ledger_order") == 3
+
+    position_writes = [sql for sql in executed if "INTO live_positions" in sql and "ROLLBACK" not in sql]
+    assert any("'SBER'" in sql for sql in position_writes)
+    assert any("'LKOH'" in sql for sql in position_writes)
+
+    status_writes = [sql for sql in executed if "UPDATE live_orders" in sql]
+    assert any("(2::bigint, 'REJECTED'::text" in sql for sql in status_writes)
+    assert sum("order_write_failed" in sql for sql in executed) == 1
+    assert conn.commits == 1
+    assert not ledger._journal
+
+
+def test_connection_failure_keeps_batch_for_reload():
+    conn = FakeConnection(fail_on=lambda sql, params: "SAVEPOINT" not in sql_text(sql) or "ROLLBACK" in sql_text(sql),
+                          error=psycopg2.OperationalError)
+    ledger = make_ledger()
+    ledger.fill(order(1), 100.0, fee=0.1)
+
+    with pytest.raises(psycopg2.OperationalError):
+        ledger.flush(conn)
+    assert conn.commits == 0
+
+
+def test_discard_removes_resting_order():
+    book = OrderBook()
+    book.add(order(5, order_type="LIMIT", price=90.0), 10.0)
+    book.add(order(6, order_type="LIMIT", price=95.0), 10.0)
+
+    book.discard({5, 42})
+
+    assert list(book.orders) == [6]
+    assert book.books["SBER"].buy_limits == [(95.0, 6)]
+
+
+# --- Стакан LIMIT/STOP ---
+
+
+T0 = datetime(2024, 3, 4, 10, 0, tzinfo=timezone.utc)
+T1 = datetime(2024, 3, 4, 10, 1, tzinfo=timezone.utc)
+
+
+def bar(low, high, open_=None, volume=None, ts=T1):
+    open_ = open_ if open_ is not None else (low + high) / 2
+    return LastBar(ticker="SBER", bar_timestamp=ts, price=open_, open=open_, high=high, low=low, volume=volume)
+
+
+def make_book(lot=1):
+    book = OrderBook()
+    book.symbol_lots["SBER"] = (1, lot)
+    return book
+
+
+def resting(book, order_id, side, order_type, price, qty):
+    book.add(order(order_id, side=side, qty=qty, order_type=order_type, price=price), qty, placed_after=T0)
+
+
+def test_match_fills_only_orders_touched_by_bar():
+    book = make_book()
+    resting(book, 1, "BUY", "LIMIT", 99.0, 10)    # low 98 <= 99 - исполняется
+    resting(book, 2, "BUY", "LIMIT", 97.0, 10)    # ниже low - ждёт
+    resting(book, 3, "SELL", "LIMIT", 101.5, 10)  # high 102 >= 101.5 - исполняется
+    resting(book, 4, "SELL", "LIMIT", 103.0, 10)  # выше high - ждёт
+    resting(book, 5, "BUY", "STOP", 101.0, 10)    # high пробил стоп
+    resting(book, 6, "SELL", "STOP", 97.5, 10)    # low не дошёл до стопа
+    ledger = make_ledger()
+
+    fills = book.match(ledger, bar(98.0, 102.0, open_=100.0))
+
+    assert fills == 3
+    assert sorted(book.orders) == [2, 4, 6]
+    assert book.books["SBER"].buy_limits == [(97.0, 2)]
+    assert book.books["SBER"].sell_limits == [(103.0, 4)]
+    assert book.books["SBER"].buy_stops == []
+    prices = {trade[0]: trade[6] for trade in ledger._trades}
+    assert prices[1] == 99.0 and prices[3] == 101.5
+    assert prices[5] == pytest.approx(101.0 * 1.0005)
+
+
+def test_match_skips_bar_of_placement_and_first_seen_bar():
+    book = make_book()
+    resting(book, 1, "BUY", "LIMIT", 99.0, 10)
+    ledger = make_ledger()
+
+    assert book.match(ledger, bar(98.0, 102.0, ts=T0)) == 0
+    assert book.match(ledger, bar(98.0, 102.0, ts=T1)) == 1
+
+
+def test_budget_goes_to_best_priced_orders_first():
+    book = make_book()
+    resting(book, 1, "BUY", "LIMIT", 99.0, 30)
+    resting(book, 2, "BUY", "LIMIT", 100.0, 30)
+    ledger = make_ledger()
+
+    # бюджет минутки: floor(400 * 0.1) = 40
+    book.match(ledger, bar(98.0, 102.0, volume=400))
+
+    filled = {trade[0]: trade[5] for trade in ledger._trades}
+    assert filled == {2: 30, 1: 10}
+    assert book.orders[1].remaining == 20
+    assert ledger._order_updates[1][1] == "PARTIALLY_FILLED"
+    assert ledger._order_updates[2][1] == "FILLED"
+
+
+def test_partial_fill_is_rounded_down_to_whole_lots():
+    book = make_book(lot=10)
+    resting(book, 1, "BUY", "LIMIT", 99.0, 100)
+    ledger = make_ledger()
+
+    # бюджет 35 -> 3 лота по 10
+    book.match(ledger, bar(98.0, 102.0, volume=350))
+
+    assert [trade[5] for trade in ledger._trades] == [30]
+    assert book.orders[1].remaining == 70
+
+
+def test_budget_below_one_lot_leaves_order_waiting():
+    book = make_book(lot=10)
+    resting(book, 1, "BUY", "LIMIT", 99.0, 100)
+    ledger = make_ledger()
+
+    assert book.match(ledger, bar(98.0, 102.0, volume=90)) == 0
+    assert ledger._trades == []
+    assert book.orders[1].remaining == 100
+
+
+def test_lot_size_prefers_lot_history():
+    class History:
+        def has_history(self, symbol_id):
+            return symbol_id == 1
+
+        def get_lotsize(self, symbol_id, as_of):
+            return 100
+
+    book = OrderBook(lot_cache=History())
+    book.symbol_lots.update({"SBER": (1, 10), "GAZP": (2, 10)})
+
+    assert book.lot_size("SBER", T1) == 100
+    assert book.lot_size("GAZP", T1) == 10
+    assert book.lot_size("UNKNOWN", T1) == 1
+
+
+def test_refresh_lots_is_throttled(monkeypatch):
+    class History:
+        def __init__(self):
+            self.refreshes = 0
+
+        def refresh(self, conn):
+            self.refreshes += 1
+            return False
+
+    clock = [1000.0]
+    monkeypatch.setattr("fake_broker.time.monotonic", lambda: clock[0])
+    history = History()
+    book = OrderBook(lot_cache=history)
+
+    assert not book.refresh_lots(FakeConnection())
+    clock[0] += fake_broker.LOT_REFRESH_SECONDS
+    book.refresh_lots(FakeConnection())
+    book.refresh_lots(FakeConnection())
+
+    assert history.refreshes == 1
+    assert not OrderBook().refresh_lots(FakeConnection())
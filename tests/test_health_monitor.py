@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from health_monitor import MISSING_RUN_MINUTES, check_service_heartbeat, check_symbol_data, longest_missing_runs
+
+NOW = datetime(2024, 3, 4, 12, 0, tzinfo=timezone.utc)
+
+
+def make_control():
+    return {"allow_trading": True, "allow_new_positions": True, "comment": None}
+
+
+def run_check(status, service_name="execution_engine", timeout_sec=60):
+    control, events = make_control(), []
+    check_service_heartbeat(status, NOW, service_name, timeout_sec, control, events)
+    return control, events
+
+
+def test_fresh_heartbeat_is_ok():
+    control, events = run_check({"last_heartbeat": NOW - timedelta(seconds=5), "status": "ok", "details_json": None})
+
+    assert events == []
+    assert control["allow_trading"]
+
+
+def test_busy_within_timeout_is_ok():
+    status = {
+        "last_heartbeat": NOW - timedelta(seconds=5),
+        "status": "busy",
+        "details_json": {"iteration_seconds": 40.0},
+    }
+
+    _, events = run_check(status)
+
+    assert events == []
+
+
+def test_busy_longer_than_timeout_is_down_despite_fresh_heartbeat():
+    status = {
+        "last_heartbeat": NOW - timedelta(seconds=5),
+        "status": "busy",
+        "details_json": {"iteration_seconds": 58.0},
+    }
+
+    control, events = run_check(status)
+
+    assert [e[0] for e in events] == ["execution_engine_down"]
+    assert events[0][4]["busy_seconds"] == 63.0
+    assert not control["allow_trading"]
+
+
+def test_stale_iteration_seconds_ignored_after_busy_ends():
+    # COALESCE в update_service_heartbeat оставляет старый details_json при status='ok'
+    status = {
+        "last_heartbeat": NOW - timedelta(seconds=5),
+        "status": "ok",
+        "details_json": {"iteration_seconds": 600.0},
+    }
+
+    _, events = run_check(status)
+
+    assert events == []
+
+
+def test_missing_heartbeat_is_down():
+    _, events = run_check({"last_heartbeat": NOW - timedelta(seconds=90), "status": "ok", "details_json": None})
+
+    assert [e[0] for e in events] == ["execution_engine_down"]
+
+
+def minutes_of(rows):
+    """[(symbol_id, [минуты]), ...] -> (row_symbols, minutes) как из load_recent_minutes"""
+    symbols = [symbol_id for symbol_id, minutes in rows for _ in minutes]
+    minutes = [minute for _, minutes in rows for minute in minutes]
+    return np.array(symbols, dtype=np.int64), np.array(minutes, dtype=np.int64)
+
+
+def test_longest_missing_runs_picks_longest_gap_per_symbol():
+    # сетка - минуты 0..9, в которые минутки есть у инструмента 1
+    row_symbols, minutes = minutes_of([
+        (1, range(10)),                 # без разрывов
+        (2, [0, 3, 4, 9]),              # разрывы 1-2 и 5-8: самый длинный - 4 минуты с 5
+        (3, [5, 6, 7, 8, 9]),           # разрыв в начале окна
+        (4, [0, 1, 2]),                 # разрыв до конца окна
+    ])
+    symbol_ids = np.array([1, 2, 3, 4, 5], dtype=np.int64)   # у 5 минуток нет вовсе
+
+    longest, first_minute = longest_missing_runs(symbol_ids, row_symbols, minutes)
+
+    assert longest.tolist() == [0, 4, 5, 7, 10]
+    assert first_minute.tolist() == [-1, 5, 0, 3, 0]
+
+
+def test_longest_missing_runs_ignores_market_pauses():
+    # минуты 3-5 не было данных ни у одного инструмента (перерыв торгов)
+    row_symbols, minutes = minutes_of([(1, [0, 1, 2, 6, 7]), (2, [0, 1, 2, 6, 7])])
+
+    longest, first_minute = longest_missing_runs(np.array([1, 2], dtype=np.int64), row_symbols, minutes)
+
+    assert longest.tolist() == [0, 0]
+    assert first_minute.tolist() == [-1, -1]
+
+
+def test_longest_missing_runs_empty_window():
+    longest, first_minute = longest_missing_runs(
+        np.array([1, 2], dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    )
+
+    assert longest.tolist() == [0, 0]
+    assert first_minute.tolist() == [-1, -1]
+
+
+def test_check_symbol_data_blocks_gapped_symbol_and_releases_recovered():
+    last_bar = datetime(2024, 3, 4, 12, 0)
+    freshness = [
+        {"symbol_id": 1, "ticker": "SBER", "bar_timestamp": last_bar},
+        {"symbol_id": 2, "ticker": "GAZP", "bar_timestamp": last_bar},
+    ]
+    window = MISSING_RUN_MINUTES + 5
+    row_symbols, minutes = minutes_of([(1, range(window)), (2, range(MISSING_RUN_MINUTES, window))])
+    events = []
+
+    blocked = check_symbol_data(freshness, row_symbols, minutes, {1: "symbol_data_stale"}, events)
+
+    assert list(blocked) == [2]
+    assert blocked[2][:2] == ("GAZP", "symbol_minutes_missing")
+    assert blocked[2][2]["missing_minutes"] == MISSING_RUN_MINUTES
+    assert [(e[0], e[3]) for e in events] == [("symbol_minutes_missing", "GAZP"), ("symbol_data_recovered", "SBER")]
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from utils_indicators import INDICATOR_CACHE, clear_indicator_cache, get_or_compute, sma
+
+
+@pytest.fixture(autouse=True)
+def clean_cache():
+    INDICATOR_CACHE.clear()
+    yield
+    INDICATOR_CACHE.clear()
+
+
+def test_same_indicator_on_different_series_is_cached_separately():
+    close = np.arange(10, dtype=float)
+    high = close * 2
+
+    sma_close = get_or_compute("k", "sma", (3,), sma, close, inputs=("Close",))
+    sma_high = get_or_compute("k", "sma", (3,), sma, high, inputs=("High",))
+
+    np.testing.assert_allclose(sma_high[2:], sma_close[2:] * 2)
+    assert len(INDICATOR_CACHE) == 2
+
+
+def test_repeated_call_returns_cached_value():
+    calls = []
+
+    def func(x, period):
+        calls.append(period)
+        return sma(x, period)
+
+    close = np.arange(10, dtype=float)
+    first = get_or_compute("k", "sma", (3,), func, close, inputs=("Close",))
+    second = get_or_compute("k", "sma", (3,), func, close, inputs=("Close",))
+
+    assert first is second
+    assert calls == [3]
+
+
+def test_without_inputs_or_data_key_nothing_is_cached():
+    close = np.arange(10, dtype=float)
+    get_or_compute("k", "sma", (3,), sma, close)
+    get_or_compute(None, "sma", (3,), sma, close, inputs=("Close",))
+    assert INDICATOR_CACHE == {}
+
+
+def test_clear_by_data_key():
+    close = np.arange(10, dtype=float)
+    get_or_compute("a", "sma", (3,), sma, close, inputs=("Close",))
+    get_or_compute("b", "sma", (3,), sma, close, inputs=("Close",))
+    clear_indicator_cache("a")
+    assert [key[0] for key in INDICATOR_CACHE] == ["b"]
@@ -0,0 +1,59 @@
+import queue
+import threading
+
+import execution_engine
+from fakes import FakeConnection
+from pipeline import ExecutionStage, skip_drained
+
+
+def test_skip_drained_drops_and_forgets_ids():
+    drained = {2, 3}
+    rows = [{"id": 1}, {"id": 2}, {"id": 4}]
+
+    assert skip_drained(rows, drained) == [{"id": 1}, {"id": 4}]
+    assert drained == {3}
+
+
+def make_execution_stage():
+    stage = ExecutionStage(queue.Queue(), queue.Queue(), threading.Event())
+    stage.conn = FakeConnection()
+    stage.lot_cache = object()
+    return stage
+
+
+def test_execution_on_error_drains_table_and_skips_queued_duplicates(monkeypatch):
+    stage = make_execution_stage()
+    backlog = [[{"id": 1}, {"id": 2}], [{"id": 3}], []]
+
+    def fake_run_once(conn, lot_cache, consumer_name, processed=None):
+        batch = backlog.pop(0)
+        processed.update(s["id"] for s in batch)
+        return len(batch)
+
+    monkeypatch.setattr(execution_engine, "run_once", fake_run_once)
+    stage.on_error()
+
+    assert backlog == []
+    assert stage.outbox.get_nowait() == ("backlog", None)
+
+    # сигнал 3 уже записан дочиткой и пришёл из очереди позже - повторно не исполняется
+    handled = []
+    monkeypatch.setattr(execution_engine, "process_signal_batch",
+                        lambda conn, signals, lot_cache: handled.extend(signals) or [])
+    stage._lot_checked_at = float("inf")
+    stage.handle([{"id": 3}, {"id": 5}])
+
+    assert handled == [{"id": 5}]
+    assert stage.drained == {1, 2}
+
+
+def test_execution_on_error_before_start_does_nothing(monkeypatch):
+    stage = make_execution_stage()
+    stage.lot_cache = None
+    calls = []
+    monkeypatch.setattr(execution_engine, "run_once", lambda *args, **kwargs: calls.append(args) or 0)
+
+    stage.on_error()
+
+    assert calls == []
+    assert stage.outbox.empty()
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import pytest
+
+from fakes import FakeConnection, sql_text
+from utils_latency import LATENCY_BUCKETS_MS, LatencyRecorder, histogram, histogram_percentile
+
+
+def test_histogram_puts_bound_values_into_their_bucket():
+    counts = histogram([0.5, 1.0, 1.5, 60000.0, 90000.0])
+
+    assert len(counts) == len(LATENCY_BUCKETS_MS) + 1
+    assert counts[0] == 2      # <= 1 мс
+    assert counts[1] == 1      # (1, 2]
+    assert counts[-2] == 1     # (30000, 60000]
+    assert counts[-1] == 1     # > 60000
+
+
+def test_histogram_percentile_interpolates_within_bucket():
+    values = [10.0 + i * 0.1 for i in range(100)]    # 10.0 .. 19.9: корзины (5, 10] и (10, 20]
+
+    p50 = histogram_percentile(histogram(values), min(values), max(values), 0.5)
+    p99 = histogram_percentile(histogram(values), min(values), max(values), 0.99)
+
+    assert p50 == pytest.approx(15.0, abs=0.2)
+    assert p99 == pytest.approx(19.9, abs=0.2)
+
+
+def test_histogram_percentile_clamps_to_observed_range():
+    values = [70000.0, 80000.0]
+
+    assert histogram_percentile(histogram(values), 70000.0, 80000.0, 0.99) <= 80000.0
+    assert histogram_percentile(histogram(values), 70000.0, 80000.0, 0.01) >= 70000.0
+    assert histogram_percentile([0] * (len(LATENCY_BUCKETS_MS) + 1), 0.0, 0.0, 0.5) == 0.0
+
+
+def test_flush_writes_one_aggregated_row_per_metric():
+    recorder = LatencyRecorder("execution_engine")
+    now = datetime(2024, 3, 4, 12, 0, tzinfo=timezone.utc)
+    recorder.duration(0.25, 3)
+    for ms in (100, 300, 200):
+        recorder.lag(now - timedelta(milliseconds=ms), until=now)
+    recorder.lag(None)
+
+    rows = {row[1]: row for row in recorder.rows()}
+    conn = FakeConnection()
+    written = recorder.flush(conn)
+
+    assert written == 4
+    assert len(recorder) == 0
+    _, metric, samples, min_ms, max_ms, sum_ms, buckets, items = rows["lag"]
+    assert (samples, min_ms, max_ms, sum_ms, items) == (3, 100.0, 300.0, 600.0, None)
+    assert sum(buckets) == 3
+    assert rows["duration"][2:6] == (1, 250.0, 250.0, 250.0)
+    assert rows["duration"][7] == 3
+
+    sqls = [sql_text(sql) for sql, _ in conn.executed]
+    assert sqls[0] == "SAVEPOINT latency_trace"
+    assert sum("INSERT INTO latency_trace" in sql for sql in sqls) == 1
+    assert sqls[-1] == "RELEASE SAVEPOINT latency_trace"
+
+
+def test_flush_failure_rolls_back_to_savepoint_and_is_not_fatal():
+    recorder = LatencyRecorder("fake_broker")
+    recorder.duration(0.01, 1)
+    conn = FakeConnection(
+        fail_on=lambda sql, params: "INSERT INTO latency_trace" in sql_text(sql),
+        error=psycopg2.Error,
+    )
+
+    assert recorder.flush(conn) == 0
+    assert sql_text(conn.executed[-1][0]) == "ROLLBACK TO SAVEPOINT latency_trace"
+    assert len(recorder) == 0
+
+
+def test_flush_without_samples_does_not_touch_connection():
+    conn = FakeConnection()
+
+    assert LatencyRecorder("data_feed").flush(conn) == 0
+    assert conn.executed == []
@@ -0,0 +1,103 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import utils_lot
+from utils_lot import LotHistorySnapshot, LotHistoryVersion, LotSizeCache, rows_version
+
+
+ROWS = {
+    1: (10, datetime(2024, 1, 1), 10),
+    2: (10, datetime(2024, 6, 1), 100),
+    3: (20, datetime(2024, 3, 1), 5),
+}
+
+
+UPDATED_AT = datetime(2024, 7, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def make_cache(rows=ROWS, max_updated_at=UPDATED_AT):
+    base = rows_version(rows)
+    version = LotHistoryVersion(base.max_change_date, base.max_id, base.row_count, max_updated_at)
+    return LotSizeCache(LotHistorySnapshot(rows=dict(rows), version=version))
+
+
+def test_get_lotsize_by_date():
+    cache = make_cache()
+
+    assert cache.get_lotsize(10, datetime(2023, 12, 31)) == 1  # до первого изменения
+    assert cache.get_lotsize(10, datetime(2024, 1, 1)) == 10
+    assert cache.get_lotsize(10, datetime(2024, 5, 31, 23, 59)) == 10
+    assert cache.get_lotsize(10, datetime(2024, 6, 1, tzinfo=timezone.utc)) == 100
+    assert cache.get_lotsize(10) == 100
+    assert cache.get_lotsize(20, datetime(2024, 4, 1)) == 5
+    assert cache.get_lotsize(99) == 1
+
+
+def test_get_lotsize_repeated_key_uses_last_value():
+    cache = make_cache()
+    as_of = datetime(2024, 2, 1)
+    assert cache.get_lotsize(10, as_of) == 10
+    assert cache.get_lotsize(10, as_of) == 10
+    assert cache.get_lotsize(20, as_of) == 1
+
+
+def test_lot_sizes_for_index_matches_get_lotsize():
+    cache = make_cache()
+    index = pd.DatetimeIndex(["2023-12-31", "2024-01-01", "2024-03-15", "2024-06-01", "2024-07-01"])
+
+    sizes = cache.lot_sizes_for_index(10, index)
+
+    assert sizes.dtype == np.int64
+    np.testing.assert_array_equal(sizes, [1, 10, 10, 100, 100])
+    assert list(sizes) == [cache.get_lotsize(10, ts.to_pydatetime()) for ts in index]
+
+
+def test_lot_sizes_for_index_tz_aware_and_unknown_symbol():
+    cache = make_cache()
+    index = pd.DatetimeIndex(["2024-02-29 23:00", "2024-03-01 03:00"]).tz_localize("Europe/Moscow")
+
+    np.testing.assert_array_equal(cache.lot_sizes_for_index(20, index), [1, 5])
+    np.testing.assert_array_equal(cache.lot_sizes_for_index(99, index), [1, 1])
+
+
+def test_refresh_picks_up_in_place_update(monkeypatch):
+    cache = make_cache()
+    updated = {1: (10, datetime(2024, 1, 1), 1)}
+    db_version = LotHistoryVersion(datetime(2024, 6, 1), 3, 3, datetime(2024, 7, 2, tzinfo=timezone.utc))
+    calls = []
+
+    monkeypatch.setattr(utils_lot, "load_lot_history_version", lambda conn=None: db_version)
+
+    def fake_rows(conn=None, since=None):
+        calls.append(since)
+        return dict(updated) if since is not None else {**ROWS, **updated}
+
+    monkeypatch.setattr(utils_lot, "load_lot_rows", fake_rows)
+
+    assert cache.refresh() is True
+    assert calls == [LotHistoryVersion(datetime(2024, 6, 1), 3, 3, UPDATED_AT)]  # только догрузка изменённых
+    assert cache.get_lotsize(10, datetime(2024, 2, 1)) == 1
+    assert cache.version == db_version
+
+    assert cache.refresh() is False
+
+
+def test_refresh_reloads_everything_after_delete(monkeypatch):
+    cache = make_cache()
+    remaining = {k: v for k, v in ROWS.items() if k != 2}
+    db_version = LotHistoryVersion(datetime(2024, 3, 1), 3, 2, UPDATED_AT)
+    calls = []
+
+    monkeypatch.setattr(utils_lot, "load_lot_history_version", lambda conn=None: db_version)
+
+    def fake_rows(conn=None, since=None):
+        calls.append(since)
+        return {} if since is not None else dict(remaining)
+
+    monkeypatch.setattr(utils_lot, "load_lot_rows", fake_rows)
+
+    assert cache.refresh() is True
+    assert len(calls) == 2 and calls[-1] is None
+    assert cache.get_lotsize(10) == 10
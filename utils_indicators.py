@@ -0,0 +1,129 @@
+"""
+utils_indicators.py - Общие индикаторы с кэшем в пределах процесса
+
+Оптимизация гоняет десятки trial-ов и несколько стратегий на одних и тех же
+свечах, а периоды индикаторов в trial-ах часто повторяются. Поэтому индикаторы
+считаются один раз на (набор данных, индикатор, входные серии, параметры)
+и переиспользуются.
+"""
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+
+
+# Кэш: {(data_key, name, inputs, params): np.ndarray}
+INDICATOR_CACHE: Dict[Tuple[Hashable, str, Tuple[str, ...], Tuple[Any, ...]], Any] = {}
+
+
+def get_or_compute(
+    data_key: Optional[Hashable],
+    name: str,
+    params: Tuple[Any, ...],
+    func: Callable[..., Any],
+    *args,
+    inputs: Optional[Sequence[str]] = None
+) -> Any:
+    """
+    Возвращает значение индикатора из кэша или вычисляет его
+
+    Args:
+        data_key: ключ набора данных (None - без кэширования)
+        name: имя индикатора (например, 'sma')
+        params: параметры индикатора (например, (20,))
+        func: функция расчёта, вызывается как func(*args, *params)
+        args: входные массивы
+        inputs: имена входных серий по порядку args (например, ('Close',));
+            без них значение не кэшируется - иначе sma по High получила бы sma по Close
+
+    Returns:
+        Результат func (массив или кортеж массивов)
+    """
+    if data_key is None or inputs is None:
+        return func(*args, *params)
+
+    key = (data_key, name, tuple(inputs), params)
+    value = INDICATOR_CACHE.get(key)
+    if value is None:
+        value = func(*args, *params)
+        INDICATOR_CACHE[key] = value
+    return value
+
+
+def clear_indicator_cache(data_key: Optional[Hashable] = None):
+    """
+    Очищает кэш индикаторов
+
+    Args:
+        data_key: если задан - удаляются только индикаторы этого набора данных
+    """
+    if data_key is None:
+        INDICATOR_CACHE.clear()
+        return
+
+    for key in [k for k in INDICATOR_CACHE if k[0] == data_key]:
+        del INDICATOR_CACHE[key]
+
+
+# --- Индикаторы ---
+
+def sma(x, period: int) -> np.ndarray:
+    """Простая скользящая средняя"""
+    return pd.Series(x).rolling(period).mean().values
+
+
+def ema(x, period: int) -> np.ndarray:
+    """Экспоненциальная скользящая средняя"""
+    return pd.Series(x).ewm(span=period, adjust=False).mean().values
+
+
+def rolling_std(x, period: int) -> np.ndarray:
+    """Скользящее стандартное отклонение"""
+    return pd.Series(x).rolling(period).std().values
+
+
+def rolling_max(x, period: int) -> np.ndarray:
+    """Скользящий максимум"""
+    return pd.Series(x).rolling(period).max().values
+
+
+def rolling_min(x, period: int) -> np.ndarray:
+    """Скользящий минимум"""
+    return pd.Series(x).rolling(period).min().values
+
+
+def rsi(x, period: int) -> np.ndarray:
+    """RSI по простым средним приростов/падений"""
+    s = pd.Series(x)
+    delta = s.diff()
+    gain = delta.clip(lower=0)
+    loss = -delta.clip(upper=0)
+    avg_gain = gain.rolling(period).mean()
+    avg_loss = loss.rolling(period).mean()
+    rs = avg_gain / avg_loss.replace(0, 1e-8)
+    return (100 - (100 / (1 + rs))).values
+
+
+def atr(o, h, l, c, period: int) -> np.ndarray:
+    """Average True Range (простое среднее TR)"""
+    df = pd.DataFrame({"o": o, "h": h, "l": l, "c": c})
+    prev_close = df["c"].shift(1)
+    tr1 = df["h"] - df["l"]
+    tr2 = (df["h"] - prev_close).abs()
+    tr3 = (df["l"] - prev_close).abs()
+    tr = pd.concat([tr1, tr2, tr3], axis=1).max(axis=1)
+    return tr.rolling(period).mean().values
+
+
+def mfi(h, l, c, v, period: int) -> np.ndarray:
+    """Money Flow Index"""
+    tp = (h + l + c) / 3.0
+    mf = tp * v
+    df = pd.DataFrame({"tp": tp, "mf": mf})
+    delta_tp = df["tp"].diff()
+    pos_mf = df["mf"].where(delta_tp > 0, 0.0)
+    neg_mf = df["mf"].where(delta_tp < 0, 0.0)
+    sum_pos = pos_mf.rolling(period).sum()
+    sum_neg = (-neg_mf).rolling(period).sum()
+    sum_neg = sum_neg.replace(0, 1e-8)
+    mr = sum_pos / sum_neg
+    return (100 - (100 / (1 + mr))).values
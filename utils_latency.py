@@ -0,0 +1,153 @@
+"""
+utils_latency.py - Замеры задержек цепочки демонов (таблица latency_trace)
+
+Каждый этап пишет два вида замеров (stage = service_name демона):
+    - duration: сколько длилась обработка пачки (мс, items - размер пачки);
+    - lag: сколько прошло от записи входа предыдущим этапом до обработки (мс):
+        data_feed        - от появления минутки в candles_1m (ingested_at) до записи агрегатов;
+        strategy_runner  - от записи бара в candles_xx (ingested_at) до сигналов по нему;
+        execution_engine - от записи сигнала (live_signals.created_at) до заявки;
+        fake_broker      - от создания заявки (live_orders.created_at) до исполнения.
+
+Замеры копятся в памяти, а пишутся агрегатом: одна строка на (этап, метрику) за
+пачку - число замеров, min/max/сумма и гистограмма по LATENCY_BUCKETS_MS. Так запись
+не растёт с размером пачки (execution_engine и fake_broker меряют lag каждого
+сигнала/заявки). Перцентили по скользящему окну health_monitor оценивает по сумме
+гистограмм (histogram_percentile) и кладёт в service_status.details_json.
+
+Запись идёт в транзакции этапа (без commit) под своим SAVEPOINT: сбой записи
+замеров откатывается и логируется, не роняя пачку этапа.
+"""
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+# Выключатель замеров (replay выключает: его время симулированное)
+ENABLED = True
+
+# Верхние границы корзин гистограммы (мс); последняя корзина - всё, что больше
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+logger = logging.getLogger("utils_latency")
+
+
+def histogram(values: Sequence[float]) -> List[int]:
+    """Число замеров в каждой корзине LATENCY_BUCKETS_MS (len(LATENCY_BUCKETS_MS) + 1)"""
+    counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for value in values:
+        counts[bisect_left(LATENCY_BUCKETS_MS, value)] += 1
+    return counts
+
+
+def histogram_percentile(buckets: Sequence[int], min_ms: float, max_ms: float, q: float) -> float:
+    """
+    Оценка перцентиля q (0..1) по гистограмме
+
+    Внутри корзины значение интерполируется линейно; границы корзин
+    сужаются до фактических min_ms/max_ms замеров.
+    """
+    total = sum(buckets)
+    if total == 0:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count == 0:
+            continue
+        if seen + count >= rank:
+            lower = max(LATENCY_BUCKETS_MS[i - 1] if i > 0 else min_ms, min_ms)
+            upper = min(LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else max_ms, max_ms)
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return max_ms
+
+
+class LatencyRecorder:
+    """Замеры одного этапа до записи в latency_trace"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        # {metric: [value_ms, ...]} и {metric: сумма items}
+        self.values: Dict[str, List[float]] = {}
+        self.items: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return sum(len(values) for values in self.values.values())
+
+    def _add(self, metric: str, value_ms: float, items: Optional[int]):
+        self.values.setdefault(metric, []).append(value_ms)
+        if items is not None:
+            self.items[metric] = self.items.get(metric, 0) + items
+
+    def duration(self, seconds: float, items: Optional[int] = None):
+        if ENABLED:
+            self._add("duration", seconds * 1000.0, items)
+
+    def lag(self, since: Optional[datetime], items: Optional[int] = None, until: Optional[datetime] = None):
+        """Задержка от since (timezone-aware) до until (None - сейчас); без since замер пропускается"""
+        if not ENABLED or since is None:
+            return
+        if until is None:
+            until = datetime.now(timezone.utc)
+        self._add("lag", (until - since).total_seconds() * 1000.0, items)
+
+    @contextmanager
+    def timed(self, items: Optional[int] = None) -> Iterator[None]:
+        """Замер duration блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.duration(time.perf_counter() - started, items)
+
+    def clear(self):
+        self.values.clear()
+        self.items.clear()
+
+    def rows(self) -> List[tuple]:
+        """Агрегаты накопленного: (stage, metric, samples, min_ms, max_ms, sum_ms, buckets, items)"""
+        return [
+            (self.stage, metric, len(values), min(values), max(values), sum(values),
+             histogram(values), self.items.get(metric))
+            for metric, values in self.values.items()
+        ]
+
+    def flush(self, conn) -> int:
+        """
+        Пишет агрегаты накопленных замеров в latency_trace (без commit)
+
+        Ошибка записи откатывается до SAVEPOINT и только логируется:
+        транзакция этапа продолжается без замеров.
+
+        Returns:
+            число записанных замеров
+        """
+        rows = self.rows()
+        self.clear()
+        if not rows:
+            return 0
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT latency_trace")
+            try:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO latency_trace (stage, metric, samples, min_ms, max_ms, sum_ms,
+                                               buckets, items, recorded_at)
+                    VALUES %s
+                    """,
+                    rows,
+                    template="(%s, %s, %s, %s, %s, %s, %s::integer[], %s, clock_timestamp())",
+                )
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT latency_trace")
+                logger.warning(f"Не удалось записать замеры {self.stage} в latency_trace: {e}")
+                return 0
+            cur.execute("RELEASE SAVEPOINT latency_trace")
+        return sum(row[2] for row in rows)
@@ -1,12 +1,125 @@
 """
 utils_lot.py - Утилиты для работы с размерами лотов
 """
+from bisect import bisect_right
+from dataclasses import dataclass
 from typing import Dict, List, Optional, Tuple
-import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime, timezone
 import numpy as np
+import pandas as pd
 from configloader import DBCFG
+from db_pool import connection
+
+
+# Строка lot_history: {id: (symbol_id, change_date как в БД, lot_size)}
+LotRow = Tuple[int, datetime, int]
+
+
+@dataclass(frozen=True)
+class LotHistoryVersion:
+    """
+    Отметка версии lot_history
+
+    max_change_date/max_id/row_count меняются при вставке и удалении строк,
+    max_updated_at - ещё и при UPDATE на месте: updated_at строки ставит
+    триггер trg_set_timestamp_lot_history (xmin для этого не годится - после
+    wraparound счётчика транзакций он сравнивается неверно). Строки кэша
+    updated_at не хранят (rows_version даёт None), его знает только БД.
+    """
+    max_change_date: Optional[datetime]
+    max_id: Optional[int]
+    row_count: int
+    max_updated_at: Optional[datetime] = None
+
+    def rows_part(self) -> "LotHistoryVersion":
+        """Версия без max_updated_at (сравнима с rows_version)"""
+        return LotHistoryVersion(self.max_change_date, self.max_id, self.row_count)
+
+
+@dataclass
+class LotHistorySnapshot:
+    """
+    Снимок lot_history с версией (pickle-friendly)
+
+    Родительский процесс загружает его один раз и передаёт воркерам,
+    чтобы они не читали таблицу сами.
+    """
+    rows: Dict[int, LotRow]
+    version: LotHistoryVersion
+
+
+def _query(conn, sql: str, params: tuple = ()) -> list:
+    """SELECT через переданное соединение или через соединение из пула процесса (DBCFG)"""
+    if conn is None:
+        with connection(DBCFG) as pooled:
+            return _query(pooled, sql, params)
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+
+def load_lot_history_version(conn=None) -> LotHistoryVersion:
+    """Текущая версия lot_history в БД (один агрегирующий запрос)"""
+    row = _query(
+        conn,
+        """
+        SELECT MAX(change_date) AS max_change_date, MAX(id) AS max_id, COUNT(*) AS row_count,
+               MAX(updated_at) AS max_updated_at
+        FROM lot_history
+        """,
+    )[0]
+    return LotHistoryVersion(row['max_change_date'], row['max_id'], int(row['row_count']), row['max_updated_at'])
+
+
+def load_lot_rows(conn=None, since: Optional[LotHistoryVersion] = None) -> Dict[int, LotRow]:
+    """
+    Загружает строки lot_history
+
+    Args:
+        conn: соединение (None - своё соединение по DBCFG)
+        since: только строки, вставленные или изменённые после этой версии
+            (id > max_id или updated_at > max_updated_at) - догрузка изменений
+    """
+    if since is None:
+        rows = _query(conn, "SELECT id, symbol_id, lot_size, change_date FROM lot_history")
+    else:
+        rows = _query(
+            conn,
+            """
+            SELECT id, symbol_id, lot_size, change_date FROM lot_history
+            WHERE id > %s OR updated_at > %s
+            """,
+            (since.max_id, since.max_updated_at),
+        )
+    return {row['id']: (row['symbol_id'], row['change_date'], int(row['lot_size'])) for row in rows}
+
+
+def rows_version(rows: Dict[int, LotRow]) -> LotHistoryVersion:
+    """Версия набора строк (сравнима с load_lot_history_version)"""
+    if not rows:
+        return LotHistoryVersion(None, None, 0)
+    return LotHistoryVersion(
+        max(change_date for _, change_date, _ in rows.values()),
+        max(rows),
+        len(rows),
+    )
+
+
+def group_lot_history(rows: Dict[int, LotRow]) -> Dict[int, List[Tuple[datetime, int]]]:
+    """Строки lot_history -> {symbol_id: [(change_date UTC-aware, lot_size), ...]} по убыванию даты"""
+    history: Dict[int, List[Tuple[datetime, int]]] = {}
+
+    for symbol_id, change_date, lot_size in rows.values():
+        if change_date.tzinfo is None:
+            change_date = change_date.replace(tzinfo=timezone.utc)
+        history.setdefault(symbol_id, []).append((change_date, lot_size))
+
+    for lots in history.values():
+        lots.sort(key=lambda item: item[0], reverse=True)
+
+    return history
 
 
 def load_lot_history() -> Dict[int, List[Tuple[datetime, int]]]:
@@ -17,43 +130,82 @@ def load_lot_history() -> Dict[int, List[Tuple[datetime, int]]]:
         Словарь {symbol_id: [(change_date, lot_size), ...]}
         change_date - UTC-aware datetime
     """
-    conn = psycopg2.connect(**DBCFG)
+    return group_lot_history(load_lot_rows())
 
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            sql = """
-                SELECT symbol_id, lot_size, change_date
-                FROM lot_history
-                ORDER BY symbol_id, change_date DESC
-            """
-            cur.execute(sql)
-            rows = cur.fetchall()
 
-            history: Dict[int, List[Tuple[datetime, int]]] = {}
+class LotSizeCache:
+    """
+    Кэш для размеров лотов с оптимизацией повторных запросов
 
-            for row in rows:
-                symbol_id = row['symbol_id']
-                lot_size = row['lot_size']
-                change_date = row['change_date']
+    По каждому символу держатся отсортированные по возрастанию даты изменений
+    (epoch-секунды для bisect по одной дате и int64 нс для векторного поиска)
+    и соответствующие размеры лота.
 
-                if change_date.tzinfo is None:
-                    change_date = change_date.replace(tzinfo=timezone.utc)
+    Кэш строится из снимка (LotHistorySnapshot от родительского процесса) или
+    из БД; долгоживущие процессы вызывают refresh(), который по версии таблицы
+    определяет изменения и догружает только новые и изменённые строки.
+    """
 
-                history.setdefault(symbol_id, []).append((change_date, int(lot_size)))
+    def __init__(self, snapshot: Optional[LotHistorySnapshot] = None, conn=None):
+        if snapshot is not None:
+            self._set_rows(snapshot.rows, snapshot.version)
+        else:
+            # версия читается до строк: изменение между запросами увидит следующий refresh
+            version = load_lot_history_version(conn)
+            self._set_rows(load_lot_rows(conn), version)
+
+    def _set_rows(self, rows: Dict[int, LotRow], version: LotHistoryVersion):
+        self._rows = rows
+        self.version = version
+        self.history = group_lot_history(rows)
+        self.last_key: Optional[Tuple[int, Optional[datetime]]] = None
+        self.last_value: Optional[int] = None
 
-            return history
+        self._dates: Dict[int, List[float]] = {}
+        self._dates_ns: Dict[int, np.ndarray] = {}
+        self._sizes: Dict[int, np.ndarray] = {}
 
-    finally:
-        conn.close()
+        for symbol_id, lots in self.history.items():
+            ascending = lots[::-1]
+            self._dates[symbol_id] = [change_date.timestamp() for change_date, _ in ascending]
+            self._dates_ns[symbol_id] = to_utc_ns(pd.DatetimeIndex([change_date for change_date, _ in ascending]))
+            self._sizes[symbol_id] = np.array([lot_size for _, lot_size in ascending], dtype=np.int64)
 
+    def snapshot(self) -> LotHistorySnapshot:
+        """Снимок для передачи в другие процессы"""
+        return LotHistorySnapshot(rows=dict(self._rows), version=self.version)
 
-class LotSizeCache:
-    """Кэш для размеров лотов с оптимизацией повторных запросов"""
+    def refresh(self, conn=None) -> bool:
+        """
+        Сверяет версию lot_history с БД и подгружает изменения
 
-    def __init__(self):
-        self.history = load_lot_history()
-        self.last_key: Optional[Tuple[int, Optional[datetime]]] = None
-        self.last_value: Optional[int] = None
+        Новые и изменённые UPDATE строки (id или updated_at больше известных)
+        догружаются инкрементально; если после этого версии не совпали
+        (удаление строк), таблица перечитывается целиком.
+
+        Returns:
+            True - кэш обновлён
+        """
+        db_version = load_lot_history_version(conn)
+        if db_version == self.version:
+            return False
+
+        rows = None
+        if self.version.max_id is not None and self.version.max_updated_at is not None:
+            rows = dict(self._rows)
+            rows.update(load_lot_rows(conn, since=self.version))
+            if rows_version(rows) != db_version.rows_part():
+                rows = None
+
+        if rows is None:
+            rows = load_lot_rows(conn)
+
+        self._set_rows(rows, db_version)
+        return True
+
+    def has_history(self, symbol_id: int) -> bool:
+        """Есть ли у символа записи в lot_history"""
+        return symbol_id in self._sizes
 
     def get_lotsize(self, symbol_id: int, as_of: Optional[datetime] = None) -> int:
         """
@@ -70,35 +222,67 @@ class LotSizeCache:
         if key == self.last_key:
             return self.last_value or 1
 
-        lots = self.history.get(symbol_id)
-        if not lots:
-            self.last_key = key
-            self.last_value = 1
-            return 1
-
-        if as_of is None:
-            size = lots[0][1]
+        sizes = self._sizes.get(symbol_id)
+        if sizes is None:
+            size = 1
+        elif as_of is None:
+            size = int(sizes[-1])
         else:
-            if hasattr(as_of, 'tzinfo') and as_of.tzinfo is None:
+            if as_of.tzinfo is None:
                 as_of = as_of.replace(tzinfo=timezone.utc)
-            elif hasattr(as_of, 'tz') and as_of.tz is None:
-                as_of = as_of.tz_localize('UTC')
-
-            size = 1
-            for change_date, lot_size in lots:
-                if change_date <= as_of:
-                    size = lot_size
-                    break
+            pos = bisect_right(self._dates[symbol_id], as_of.timestamp()) - 1
+            size = int(sizes[pos]) if pos >= 0 else 1
 
         self.last_key = key
         self.last_value = size
         return size
 
+    def lot_sizes_for_index(self, symbol_id: int, index: pd.DatetimeIndex) -> np.ndarray:
+        """
+        Размеры лота на каждую дату индекса (векторно, searchsorted)
+
+        Args:
+            symbol_id: ID символа
+            index: даты баров (без часового пояса - считаются UTC)
+
+        Returns:
+            np.ndarray int64 той же длины, что index (1 - до первого изменения
+            или если история символа не найдена)
+        """
+        sizes = self._sizes.get(symbol_id)
+        if sizes is None:
+            return np.ones(len(index), dtype=np.int64)
+
+        pos = np.searchsorted(self._dates_ns[symbol_id], to_utc_ns(index), side='right') - 1
+        return np.where(pos >= 0, sizes[np.maximum(pos, 0)], 1)
+
+
+def to_utc_ns(index) -> np.ndarray:
+    """Даты в int64 наносекунд UTC (даты без часового пояса считаются UTC)"""
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    return np.asarray(index.values, dtype='datetime64[ns]').view(np.int64)
+
 
 # Глобальный кэш
 global_lot_cache: Optional[LotSizeCache] = None
 
 
+def install_lot_snapshot(snapshot: LotHistorySnapshot):
+    """Устанавливает глобальный кэш процесса из снимка родителя (без запроса к БД)"""
+    global global_lot_cache
+    global_lot_cache = LotSizeCache(snapshot)
+
+
+def get_lot_cache() -> LotSizeCache:
+    """Глобальный кэш лотов процесса (создаётся при первом обращении)"""
+    global global_lot_cache
+    if global_lot_cache is None:
+        global_lot_cache = LotSizeCache()
+    return global_lot_cache
+
+
 def get_lotsize(symbol_id: int, as_of: Optional[datetime] = None) -> int:
     """
     Глобальная функция для получения размера лота
@@ -110,10 +294,21 @@ def get_lotsize(symbol_id: int, as_of: Optional[datetime] = None) -> int:
     Returns:
         Размер лота
     """
-    global global_lot_cache
-    if global_lot_cache is None:
-        global_lot_cache = LotSizeCache()
-    return global_lot_cache.get_lotsize(symbol_id, as_of)
+    return get_lot_cache().get_lotsize(symbol_id, as_of)
+
+
+def lot_sizes_for_index(symbol_id: int, index: pd.DatetimeIndex) -> np.ndarray:
+    """
+    Глобальная функция: размеры лота, выровненные по индексу данных бэктеста
+
+    Args:
+        symbol_id: ID символа
+        index: даты баров
+
+    Returns:
+        np.ndarray int64 размеров лота по барам
+    """
+    return get_lot_cache().lot_sizes_for_index(symbol_id, index)
 
 
 def calc_shares_by_risk(
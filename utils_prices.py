@@ -0,0 +1,187 @@
+"""
+utils_prices.py - Последние цены инструментов (таблица last_prices)
+
+last_prices хранит одну строку на инструмент: последнюю минутную свечу
+(price = её close, плюс open/high/low/volume для исполнения LIMIT/STOP).
+Её обновляют при каждой записи минуток (datafeed_aggregator и внешняя загрузка
+в candles_1m), а читают fake_broker, переоценка позиций и проверки здоровья -
+вместо поиска последней свечи в candles_1m.
+
+Функции записи не делают commit: цены пишутся в транзакции вызывающего кода,
+вместе с самими свечами.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from configloader import DBCFG
+from db_pool import connection
+
+
+# Последняя минутка: (symbol_id, timestamp как в candles_1m, close, open, high, low, volume)
+PriceRow = Tuple[int, datetime, float, Optional[float], Optional[float], Optional[float], Optional[int]]
+
+
+@dataclass(frozen=True)
+class LastBar:
+    """Последняя минутная свеча инструмента из last_prices"""
+    ticker: str
+    bar_timestamp: datetime
+    price: float
+    open: float
+    high: float
+    low: float
+    volume: Optional[int]
+
+
+def _optional_float(value) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+def latest_by_symbol(rows: Iterable) -> List[PriceRow]:
+    """
+    Последняя минутка по каждому symbol_id из набора свечей
+
+    Args:
+        rows: строки candles_1m (DictRow/dict с symbol_id, timestamp, close;
+              open/high/low/volume - если есть)
+
+    Returns:
+        [PriceRow] - по одной строке на инструмент
+    """
+    latest: Dict[int, PriceRow] = {}
+    for row in rows:
+        symbol_id = row["symbol_id"]
+        ts = row["timestamp"]
+        current = latest.get(symbol_id)
+        if current is None or ts >= current[1]:
+            latest[symbol_id] = (
+                symbol_id,
+                ts,
+                float(row["close"]),
+                _optional_float(row.get("open")),
+                _optional_float(row.get("high")),
+                _optional_float(row.get("low")),
+                int(row["volume"]) if row.get("volume") is not None else None,
+            )
+    return list(latest.values())
+
+
+def upsert_last_prices(conn, prices: List[PriceRow]) -> int:
+    """
+    Записывает последние цены одним запросом (без commit)
+
+    Более старая минутка не затирает более новую (повторная или догружаемая история).
+
+    Args:
+        conn: соединение psycopg2
+        prices: [PriceRow]
+
+    Returns:
+        число переданных инструментов
+    """
+    if not prices:
+        return 0
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            INSERT INTO last_prices (
+                symbol_id, ticker, price, bar_timestamp,
+                open, high, low, volume, updated_at
+            )
+            SELECT s.id, s.ticker, v.price, v.bar_timestamp,
+                   v.open, v.high, v.low, v.volume, now()
+            FROM (VALUES %s) AS v (symbol_id, bar_timestamp, price, open, high, low, volume)
+            JOIN symbols s ON s.id = v.symbol_id
+            ON CONFLICT (symbol_id)
+            DO UPDATE SET price = EXCLUDED.price,
+                          bar_timestamp = EXCLUDED.bar_timestamp,
+                          open = EXCLUDED.open,
+                          high = EXCLUDED.high,
+                          low = EXCLUDED.low,
+                          volume = EXCLUDED.volume,
+                          updated_at = EXCLUDED.updated_at
+            WHERE last_prices.bar_timestamp <= EXCLUDED.bar_timestamp
+            """,
+            prices,
+            template=(
+                "(%s::integer, %s::timestamp, %s::double precision, %s::double precision,"
+                " %s::double precision, %s::double precision, %s::bigint)"
+            ),
+        )
+    return len(prices)
+
+
+def update_last_prices_from_candles(conn, rows: Iterable) -> int:
+    """
+    Обновляет last_prices по только что записанным минуткам (без commit)
+
+    Вызывается загрузчиком candles_1m в той же транзакции, что и вставка свечей.
+
+    Args:
+        conn: соединение psycopg2
+        rows: строки candles_1m (dict с symbol_id, timestamp, close)
+
+    Returns:
+        число обновлённых инструментов
+    """
+    return upsert_last_prices(conn, latest_by_symbol(rows))
+
+
+def load_last_prices(conn=None, tickers: Optional[List[str]] = None) -> Dict[str, float]:
+    """
+    Последние цены по тикерам
+
+    Args:
+        conn: соединение psycopg2 (None - соединение из пула процесса, DBCFG)
+        tickers: тикеры (None - все инструменты)
+
+    Returns:
+        {ticker: price}; инструментов без цены в словаре нет
+    """
+    if conn is None:
+        with connection(DBCFG) as pooled:
+            return load_last_prices(pooled, tickers)
+
+    with conn.cursor() as cur:
+        if tickers is None:
+            cur.execute("SELECT ticker, price FROM last_prices")
+        else:
+            cur.execute("SELECT ticker, price FROM last_prices WHERE ticker = ANY(%s)", (list(tickers),))
+        return {ticker: float(price) for ticker, price in cur.fetchall()}
+
+
+def load_last_bars(conn, tickers: List[str]) -> Dict[str, LastBar]:
+    """
+    Последние минутные свечи по тикерам (для исполнения LIMIT/STOP по high/low)
+
+    Returns:
+        {ticker: LastBar}; отсутствующие open/high/low заменяются на price
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT ticker, bar_timestamp, price, open, high, low, volume
+            FROM last_prices
+            WHERE ticker = ANY(%s)
+            """,
+            (list(tickers),),
+        )
+        rows = cur.fetchall()
+
+    bars: Dict[str, LastBar] = {}
+    for ticker, bar_ts, price, open_, high, low, volume in rows:
+        price = float(price)
+        bars[ticker] = LastBar(
+            ticker=ticker,
+            bar_timestamp=bar_ts,
+            price=price,
+            open=float(open_) if open_ is not None else price,
+            high=float(high) if high is not None else price,
+            low=float(low) if low is not None else price,
+            volume=int(volume) if volume is not None else None,
+        )
+    return bars